@@ -1,4 +1,42 @@
+import atexit
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import metrics
+
+POSTGRES_POOL_MIN_CONNECTIONS = 1
+POSTGRES_POOL_MAX_CONNECTIONS = 20
+
+# One pool per process, shared by every PostgresHelper
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAX_CONNECTIONS)
+
+
+class PreparedStatementConnection(psycopg2.extensions.connection):
+    """
+    A connection that remembers which server-side prepared statements it has.
+    Prepared statements live as long as the backend session, so they are prepared once per pooled connection.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+def _close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+atexit.register(_close_pool)
 
 
 class PostgresHelper(object):
@@ -14,37 +52,123 @@ class PostgresHelper(object):
         POSTGRES_DB = ''
 
         self.conn_string = "host=" + str(POSTGRES_HOST) + " port=" + str(POSTGRES_PORT) + " dbname=" + str(POSTGRES_DB) + " user=" + str(POSTGRES_USERNAME) + " password=" + str(POSTGRES_PASSWORD)
-        print('PostGRES database to be used: ' + POSTGRES_HOST + ":" + str(POSTGRES_PORT))
 
-        # Check connection to the PostGRES database
-        try:
-            connection = psycopg2.connect(self.conn_string)
-            connection.close()
-            print('Successfully connected to PostGRES database.')
-        except (RuntimeError, Exception) as err:
-            print('Failed to connect to PostGRES database. Please check your environment variables and try again.')
-            print('\nTHE APPLICATION WILL NOT WORK PROPERLY.\n')
+        # The first helper of the process creates the pool, which checks the connection to the PostGRES database
+        if _pool is None:
+            print('PostGRES database to be used: ' + POSTGRES_HOST + ":" + str(POSTGRES_PORT))
+            try:
+                self.get_pool()
+                print('Successfully connected to PostGRES database.')
+            except (RuntimeError, Exception) as err:
+                print('Failed to connect to PostGRES database. Please check your environment variables and try again.')
+                print('\nTHE APPLICATION WILL NOT WORK PROPERLY.\n')
+
+    def get_pool(self):
+        """
+        Returns the connection pool of the process, creating it on first use.
+        """
+        global _pool
+        if _pool is None:
+            with _pool_lock:
+                if _pool is None:
+                    _pool = psycopg2.pool.ThreadedConnectionPool(POSTGRES_POOL_MIN_CONNECTIONS,
+                                                                 POSTGRES_POOL_MAX_CONNECTIONS,
+                                                                 self.conn_string,
+                                                                 connection_factory=PreparedStatementConnection)
+        return _pool
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the duration of a transaction.
+        The transaction is committed when the block succeeds and rolled back otherwise.
+        Waits for a free connection when all of them are in use instead of failing.
+        """
+        connection_pool = self.get_pool()
+        started_at = time.perf_counter()
+        with _pool_slots:
+            conn = connection_pool.getconn()
+            metrics.db_pool_wait_seconds.observe(time.perf_counter() - started_at)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                # Connections broken by a server restart are dropped, the pool opens new ones on demand
+                connection_pool.putconn(conn, close=conn.closed != 0)
 
-    def query(self, query_string):
+    def query(self, query_string, params=None, name=''):
         """
         Executes the query and returns the results
+        :param query_string: The SQL with %s placeholders for the parameters
+        :param params: The values of the placeholders, never formatted into the SQL
+        :param name: A constant identifier of the query, which labels its metrics
         """
-        conn = psycopg2.connect(self.conn_string)
-        cursor = conn.cursor()
-        cursor.execute(query_string)
-        results = cursor.fetchall()
-        cursor.close()
-        return results
+        with metrics.timed_query('query', name), self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query_string, params)
+                return cursor.fetchall()
 
-    def execute(self, query_string):
+    def execute(self, query_string, params=None):
         """
         Executes the query
+        :param query_string: The SQL with %s placeholders for the parameters
+        :param params: The values of the placeholders, never formatted into the SQL
         """
-        conn = psycopg2.connect(self.conn_string)
-        conn.autocommit = True
-        cursor = conn.cursor()
-        cursor.execute(query_string)
-        cursor.close()
+        with metrics.timed_query('execute'), self.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query_string, params)
+        return
+
+    def stream(self, query_string, params=None, itersize=2000, name=''):
+        """
+        Executes the query on a server-side (named) cursor and yields the rows one at a time.
+        Only itersize rows are transferred per round trip, so the memory used does not depend on the size of the
+        result. The pooled connection is held until the generator is exhausted or closed.
+        :param query_string: The SQL with %s placeholders for the parameters
+        :param params: The values of the placeholders, never formatted into the SQL
+        :param itersize: The number of rows fetched per round trip
+        :param name: A constant identifier of the query, which labels its metrics
+        """
+        with self.connection() as conn:
+            with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = itersize
+                # Timed up to the first page of rows, the rest is paced by the consumer
+                with metrics.timed_query('stream', name):
+                    cursor.execute(query_string, params)
+                    rows = iter(cursor)
+                    first_row = next(rows, None)
+                if first_row is None:
+                    return
+                yield first_row
+                for row in rows:
+                    yield row
+
+    def query_prepared(self, name, statement, params):
+        """
+        Executes a server-side prepared statement and returns the results.
+        The statement is parsed and planned once per pooled connection, then only executed.
+        :param name: The name of the prepared statement, a constant identifier
+        :param statement: The SQL with $1, $2, ... placeholders
+        :param params: The values of the placeholders
+        """
+        with metrics.timed_query('prepared', name), self.connection() as conn:
+            with conn.cursor() as cursor:
+                if name not in conn.prepared_statements:
+                    cursor.execute(f"PREPARE {name} AS {statement}")
+                    conn.prepared_statements.add(name)
+                placeholders = ', '.join(['%s'] * len(params))
+                cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+                return cursor.fetchall()
+
+    def execute_values(self, query_string, rows, template=None, page_size=1000):
+        """
+        Executes the query once per page of rows, the VALUES %s placeholder is expanded to the rows of the page.
+        All pages are committed together.
+        :param template: The placeholders of one row, e.g. '(%s::bigint, %s)', defaults to untyped placeholders
+        """
+        with metrics.timed_query('execute_values'), self.connection() as conn:
+            with conn.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, query_string, rows, template=template, page_size=page_size)
         return
 
     @staticmethod
@@ -37,129 +37,308 @@ Overall Guest Satisfaction:
  - Analyze the overall sentiment and satisfaction level from the reviews.
 Note: Maintain a balanced view, highlighting unique features and actionable insights for an investor."""
 
-import tiktoken
+# Prompts of the hierarchical summarization in hierarchical_summarizer.py
+chunk_summary_prompt = """You are condensing a batch of customer reviews, separated by '|||', for an AirBNB property \
+so that it can be summarized later together with the other batches. In no more than 150 words, keep every fact that \
+matters: key features, facilities, the hosts, the location, recurring praise and recurring complaints with how often \
+they come up, and the overall sentiment. Do not add anything that is not in the reviews."""
+
+partial_summaries_preface = """The reviews of this AirBNB property were too many to read at once, so they were \
+condensed into partial summaries, one per batch of reviews, the most recent first, separated by '|||'. Treat them as \
+the customer reviews. """
+
+# Prompt preface of the incremental refresh in incremental_refresh.py
+new_reviews_preface = """The text below starts with the current analysis of the reviews of this AirBNB property. After \
+the line '###' come the reviews received since it was written, most recent first, separated by '|||'. Update the \
+analysis so that it covers the old and the new reviews together, giving the new ones their due weight without \
+dropping what still holds from the old ones. """
+
+# Prompt of the single call that generates both the summary and the critical review
+combined_prompt = """You are given the customer reviews, separated by '|||', for an AirBNB property. Write two \
+analyses of them and answer with a JSON object whose "summary" and "critical_review" keys hold them as plain text.
+
+The "summary": """ + summary_prompt + """
+
+The "critical_review": """ + critical_review_prompt.lstrip('"')
+
+# Structured output of the combined prompt, for the models that support json_schema response formats
+combined_response_format = {
+    'type': 'json_schema',
+    'json_schema': {
+        'name': 'review_analysis',
+        'strict': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'summary': {'type': 'string'},
+                'critical_review': {'type': 'string'}
+            },
+            'required': ['summary', 'critical_review'],
+            'additionalProperties': False
+        }
+    }
+}
+
+# JSON mode of the older models, the prompt names the keys and the response is validated against the schema above
+json_object_response_format = {'type': 'json_object'}
+
 import datetime as dt
+import itertools
+from contextlib import closing
 from PostgresHelper import PostgresHelper
-import string
+import metrics
+from completion_cache import CompletionCache, completion_cache_mode, completion_key
+from review_text import clean_review, map_reviews, normalize_processes, printable
+from review_writer import BufferedReviewWriter, bulk_update_reviews
+from token_budget import num_tokens, get_token_budget
+import openai
 from openai import OpenAI
+from openai.types.chat import ChatCompletion
 
 client = OpenAI(api_key='INSERT API KEY HERE')
 import os
 import time
 
 cost_per_100k_tokens = 0.80
+openai_model = "gpt-4-1106-preview"
+max_completion_tokens = 1024
+
+# The prompt and sampling parameters of each kind of generation
+prompt_settings = {
+    'summary': {'prompt': summary_prompt, 'temperature': 1},
+    'critical_review': {'prompt': critical_review_prompt, 'temperature': 0.5},
+    'chunk_summary': {'prompt': chunk_summary_prompt, 'temperature': 0.3},
+    'reduce_summary': {'prompt': partial_summaries_preface + summary_prompt, 'temperature': 1},
+    'reduce_critical_review': {'prompt': partial_summaries_preface + critical_review_prompt, 'temperature': 0.5},
+    'merge_summary': {'prompt': new_reviews_preface + summary_prompt, 'temperature': 1},
+    'merge_critical_review': {'prompt': new_reviews_preface + critical_review_prompt, 'temperature': 0.5},
+    'combined': {'prompt': combined_prompt, 'temperature': 0.7, 'max_tokens': 2 * max_completion_tokens,
+                 'response_format': combined_response_format},
+}
+
+# Models accepting json_schema response formats, by prefix of their name
+json_schema_models = ['gpt-4o-mini', 'gpt-4o-2024-08-06', 'gpt-4o-2024-11-20', 'gpt-4.1']
+
+# Generate the summary and the critical review of a single property in one structured call, falling back to two calls.
+# A model that rejects the response format turns it off for the rest of the run after the first failure.
+combined_generation = True
+
+
+def completion_request(kind, chunk):
+    """
+    Returns the keyword arguments of chat.completions.create for a kind of generation, which also key its response in
+    the completion cache.
+    :param kind: A key of prompt_settings
+    :param chunk: The cleaned up consolidated review
+    """
+    settings = prompt_settings[kind]
+    request = {
+        'model': openai_model,
+        'messages': [
+            {"role": "system", "content": settings['prompt']},
+            {"role": "user", "content": chunk}
+        ],
+        'temperature': settings['temperature'],
+        'max_tokens': settings.get('max_tokens', max_completion_tokens),
+        'top_p': 1,
+        'frequency_penalty': 0,
+        'presence_penalty': 0
+    }
+    if 'response_format' in settings:
+        if openai_model.startswith(tuple(json_schema_models)):
+            request['response_format'] = settings['response_format']
+        else:
+            request['response_format'] = json_object_response_format
+    return request
+
+
+# Rows per round trip of the server-side cursors and properties tokenized together when streaming the reviews
+stream_itersize = 2000
+format_page_size = 256
+
+# Account limits for openai_model, used to pace the asynchronous pipeline
+requests_per_minute = 500
+tokens_per_minute = 300000
+max_concurrent_requests = 16
 
 
 class AirBnbReviewSummarizer(object):
-    def __init__(self):
+    def __init__(self, cache_mode=completion_cache_mode):
+        """
+        :param cache_mode: The mode of the completion cache, 'record', 'replay' or 'off'
+        """
         self.postgres_helper = PostgresHelper()
+        self.review_writer = BufferedReviewWriter(self.postgres_helper)
+        self.completion_cache = CompletionCache(mode=cache_mode)
+        self.combined_generation = combined_generation
+        # Properties generated, seconds and tokens used by the combined call and by the two calls, from their usage
+        self.generation_totals = {path: {'count': 0, 'seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0}
+                                  for path in ['combined', 'two_calls']}
 
     def num_tokens_from_string(self, string: str, encoding_name: str) -> int:
         """Returns the number of tokens in a text string."""
-        encoding = tiktoken.get_encoding(encoding_name)
-        num_tokens = len(encoding.encode(string))
-        return num_tokens
+        return num_tokens(string, encoding_name)
 
-    def crop_string_to_max_tokens(self, string: str, encoding_name: str, max_tokens:int) -> string:
+    def crop_string_to_max_tokens(self, string: str, encoding_name: str, max_tokens:int) -> str:
         """Crops the string to meet the max number of tokens."""
-        num_prompt_tokens = self.num_tokens_from_string(summary_prompt, "cl100k_base")
-        encoding = tiktoken.get_encoding(encoding_name)
-        encoded_cropped_list = encoding.encode(string)[:(max_tokens-num_prompt_tokens)]
-        return encoding.decode(encoded_cropped_list)
+        return get_token_budget(max_tokens, summary_prompt, encoding_name).crop_tokens(string)[0]
 
     def get_consolidated_reviews_for_single_property(self, property_id):
-        sql = f"""
+        sql = """
         SELECT
             CONSOLIDATED_REVIEW
         FROM JoshuaConsolidatedRawReviews
-        WHERE PROPERTY_ID = {property_id}
+        WHERE PROPERTY_ID = $1
         """
-        print(sql)
-        query_results = self.postgres_helper.query(sql)
+        query_results = self.postgres_helper.query_prepared('consolidated_review_by_property_id', sql, (int(property_id),))
         if len(query_results) > 0:
             return query_results[0][0]
         else:
             return ''
 
     def get_property_reviews(self, limit=10):
-        sql = f"""
+        sql = """
         SELECT
             PROPERTY_ID, CONSOLIDATED_REVIEW
             FROM JoshuaConsolidatedRawReviews
-            WHERE lengthCONSOLIDATED_REVIEW) > 0
+            WHERE length(CONSOLIDATED_REVIEW) > 0
             AND SUMMARY IS NULL
-            LIMIT {limit}
+            LIMIT %s
         """
-        query_results = self.postgres_helper.query(sql)
+        query_results = self.postgres_helper.query(sql, (limit,), name='property_reviews')
         return query_results
 
     def get_reviews_for_summarized_properties(self, limit=10):
-        sql = f"""
+        sql = """
         SELECT
             PROPERTY_ID, CONSOLIDATED_REVIEW
             FROM JoshuaConsolidatedRawReviews
             WHERE length(CONSOLIDATED_REVIEW) > 0
             AND CRITICAL_REVIEW IS NULL
             AND (length(summary) > 0 OR SUMMARY IS NOT NULL)
-            LIMIT {limit}
+            LIMIT %s
         """
-        query_results = self.postgres_helper.query(sql)
+        query_results = self.postgres_helper.query(sql, (limit,), name='reviews_for_summarized_properties')
         return query_results
 
+    def stream_property_reviews(self, itersize=stream_itersize):
+        """
+        Streams the (property_id, consolidated review) of the properties without a summary over a server-side cursor.
+        """
+        sql = """
+        SELECT
+            PROPERTY_ID, CONSOLIDATED_REVIEW
+            FROM JoshuaConsolidatedRawReviews
+            WHERE length(CONSOLIDATED_REVIEW) > 0
+            AND SUMMARY IS NULL
+        """
+        return self.postgres_helper.stream(sql, itersize=itersize, name='property_reviews')
+
+    def stream_reviews_for_summarized_properties(self, itersize=stream_itersize):
+        """
+        Streams the (property_id, consolidated review) of the summarized properties without a critical review.
+        """
+        sql = """
+        SELECT
+            PROPERTY_ID, CONSOLIDATED_REVIEW
+            FROM JoshuaConsolidatedRawReviews
+            WHERE length(CONSOLIDATED_REVIEW) > 0
+            AND CRITICAL_REVIEW IS NULL
+            AND (length(summary) > 0 OR SUMMARY IS NOT NULL)
+        """
+        return self.postgres_helper.stream(sql, itersize=itersize, name='reviews_for_summarized_properties')
+
+    def clean_review_stream(self, property_reviews):
+        """
+        Cleans up the consolidated reviews of a stream of (property_id, consolidated review).
+        """
+        for property_id, consolidated_review in property_reviews:
+            yield property_id, clean_review(consolidated_review)
+
+    def format_review_stream(self, property_reviews, prompt=summary_prompt, page_size=format_page_size,
+                             processes=normalize_processes):
+        """
+        Crops a stream of cleaned (property_id, consolidated review) to the token budget, a page at a time.
+        :param processes: The number of processes filtering the printable characters of a page
+        :return: A generator of (property_id, token worthy review, token count), the review holding only printable
+        characters and the count being the one of the cropped review
+        """
+        while True:
+            page = list(itertools.islice(property_reviews, page_size))
+            if len(page) == 0:
+                return
+            formatted_reviews = self.format_reviews([consolidated_review for _, consolidated_review in page], prompt=prompt)
+            printable_reviews = map_reviews(printable, [token_worthy_review for token_worthy_review, _ in formatted_reviews],
+                                            processes)
+            for (property_id, _), token_worthy_review, (_, token_count) in zip(page, printable_reviews, formatted_reviews):
+                yield property_id, token_worthy_review, token_count
+
+    def page_size_for(self, limit):
+        """
+        Tokenizes no more properties per page than a limited export needs.
+        """
+        if limit is None:
+            return format_page_size
+        return max(1, min(format_page_size, limit))
+
+    def token_worthy_review_stream(self, property_reviews, prompt=summary_prompt, page_size=format_page_size):
+        """
+        The clean and tokenize stages of the export pipeline, in bounded memory.
+        """
+        return self.format_review_stream(self.clean_review_stream(property_reviews), prompt, page_size)
+
     def is_summary_available(self, propertyId):
-        postgres = PostgresHelper()
-        query_string = f"""
+        query_string = """
         SELECT
             property_id,
             summary
         FROM JoshuaConsolidatedRawReviews
         WHERE (length(summary) > 0 OR SUMMARY IS NOT NULL)
-        AND property_id = {propertyId}
+        AND property_id = $1
         """
-        rows = postgres.query(query_string)
+        rows = self.postgres_helper.query_prepared('summary_by_property_id', query_string, (int(propertyId),))
         return_value = False
         if len(rows) > 0:
             return_value = True
 
         return return_value
 
-    def format_review(self, review, max_tokens=4096):
+    def format_review(self, review, max_tokens=4096, prompt=summary_prompt):
         """
-        Formats a review to ensure that the tokens are less than 4096
-        :param review:
-        :return:
+        Formats a review to ensure that the tokens are less than 4096, keeping the newest reviews that fit
+        :param review: The consolidated review
+        :param max_tokens: The token budget of the prompt and the review together
+        :param prompt: The system prompt the review is sent with
+        :return: The cropped review and its number of tokens
         """
-        while (True):
-            token_count = self.num_tokens_from_string(review, "cl100k_base")
-            if token_count > max_tokens:
-                review = self.crop_string_to_max_tokens(review, "cl100k_base", 4096)
-                #full_text = tokenizer.decode(tokenizer.encode(full_text)[:text_max_length])
-                #desired_fraction = max_tokens / token_count
-                #desired_length = int(len(review) * desired_fraction)
-                #review = review[:desired_length]
-                continue
-            else:
-                break
+        return get_token_budget(max_tokens, prompt).fit(review)
 
-        return review, token_count
+    def format_reviews(self, reviews, max_tokens=4096, prompt=summary_prompt):
+        """
+        Formats a page of reviews at once, tokenizing them in parallel
+        :param reviews: The consolidated reviews
+        :return: A list of (cropped review, number of tokens)
+        """
+        return get_token_budget(max_tokens, prompt).fit_many(reviews)
 
     def save_property_review_summary(self, property_id, summary):
-        sql = f"""
-        UPDATE JoshuaConsolidatedRawReviews
-        SET SUMMARY = '{summary}'
-        WHERE PROPERTY_ID = {property_id}
-        """
-        self.postgres_helper.execute(sql)
+        # Also records the reviews the summary covers, for the incremental refresh
+        bulk_update_reviews(self.postgres_helper, 'summary', [(int(property_id), summary)])
 
     def save_critical_review(self, property_id, critical_review):
-        sql = f"""
+        sql = """
         UPDATE JoshuaConsolidatedRawReviews
-        SET CRITICAL_REVIEW = '{critical_review}'
-        WHERE PROPERTY_ID = {property_id}
+        SET CRITICAL_REVIEW = %s
+        WHERE PROPERTY_ID = %s
         """
-        self.postgres_helper.execute(sql)
+        self.postgres_helper.execute(sql, (critical_review, int(property_id)))
 
     def generate_clean_csv(self, limit=10):
+        """
+        Writes the cropped reviews as tab separated values, one property per line.
+        :param limit: The number of properties to write, None for the whole table
+        :return: The name of the CSV file
+        """
         # Open a CSV file for writing (tab-separated)
         basename = "/tmp/token_worthy_reviews"
         suffix = dt.datetime.now().strftime("%y%m%d_%H%M%S")
@@ -168,125 +347,281 @@ class AirBnbReviewSummarizer(object):
         file = open(temp_filename, "w")
         file.write(f"property_id\tconsolidated_review\ttoken_count\n")
 
-        property_reviews = self.get_property_reviews(2 * limit)
         total_tokens = 0
         property_counter = 0
 
-        for property_review in property_reviews:
-            property_id = property_review[0]
-            raw_consolidated_review = property_review[1].replace('\n', ' ').replace('\t', ' ').replace('["','').replace('"]','').replace('\\"', '"')
-            token_worthy_review, token_count = self.format_review(raw_consolidated_review)
-
-            if token_count > 0:
-                filtered_consolidated_review = ''.join(filter(lambda x: x in string.printable, token_worthy_review))
-                total_tokens += token_count
-                property_counter += 1
-                file.write(f"{property_id}\t{filtered_consolidated_review}\t{token_count}\n")
-            if property_counter >= limit:
-                break
+        with closing(self.stream_property_reviews()) as property_reviews:
+            for property_id, token_worthy_review, token_count in self.token_worthy_review_stream(property_reviews, page_size=self.page_size_for(limit)):
+                if token_count > 0:
+                    total_tokens += token_count
+                    property_counter += 1
+                    file.write(f"{property_id}\t{token_worthy_review}\t{token_count}\n")
+                if limit is not None and property_counter >= limit:
+                    break
 
         file.close()
         total_cost = total_tokens * cost_per_100k_tokens / 100000
         print(f"Total properties: {property_counter}")
         print(f"Total tokens: {total_tokens}")
         print(f"Estimated cost of generating model: ${total_cost}")
+        return temp_filename
 
-    def generate_openai_jsonl(self, limit=10):
+    def generate_openai_jsonl(self, limit=10, with_property_id=False, kind='summary'):
+        """
+        Writes the cropped reviews as chat messages, one property per line.
+        :param limit: The number of properties to write, None for the whole table
+        :param with_property_id: Adds the property_id and the kind to every line, as needed by the batch mode in
+        openai_batch.py
+        :param kind: 'summary' for the properties without a summary, 'critical_review' for the summarized properties
+        without a critical review; the reviews are cropped to the budget of the prompt of that kind
+        :return: The name of the JSONL file
+        """
         # Open a CSV file for writing (tab-separated)
         basename = "/tmp/token_worthy_reviews"
         suffix = dt.datetime.now().strftime("%y%m%d_%H%M%S")
-        temp_filename = "_".join([basename, suffix]) + '.jsonl'  # e.g. '/tmp/token_worthy_reviews_120508_171442.jsonl'
+        temp_filename = "_".join([basename, kind, suffix]) + '.jsonl'  # e.g. '/tmp/token_worthy_reviews_summary_120508_171442.jsonl'
 
         file = open(temp_filename, "w")
 
-        property_reviews = self.get_property_reviews(2 * limit)
         total_tokens = 0
         property_counter = 0
+        prompt = prompt_settings[kind]['prompt']
 
-        for property_review in property_reviews:
-            property_id = property_review[0]
-            raw_consolidated_review = property_review[1].replace('\n', ' ').replace('\t', ' ').replace('["','').replace('"]','').replace('\\"', '"')
-            token_worthy_review, token_count = self.format_review(raw_consolidated_review)
-
-            if token_count > 0:
-                filtered_consolidated_review = ''.join(filter(lambda x: x in string.printable, token_worthy_review))
-
-                # {"messages": [{"role": "system", "content": "You are an overly friendly hospitality chatbot named Chatner who just loves to help people, and you're not satisfied unless the customer is completely satisfied."}, {"role": "user", "content": "Is breakfast included?"}, {"role": "assistant", "content": "Oh, I'm thrilled you asked about breakfast! Yes, it's included and served from 7 to 10 a.m. in the main dining area. Enjoy!"}]}
-                system_role = {
-                    "role": "system",
-                    "content": summary_prompt
-                }
-                user_role = {
-                    "role": "user",
-                    "content": filtered_consolidated_review
-                }
-                total_tokens += token_count
-                property_counter += 1
-                complete_message = {
-                    "messages": [
-                        system_role,
-                        user_role
-                    ]
-                }
-                file.write(f"{json.dumps(complete_message)}\n")
-                if property_counter >= limit:
-                    break
+        if kind == 'summary':
+            property_reviews = self.stream_property_reviews()
+        else:
+            property_reviews = self.stream_reviews_for_summarized_properties()
+
+        with closing(property_reviews):
+            for property_id, token_worthy_review, token_count in self.token_worthy_review_stream(property_reviews, prompt, page_size=self.page_size_for(limit)):
+                if token_count > 0:
+                    # {"messages": [{"role": "system", "content": "You are an overly friendly hospitality chatbot named Chatner who just loves to help people, and you're not satisfied unless the customer is completely satisfied."}, {"role": "user", "content": "Is breakfast included?"}, {"role": "assistant", "content": "Oh, I'm thrilled you asked about breakfast! Yes, it's included and served from 7 to 10 a.m. in the main dining area. Enjoy!"}]}
+                    system_role = {
+                        "role": "system",
+                        "content": prompt
+                    }
+                    user_role = {
+                        "role": "user",
+                        "content": token_worthy_review
+                    }
+                    total_tokens += token_count
+                    property_counter += 1
+                    complete_message = {
+                        "messages": [
+                            system_role,
+                            user_role
+                        ]
+                    }
+                    if with_property_id:
+                        complete_message["property_id"] = property_id
+                        complete_message["kind"] = kind
+                    file.write(f"{json.dumps(complete_message)}\n")
+                    if limit is not None and property_counter >= limit:
+                        break
 
         file.close()
         total_cost = total_tokens * cost_per_100k_tokens / 100000
         print(f"Total properties: {property_counter}")
         print(f"Total tokens: {total_tokens}")
         print(f"Estimated cost of generating model: ${total_cost}")
+        return temp_filename
 
-    def create_summary_from_base_model(self, chunk):
-        response = client.chat.completions.create(model="gpt-4-1106-preview",
-        messages=[
-            {"role": "system", "content": f"{summary_prompt}"},
-            {"role": "user", "content": f"{chunk}"}
-        ],
-        temperature=1,
-        max_tokens=1024,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0)
-        print(response)
+    def create_completion_from_base_model(self, kind, chunk):
+        """
+        Answers a completion from the completion cache, or from the base model when it is not cached
+        :param kind: A key of prompt_settings
+        :param chunk: The cleaned up consolidated review
+        """
+        request = completion_request(kind, chunk)
+        return self.completion_cache.complete(request, lambda: self.call_base_model(kind, request), client.base_url)
+
+    def call_base_model(self, kind, request):
+        """
+        Sends a chat completion request and records its latency, tokens and cost in the metrics
+        """
+        started_at = time.monotonic()
+        try:
+            response = client.chat.completions.create(**request)
+        except Exception as err:
+            metrics.observe_completion_error(request['model'], kind, err)
+            raise
+        metrics.observe_completion(request['model'], kind, response, time.monotonic() - started_at, cost_per_100k_tokens)
         return response
 
+    def create_summary_from_base_model(self, chunk):
+        return self.create_completion_from_base_model('summary', chunk)
+
     def create_critical_review_from_base_model(self, chunk):
-        response = client.chat.completions.create(model="gpt-4-1106-preview",
-        messages=[
-            {"role": "system", "content": f"{critical_review_prompt}"},
-            {"role": "user", "content": f"{chunk}"}
-        ],
-        temperature=0.5,
-        max_tokens=1024,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0)
-        print(response)
-        return response
+        return self.create_completion_from_base_model('critical_review', chunk)
+
+    def create_combined_review_from_base_model(self, chunk):
+        """
+        Generates the summary and the critical review in one structured completion
+        :return: A dictionary of the summary and the critical review, and the response
+        :raises ValueError: When the response is not a JSON object of the schema of combined_response_format
+        """
+        response = self.create_completion_from_base_model('combined', chunk)
+        choice = response.choices[0]
+        if choice.finish_reason != 'stop' or not choice.message.content:
+            raise ValueError(f"Incomplete combined response, finish reason {choice.finish_reason}")
+        try:
+            texts = json.loads(choice.message.content)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"Combined response is not JSON: {err}")
+        if not isinstance(texts, dict) or any(not isinstance(texts.get(kind), str) or len(texts[kind].strip()) == 0
+                                              for kind in ['summary', 'critical_review']):
+            raise ValueError("Combined response does not hold both the summary and the critical review")
+        if len(texts) != 2:  # JSON mode does not enforce additionalProperties
+            raise ValueError(f"Combined response holds unexpected keys {sorted(texts)}")
+        return {kind: texts[kind].strip() for kind in ['summary', 'critical_review']}, response
+
+    def record_generation(self, path, elapsed, responses):
+        """
+        Adds a property generated by the combined call or the two calls to generation_totals
+        :param path: 'combined' or 'two_calls'
+        :param elapsed: The seconds taken by the calls
+        :param responses: The responses of the calls, their usage is the number of tokens billed
+        """
+        totals = self.generation_totals[path]
+        totals['count'] += 1
+        totals['seconds'] += elapsed
+        for response in responses:
+            if response.usage is not None:
+                totals['prompt_tokens'] += response.usage.prompt_tokens
+                totals['completion_tokens'] += response.usage.completion_tokens
+
+    def report_combined_savings(self, property_id, elapsed, response):
+        """
+        Prints the latency and the tokens of the combined call of a property, and once properties were generated both
+        ways, what a combined call saves on average over the two calls.
+        :param elapsed: The seconds taken by the combined call
+        :param response: The response of the combined call
+        """
+        message = f"Property Id {property_id}: 1 call instead of 2 in {elapsed:.1f} seconds"
+        if response.usage is not None:
+            message += (f", {response.usage.prompt_tokens} input and {response.usage.completion_tokens} output "
+                        f"tokens")
+        combined, two_calls = self.generation_totals['combined'], self.generation_totals['two_calls']
+        if combined['count'] > 0 and two_calls['count'] > 0:
+            averages = {path: {key: totals[key] / totals['count'] for key in ['seconds', 'prompt_tokens',
+                                                                           'completion_tokens']}
+                        for path, totals in self.generation_totals.items()}
+            saved_tokens = averages['two_calls']['prompt_tokens'] - averages['combined']['prompt_tokens']
+            saved_seconds = averages['two_calls']['seconds'] - averages['combined']['seconds']
+            message += (f". On average over {combined['count']} combined and {two_calls['count']} two call "
+                        f"properties: {saved_tokens:.0f} input tokens "
+                        f"({100.0 * saved_tokens / max(averages['two_calls']['prompt_tokens'], 1):.0f}%) and "
+                        f"{saved_seconds:.1f} seconds saved, "
+                        f"{averages['combined']['completion_tokens'] - averages['two_calls']['completion_tokens']:+.0f}"
+                        f" output tokens")
+        print(message)
 
     def fetch_save_summary_of_reviews_for_single_property(self, property_id):
         property_review = self.get_consolidated_reviews_for_single_property(property_id)
 
         # Clean up the consolidated review
-        raw_consolidated_review = property_review.replace('\n', ' ').replace('\t', ' ').replace('["', '').replace('"]', '').replace('\\"', '"')
+        raw_consolidated_review = clean_review(property_review)
         token_worthy_review, token_count = self.format_review(raw_consolidated_review)
 
         if token_count > 0:
             print(f"Summarizing reviews for property Id {property_id} with {token_count} tokens...")
-            filtered_consolidated_review = ''.join(filter(lambda x: x in string.printable, token_worthy_review))
-
+            filtered_consolidated_review = printable(token_worthy_review)
+
+            if self.combined_generation:
+                try:
+                    started_at = time.monotonic()
+                    texts, combined_response = self.create_combined_review_from_base_model(
+                        filtered_consolidated_review)
+                    elapsed = time.monotonic() - started_at
+                    self.save_property_review_summary(property_id, texts['summary'])
+                    self.save_critical_review(property_id, texts['critical_review'])
+                    self.record_generation('combined', elapsed, [combined_response])
+                    self.report_combined_savings(property_id, elapsed, combined_response)
+                    return
+                except openai.BadRequestError as err:
+                    # The model rejects the response format, every other property would fail the same way
+                    self.combined_generation = False
+                    print(f"Combined generation is not supported by {openai_model}: {err}. "
+                          f"Generating with two calls from now on.")
+                except (openai.OpenAIError, ValueError) as err:
+                    print(f"Combined generation failed for property Id {property_id}: {err}. Falling back to two calls.")
+
+            started_at = time.monotonic()
             # Get the summary first
-            response = self.create_summary_from_base_model(filtered_consolidated_review)
-            the_summary = response.choices[0].message.content
-            the_summary_for_sql = the_summary.replace("'", "''")  # Save the summary to the database
-            self.save_property_review_summary(property_id, the_summary_for_sql)
+            summary_response = self.create_summary_from_base_model(filtered_consolidated_review)
+            the_summary = summary_response.choices[0].message.content
+            self.save_property_review_summary(property_id, the_summary)  # Save the summary to the database
 
             response = self.create_critical_review_from_base_model(filtered_consolidated_review)
             the_critical_review = response.choices[0].message.content
-            the_critical_review_for_sql = the_critical_review.replace("'", "''")  # Save critical review to the database
-            self.save_critical_review(property_id, the_critical_review_for_sql)
+            self.save_critical_review(property_id, the_critical_review)  # Save critical review to the database
+            self.record_generation('two_calls', time.monotonic() - started_at, [summary_response, response])
+        else:
+            print(f"Skipped property Id {property_id}. No tokens found.")
+            self.save_property_review_summary(property_id, "")
+
+    def stream_completion_from_base_model(self, kind, chunk):
+        """
+        Streams a completion of the base model, yielding the text as it is generated
+        A cached completion is yielded at once, a streamed one is cached once complete
+        :param kind: 'summary' or 'critical_review'
+        :param chunk: The cleaned up consolidated review
+        """
+        request = completion_request(kind, chunk)
+        key = completion_key(request, client.base_url)
+        cached_response = self.completion_cache.get(key)
+        if cached_response is not None:
+            yield cached_response.choices[0].message.content
+            return
+
+        started_at = time.monotonic()
+        parts = []
+        last_chunk = None
+        finish_reason = None
+        try:
+            # The last chunk carries the usage of the whole completion
+            stream = client.chat.completions.create(**request, stream=True, stream_options={'include_usage': True})
+            for response_chunk in stream:
+                last_chunk = response_chunk
+                if len(response_chunk.choices) > 0:
+                    finish_reason = response_chunk.choices[0].finish_reason or finish_reason
+                    if response_chunk.choices[0].delta.content:
+                        parts.append(response_chunk.choices[0].delta.content)
+                        yield response_chunk.choices[0].delta.content
+        except Exception as err:
+            metrics.observe_completion_error(request['model'], kind, err)
+            raise
+        if last_chunk is not None and finish_reason is not None:
+            response = ChatCompletion(
+                id=last_chunk.id, created=last_chunk.created, model=last_chunk.model, object='chat.completion',
+                choices=[{'index': 0, 'finish_reason': finish_reason,
+                          'message': {'role': 'assistant', 'content': ''.join(parts)}}],
+                usage=last_chunk.usage)
+            metrics.observe_completion(request['model'], kind, response, time.monotonic() - started_at,
+                                       cost_per_100k_tokens)
+            self.completion_cache.put(key, response)
+
+    def stream_summary_of_reviews_for_single_property(self, property_id):
+        """
+        Streaming counterpart of fetch_save_summary_of_reviews_for_single_property
+        Yields (kind, text delta) as the summary and then the critical review are generated, saving each once complete
+        """
+        property_review = self.get_consolidated_reviews_for_single_property(property_id)
+
+        # Clean up the consolidated review
+        raw_consolidated_review = clean_review(property_review)
+        token_worthy_review, token_count = self.format_review(raw_consolidated_review)
+
+        if token_count > 0:
+            print(f"Streaming the summary of reviews for property Id {property_id} with {token_count} tokens...")
+            filtered_consolidated_review = printable(token_worthy_review)
+
+            for kind, save in [('summary', self.save_property_review_summary), ('critical_review', self.save_critical_review)]:
+                parts = []
+                for delta in self.stream_completion_from_base_model(kind, filtered_consolidated_review):
+                    parts.append(delta)
+                    yield kind, delta
+                save(property_id, ''.join(parts))
         else:
             print(f"Skipped property Id {property_id}. No tokens found.")
             self.save_property_review_summary(property_id, "")
@@ -300,49 +635,44 @@ class AirBnbReviewSummarizer(object):
         file = open(temp_filename, "w")
         file.write(f"property_id\tsummary\tprompt_tokens\tcompletion_tokens\ttotal_tokens\tfinish_reason\n")
 
-        property_reviews = self.get_property_reviews(2 * limit)
         grand_token_count = 0
         property_counter = 0
 
-        for property_review in property_reviews:
-            property_id = property_review[0]
-
-            raw_consolidated_review = property_review[1].replace('\n', ' ').replace('\t', ' ').replace('["','').replace('"]','').replace('\\"', '"')
-            token_worthy_review, token_count = self.format_review(raw_consolidated_review)
-
-            if token_count > 0:
-                print(f"Summarizing reviews for property Id {property_id} with {token_count} tokens...")
-                filtered_consolidated_review = ''.join(filter(lambda x: x in string.printable, token_worthy_review))
-                response = self.create_summary_from_base_model(filtered_consolidated_review)
-
-                the_summary = response.choices[0].message.content
-                prompt_tokens = response.usage.prompt_tokens
-                completion_tokens = response.usage.completion_tokens
-                total_tokens = response.usage.total_tokens
-                finish_reason = response.choices[0].finish_reason
-                file.write(f"{property_id}\t{the_summary}\t{prompt_tokens}\t{completion_tokens}\t{total_tokens}\t{finish_reason}\n")
-
-                # Save it to the database
-                the_summary_for_sql = the_summary.replace("'", "''")
-                self.save_property_review_summary(property_id, the_summary_for_sql)
+        with closing(self.stream_property_reviews()) as property_reviews:
+            for property_id, token_worthy_review, token_count in self.token_worthy_review_stream(property_reviews, page_size=self.page_size_for(limit)):
+                if token_count > 0:
+                    print(f"Summarizing reviews for property Id {property_id} with {token_count} tokens...")
+                    response = self.create_summary_from_base_model(token_worthy_review)
+
+                    the_summary = response.choices[0].message.content
+                    prompt_tokens = response.usage.prompt_tokens
+                    completion_tokens = response.usage.completion_tokens
+                    total_tokens = response.usage.total_tokens
+                    finish_reason = response.choices[0].finish_reason
+                    file.write(f"{property_id}\t{the_summary}\t{prompt_tokens}\t{completion_tokens}\t{total_tokens}\t{finish_reason}\n")
+
+                    # Save it to the database
+                    self.review_writer.add(property_id, 'summary', the_summary)
+
+                    grand_token_count += total_tokens
+                    property_counter += 1
+                    print("Waiting for 10 seconds...")
+                    time.sleep(10)
+                else:
+                    print(f"Skipped property Id {property_id}. No tokens found.")
+                    self.review_writer.add(property_id, 'summary', "")
 
-                grand_token_count += total_tokens
-                property_counter += 1
-                print("Waiting for 10 seconds...")
-                time.sleep(10)
-            else:
-                print(f"Skipped property Id {property_id}. No tokens found.")
-                self.save_property_review_summary(property_id, "")
-
-            if property_counter >= limit:
-                break
+                if property_counter >= limit:
+                    break
 
         file.close()
+        self.review_writer.flush()
         total_cost = grand_token_count * cost_per_100k_tokens / 100000
         print(f"Summaries are saved in file: {temp_filename}")
         print(f"Total properties: {property_counter}")
         print(f"Total tokens: {grand_token_count}")
         print(f"Cost of generating model: ${total_cost}")
+        print(metrics.summary())
 
 
     def generate_property_critical_reviews_from_basemodel(self, limit=10):
@@ -354,48 +684,44 @@ class AirBnbReviewSummarizer(object):
         file = open(temp_filename, "w")
         file.write(f"property_id\tsummary\tprompt_tokens\tcompletion_tokens\ttotal_tokens\tfinish_reason\n")
 
-        property_reviews = self.get_reviews_for_summarized_properties(2 * limit)
         grand_token_count = 0
         property_counter = 0
 
-        for property_review in property_reviews:
-            property_id = property_review[0]
-            raw_consolidated_review = property_review[1].replace('\n', ' ').replace('\t', ' ').replace('["','').replace('"]','').replace('\\"', '"')
-            token_worthy_review, token_count = self.format_review(raw_consolidated_review)
-
-            if token_count > 0:
-                print(f"Summarizing reviews for property Id {property_id} with {token_count} tokens...")
-                filtered_consolidated_review = ''.join(filter(lambda x: x in string.printable, token_worthy_review))
-                response = self.create_critical_review_from_base_model(filtered_consolidated_review)
-
-                the_critical_review = response['choices'][0]['message']['content']
-                prompt_tokens = response['usage']['prompt_tokens']
-                completion_tokens = response['usage']['completion_tokens']
-                total_tokens = response['usage']['total_tokens']
-                finish_reason = response['choices'][0]['finish_reason']
-                file.write(f"{property_id}\t{the_critical_review}\t{prompt_tokens}\t{completion_tokens}\t{total_tokens}\t{finish_reason}\n")
-
-                # Save it to the database
-                the_critical_review_for_sql = the_critical_review.replace("'", "''")
-                self.save_critical_review(property_id, the_critical_review_for_sql)
-
-                grand_token_count += total_tokens
-                property_counter += 1
-                print("Waiting for 10 seconds...")
-                time.sleep(10)
-            else:
-                print(f"Skipped property Id {property_id}. No tokens found.")
-                self.save_property_review_summary(property_id, "")
-
-            if property_counter >= limit:
-                break
+        with closing(self.stream_reviews_for_summarized_properties()) as property_reviews:
+            for property_id, token_worthy_review, token_count in self.token_worthy_review_stream(property_reviews, prompt=critical_review_prompt, page_size=self.page_size_for(limit)):
+                if token_count > 0:
+                    print(f"Summarizing reviews for property Id {property_id} with {token_count} tokens...")
+                    response = self.create_critical_review_from_base_model(token_worthy_review)
+
+                    the_critical_review = response['choices'][0]['message']['content']
+                    prompt_tokens = response['usage']['prompt_tokens']
+                    completion_tokens = response['usage']['completion_tokens']
+                    total_tokens = response['usage']['total_tokens']
+                    finish_reason = response['choices'][0]['finish_reason']
+                    file.write(f"{property_id}\t{the_critical_review}\t{prompt_tokens}\t{completion_tokens}\t{total_tokens}\t{finish_reason}\n")
+
+                    # Save it to the database
+                    self.review_writer.add(property_id, 'critical_review', the_critical_review)
+
+                    grand_token_count += total_tokens
+                    property_counter += 1
+                    print("Waiting for 10 seconds...")
+                    time.sleep(10)
+                else:
+                    print(f"Skipped property Id {property_id}. No tokens found.")
+                    self.review_writer.add(property_id, 'critical_review', "")
+
+                if property_counter >= limit:
+                    break
 
         file.close()
+        self.review_writer.flush()
         total_cost = grand_token_count * cost_per_100k_tokens / 100000
         print(f"Summaries are saved in file: {temp_filename}")
         print(f"Total properties: {property_counter}")
         print(f"Total tokens: {grand_token_count}")
         print(f"Cost of generating model: ${total_cost}")
+        print(metrics.summary())
 
 
 if __name__ == '__main__':
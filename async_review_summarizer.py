@@ -0,0 +1,253 @@
+"""
+Asynchronous summarization pipeline.
+Instead of summarizing one property at a time and sleeping for 10 seconds between calls, this keeps up to
+max_concurrent_requests calls to OpenAI in flight and paces them with a token bucket that follows the
+requests_per_minute and tokens_per_minute limits of the account. 429 and transient server errors are retried
+with exponential backoff, honouring the Retry-After header when OpenAI sends one.
+
+To measure the throughput without paying for it, start the fake endpoint and point the pipeline to it:
+    python fake_openai_server.py --port 8089 --latency 2.0 --rpm 600
+    python async_review_summarizer.py --benchmark 200 --base-url http://localhost:8089/v1
+"""
+import argparse
+import asyncio
+import datetime as dt
+import time
+from contextlib import closing
+import openai
+from openai import AsyncOpenAI
+import airbnb_review_summarizer as ars
+import metrics
+from airbnb_review_summarizer import AirBnbReviewSummarizer, prompt_settings
+from completion_cache import completion_cache_modes, completion_key
+from rate_limiter import RateLimiter, backoff_delay
+from token_budget import get_token_budget
+
+max_attempts = 6
+
+
+class AsyncAirBnbReviewSummarizer(AirBnbReviewSummarizer):
+    def __init__(self, concurrency=ars.max_concurrent_requests, requests_per_minute=ars.requests_per_minute,
+                 tokens_per_minute=ars.tokens_per_minute, base_url=None, api_key=None,
+                 cache_mode=ars.completion_cache_mode):
+        """
+        :param concurrency: The maximum number of requests in flight
+        :param requests_per_minute: The RPM limit to pace the requests with
+        :param tokens_per_minute: The TPM limit to pace the requests with
+        :param base_url: The OpenAI compatible endpoint, e.g. the fake server for benchmarks
+        :param api_key: The API key, defaults to the one of the synchronous client
+        :param cache_mode: The mode of the completion cache, 'record', 'replay' or 'off'
+        """
+        super().__init__(cache_mode=cache_mode)
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        # Retries are handled here so that they go through the rate limiter as well
+        self.async_client = AsyncOpenAI(api_key=api_key or ars.client.api_key,
+                                        base_url=base_url or ars.client.base_url,
+                                        max_retries=0)
+        self.retry_count = 0
+
+    async def create_completion(self, kind, chunk, token_count):
+        """
+        Sends one chat completion request once the rate limiter allows it, retrying on 429 and server errors.
+        Cached completions are answered at once, without going through the rate limiter.
+        :param kind: 'summary' or 'critical_review'
+        :param chunk: The cleaned up consolidated review
+        :param token_count: The number of tokens in the review, used to pay the token bucket
+        :return: The response of the OpenAI API
+        """
+        settings = prompt_settings[kind]
+        request = ars.completion_request(kind, chunk)
+        key = completion_key(request, self.async_client.base_url)
+        cached_response = self.completion_cache.get(key)
+        if cached_response is not None:
+            return cached_response
+
+        # OpenAI counts max_tokens against the TPM limit when the request is admitted
+        estimated_tokens = token_count + get_token_budget(prompt=settings['prompt']).prompt_tokens + request['max_tokens']
+
+        for attempt in range(max_attempts):
+            await self.rate_limiter.acquire(estimated_tokens)
+            started_at = time.monotonic()
+            try:
+                response = await self.async_client.chat.completions.create(**request)
+                metrics.observe_completion(request['model'], kind, response, time.monotonic() - started_at,
+                                           ars.cost_per_100k_tokens)
+                self.completion_cache.put(key, response)
+                return response
+            except Exception as err:
+                metrics.observe_completion_error(request['model'], kind, err)
+                if not isinstance(err, (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)):
+                    raise
+                if attempt == max_attempts - 1:
+                    raise
+                retry_after = None
+                response = getattr(err, 'response', None)
+                if response is not None and response.headers.get('retry-after') is not None:
+                    try:
+                        retry_after = float(response.headers.get('retry-after'))
+                    except ValueError:
+                        retry_after = None
+                delay = backoff_delay(attempt, retry_after=retry_after)
+                self.retry_count += 1
+                print(f"{type(err).__name__} on attempt {attempt + 1}. Retrying in {delay:.1f} seconds...")
+                if isinstance(err, openai.RateLimitError):
+                    # Everybody else would get a 429 as well, so pause all senders and not just this one
+                    self.rate_limiter.back_off(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+    async def summarize_chunks(self, items, kind, on_result):
+        """
+        Runs the completions for all items with at most self.concurrency requests in flight.
+        :param items: An iterable of (property_id, cleaned review, token count)
+        :param kind: 'summary' or 'critical_review'
+        :param on_result: Coroutine function called with (property_id, response) as each completion finishes
+        :return: The number of properties that failed
+        """
+        queue = asyncio.Queue(maxsize=2 * self.concurrency)
+        failures = 0
+
+        async def worker():
+            nonlocal failures
+            while True:
+                item = await queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                property_id, chunk, token_count = item
+                try:
+                    response = await self.create_completion(kind, chunk, token_count)
+                    await on_result(property_id, response)
+                except Exception as err:
+                    failures += 1
+                    print(f"Failed to summarize property Id {property_id}: {err}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        # Items may be streamed from the database, so they are pulled off the event loop
+        loop = asyncio.get_running_loop()
+        item_iterator = iter(items)
+        while True:
+            item = await loop.run_in_executor(None, next, item_iterator, None)
+            if item is None:
+                break
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        return failures
+
+    def prepare_reviews(self, property_reviews, kind, limit):
+        """
+        Cleans up the streamed reviews and crops them to the token budget, skipping the empty ones.
+        :return: A generator of (property_id, cleaned review, token count)
+        """
+        item_counter = 0
+        for property_id, token_worthy_review, token_count in self.token_worthy_review_stream(property_reviews, prompt=prompt_settings[kind]['prompt'], page_size=self.page_size_for(limit)):
+            if token_count > 0:
+                item_counter += 1
+                yield property_id, token_worthy_review, token_count
+            else:
+                print(f"Skipped property Id {property_id}. No tokens found.")
+                self.review_writer.add(property_id, kind, "")
+
+            if limit is not None and item_counter >= limit:
+                break
+
+    async def generate_from_basemodel_async(self, kind, limit=10):
+        """
+        Asynchronous counterpart of generate_property_summary_from_basemodel and
+        generate_property_critical_reviews_from_basemodel.
+        """
+        basename = "/tmp/summary_of_reviews"
+        suffix = dt.datetime.now().strftime("%y%m%d_%H%M%S")
+        temp_filename = "_".join([basename, suffix]) + '.csv'  # e.g. '/tmp/summary_of_reviews_120508_171442.csv'
+
+        if kind == 'summary':
+            property_reviews = self.stream_property_reviews()
+        else:
+            property_reviews = self.stream_reviews_for_summarized_properties()
+
+        file = open(temp_filename, "w")
+        file.write(f"property_id\tsummary\tprompt_tokens\tcompletion_tokens\ttotal_tokens\tfinish_reason\n")
+        grand_token_count = 0
+        property_counter = 0
+
+        async def on_result(property_id, response):
+            nonlocal grand_token_count, property_counter
+            the_text = response.choices[0].message.content
+            usage = response.usage
+            file.write(f"{property_id}\t{the_text}\t{usage.prompt_tokens}\t{usage.completion_tokens}\t{usage.total_tokens}\t{response.choices[0].finish_reason}\n")
+            # Written in bulk by the background thread of the writer, so the event loop never waits for the database
+            self.review_writer.add(property_id, kind, the_text)
+            grand_token_count += usage.total_tokens
+            property_counter += 1
+
+        start_time = time.monotonic()
+        with closing(property_reviews):
+            failures = await self.summarize_chunks(self.prepare_reviews(property_reviews, kind, limit), kind, on_result)
+        elapsed = time.monotonic() - start_time
+
+        file.close()
+        self.review_writer.flush()
+        total_cost = grand_token_count * ars.cost_per_100k_tokens / 100000
+        print(f"Summaries are saved in file: {temp_filename}")
+        print(f"Total properties: {property_counter} ({failures} failed, {self.retry_count} retries)")
+        print(f"Throughput: {60.0 * property_counter / max(elapsed, 1e-9):.1f} properties per minute")
+        print(self.completion_cache.report())
+        print(f"Total tokens: {grand_token_count}")
+        print(f"Cost of generating model: ${total_cost}")
+        print(metrics.summary())
+
+    def generate_property_summary_async(self, limit=10):
+        asyncio.run(self.generate_from_basemodel_async('summary', limit))
+
+    def generate_property_critical_reviews_async(self, limit=10):
+        asyncio.run(self.generate_from_basemodel_async('critical_review', limit))
+
+    async def benchmark(self, property_count, review_words=600):
+        """
+        Measures the throughput of the pipeline on synthetic reviews, without touching the database.
+        """
+        review = ' '.join(['The cabin was clean and quiet with a great view of the desert.'] * (review_words // 12))
+        token_count = self.num_tokens_from_string(review, "cl100k_base")
+        items = [(property_id, review, token_count) for property_id in range(property_count)]
+        completed = 0
+
+        async def on_result(property_id, response):
+            nonlocal completed
+            completed += 1
+
+        start_time = time.monotonic()
+        failures = await self.summarize_chunks(items, 'summary', on_result)
+        elapsed = time.monotonic() - start_time
+        print(f"Completed {completed} of {property_count} in {elapsed:.2f} seconds "
+              f"({failures} failed, {self.retry_count} retries)")
+        print(f"Throughput: {60.0 * completed / max(elapsed, 1e-9):.1f} properties per minute "
+              f"with {self.concurrency} requests in flight")
+        print(self.completion_cache.report())
+        print(metrics.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize reviews with several OpenAI requests in flight.')
+    parser.add_argument('--mode', choices=['summary', 'critical_review'], default='summary')
+    parser.add_argument('--limit', type=int, default=10, help='The number of properties, 0 for all of them')
+    parser.add_argument('--concurrency', type=int, default=ars.max_concurrent_requests)
+    parser.add_argument('--rpm', type=int, default=ars.requests_per_minute)
+    parser.add_argument('--tpm', type=int, default=ars.tokens_per_minute)
+    parser.add_argument('--base-url', default=None, help='OpenAI compatible endpoint, e.g. the fake server')
+    parser.add_argument('--cache-mode', choices=completion_cache_modes, default=ars.completion_cache_mode,
+                        help='replay runs offline from the completion cache')
+    parser.add_argument('--benchmark', type=int, default=0, help='Number of synthetic properties to benchmark with')
+    args = parser.parse_args()
+
+    generator = AsyncAirBnbReviewSummarizer(concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                            tokens_per_minute=args.tpm, base_url=args.base_url,
+                                            cache_mode=args.cache_mode)
+    if args.benchmark > 0:
+        asyncio.run(generator.benchmark(args.benchmark))
+    else:
+        asyncio.run(generator.generate_from_basemodel_async(args.mode, args.limit or None))
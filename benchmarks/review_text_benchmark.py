@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+'''
+Compares the normalization of review_text with the inline cleanup it replaced, on synthetic consolidated reviews
+that mix plain English with accented letters, emoji and control characters like the real ones do.
+Both versions must give the same text, the check is printed next to each timing.
+
+    python benchmarks/review_text_benchmark.py --reviews 2000 --processes 4
+'''
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import review_text as rt
+
+words = ['The', 'cabin', 'was', 'clean', 'and', 'quiet', 'with', 'a', 'great', 'view', 'of', 'the', 'desert.',
+         'Host', 'replied', 'fast!', '"Amazing"', 'stay', 'café', 'naïve', 'über', '\U0001F600', '—', '\x07',
+         '\\"cozy\\"', '\n', '\t']
+
+
+def time_it(function, *args):
+    started_at = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started_at
+
+
+def consolidated_reviews(count, reviews_per_property=30, seed=0):
+    rng = random.Random(seed)
+    return ['["' + '|||'.join(' '.join(rng.choice(words) for _ in range(rng.randint(20, 200)))
+                              for _ in range(reviews_per_property)) + '"]'
+            for _ in range(count)]
+
+
+def inline_clean(text):
+    return text.replace('\n', ' ').replace('\t', ' ').replace('["','').replace('"]','').replace('\\"', '"')
+
+
+def inline_printable(text):
+    return ''.join(filter(lambda x: x in string.printable, text))
+
+
+def report(name, characters, before_seconds, after_seconds, same):
+    print(f"{name:<12}inline {characters / before_seconds / 1e6:8.1f} M chars/s   "
+          f"review_text {characters / after_seconds / 1e6:8.1f} M chars/s   "
+          f"speedup {before_seconds / after_seconds:6.1f}x   same output {same}")
+
+
+def run(count, processes):
+    texts = consolidated_reviews(count)
+    characters = sum(len(text) for text in texts)
+    print(f"{count} consolidated reviews, {characters / count:.0f} characters on average")
+
+    before, before_seconds = time_it(lambda: [inline_clean(text) for text in texts])
+    after, after_seconds = time_it(rt.map_reviews, rt.clean_review, texts, 1)
+    report('clean', characters, before_seconds, after_seconds, before == after)
+
+    cleaned = after
+    before, before_seconds = time_it(lambda: [inline_printable(text) for text in cleaned])
+    after, after_seconds = time_it(rt.map_reviews, rt.printable, cleaned, 1)
+    report('printable', characters, before_seconds, after_seconds, before == after)
+
+    if processes > 1:
+        rt.map_reviews(rt.printable, cleaned[:rt.min_parallel_reviews], processes)  # Starts the workers
+        parallel, parallel_seconds = time_it(rt.map_reviews, rt.printable, cleaned, processes)
+        report(f"printable/{processes}", characters, before_seconds, parallel_seconds, before == parallel)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the review text normalization.')
+    parser.add_argument('--reviews', type=int, default=2000, help='Consolidated reviews of 30 reviews each')
+    parser.add_argument('--processes', type=int, default=1, help='Also time map_reviews with these many processes')
+    args = parser.parse_args()
+    run(args.reviews, args.processes)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks the hot paths of the project on synthetic data, without a database or an OpenAI account:
+    - the review text normalization and format_review, alone and a page at a time
+    - the CSV and JSONL exports
+    - the review summary, seek and property list endpoints, through the Flask test client, cold and cached, and the
+      whole property list streamed in one page
+    - the speed_distance functions, scalar and on arrays
+The database is replaced by benchmarks/synthetic_data.SyntheticPostgres. Every case runs once to warm up and then
+--repeat times; the results are written as JSON so that two commits can be compared:
+
+    python benchmarks/run_benchmarks.py --properties 10000 --output /tmp/before.json
+    python benchmarks/run_benchmarks.py --properties 10000 --output /tmp/after.json --compare /tmp/before.json
+
+A case whose median time grew by more than --threshold over the baseline is reported as a regression and the exit
+status is 1. format_review needs the cl100k_base encoding of tiktoken, which is downloaded on first use.
+'''
+import argparse
+import contextlib
+import datetime as dt
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_data import SyntheticDataset, SyntheticPostgres
+
+default_threshold = 0.10  # Relative growth of the median time reported as a regression
+
+
+def measure(function, repeat):
+    """
+    Runs function once to warm up and then repeat times.
+    :return: The durations in seconds
+    """
+    durations = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        function()
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - started_at)
+    return durations
+
+
+def summarize_durations(durations, operations):
+    median = statistics.median(durations)
+    return {
+        'operations': operations,
+        'repeat': len(durations),
+        'min_seconds': min(durations),
+        'median_seconds': median,
+        'mean_seconds': statistics.fmean(durations),
+        'operations_per_second': operations / median if median > 0 else None
+    }
+
+
+def text_cases(dataset, sample):
+    import review_text as rt
+    from airbnb_review_summarizer import AirBnbReviewSummarizer
+
+    summarizer = AirBnbReviewSummarizer(cache_mode='off')
+    summarizer.postgres_helper = SyntheticPostgres(dataset)
+    raw_reviews = [dataset.consolidated_review(property_id) for property_id in dataset.property_ids[:sample]]
+    cleaned_reviews = [rt.clean_review(review) for review in raw_reviews]
+
+    def export(method):
+        filename = method(limit=sample)
+        if filename is not None and os.path.exists(filename):
+            os.remove(filename)
+
+    return {
+        'clean_review': (lambda: [rt.clean_review(review) for review in raw_reviews], sample),
+        'printable': (lambda: [rt.printable(review) for review in cleaned_reviews], sample),
+        'format_review': (lambda: [summarizer.format_review(review) for review in cleaned_reviews], sample),
+        'format_reviews_page': (lambda: summarizer.format_reviews(cleaned_reviews), sample),
+        'export_csv': (lambda: export(summarizer.generate_clean_csv), sample),
+        'export_jsonl': (lambda: export(summarizer.generate_openai_jsonl), sample)
+    }
+
+
+def endpoint_cases(dataset, sample):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import server
+    synthetic_postgres = SyntheticPostgres(dataset)
+    server.postgres = synthetic_postgres
+    server.review_summarizer.postgres_helper = synthetic_postgres
+    server.property_search.postgres_helper = synthetic_postgres
+    server.property_read_model.postgres_helper = synthetic_postgres
+    server.property_read_model.refresh_interval = None
+    server.property_search.refresh_interval = None
+    client = server.app.test_client()
+    property_ids = [int(property_id) for property_id in dataset.property_ids[:sample]]
+    terms = ['Des', 'Oasis Cabin', str(property_ids[0])[:4], 'Hot Tub Views', 'o', 'Starry Sky Retreat #1']
+    list_limit = min(len(dataset), server.list_stream_min_rows)
+
+    def get(url, headers=None):
+        response = client.get(url, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} answered {response.status_code}")
+        return response
+
+    def review_summaries(cold):
+        for property_id in property_ids:
+            if cold:
+                server.query_cache.invalidate('review_summary', property_id)
+            get(f"/v1/api/reviews/summary/{property_id}")
+
+    def property_list(cold, layout):
+        if cold:
+            server.query_cache.invalidate('property_list')
+        get(f"/v1/api/property/list/all?limit={list_limit}&format={layout}", headers={'Accept-Encoding': 'gzip'})
+
+    def property_list_pages(limit):
+        after = None
+        while True:
+            url = f"/v1/api/property/list/all?limit={limit}" + (f"&after={after}" if after is not None else '')
+            after = json.loads(get(url, headers={'Accept-Encoding': 'identity'}).data)['next_cursor']
+            if after is None:
+                break
+
+    return {
+        'endpoint_review_summary': (lambda: review_summaries(True), sample),
+        'endpoint_review_summary_cached': (lambda: review_summaries(False), sample),
+        'endpoint_seek': (lambda: [get(f"/v1/api/property/seek?term={term}") for term in terms], len(terms)),
+        'endpoint_property_list': (lambda: property_list(True, 'rows'), 1),
+        'endpoint_property_list_columnar': (lambda: property_list(True, 'columnar'), 1),
+        'endpoint_property_list_cached': (lambda: property_list(False, 'rows'), 1),
+        'endpoint_property_list_streamed': (lambda: property_list_pages(max(len(dataset), server.list_stream_min_rows + 1)), 1)
+    }
+
+
+def speed_distance_cases(dataset, sample):
+    import numpy as np
+    import pandas as pd
+    import speed_distance as sd
+
+    count = len(dataset)
+    latitudes, longitudes = dataset.latitudes, dataset.longitudes
+    next_latitudes, next_longitudes = np.roll(latitudes, 1), np.roll(longitudes, 1)
+    times = pd.Series(pd.Timestamp('2024-01-01') + pd.to_timedelta(np.arange(count) * 60, unit='s'))
+    next_times = times + pd.Timedelta(seconds=30)
+    rows = list(zip(latitudes[:sample].tolist(), longitudes[:sample].tolist(),
+                    next_latitudes[:sample].tolist(), next_longitudes[:sample].tolist()))
+
+    return {
+        'distance_great_circle': (lambda: [sd.distance_great_circle(*row) for row in rows], sample),
+        'distance_great_circle_array': (lambda: sd.distance_great_circle_array(latitudes, longitudes,
+                                                                               next_latitudes, next_longitudes), count),
+        'calculate_speed': (lambda: sd.calculate_speed(latitudes, longitudes, next_latitudes, next_longitudes,
+                                                       times, next_times), count),
+        'bounding_box_array': (lambda: sd.bounding_box_array(latitudes, longitudes), count)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (RuntimeError, Exception):
+        return None
+
+
+def run(properties, seed, sample, repeat, only=None):
+    dataset = SyntheticDataset(properties, seed)
+    sample = min(sample, properties)
+    results = {}
+    for make_cases in [text_cases, endpoint_cases, speed_distance_cases]:
+        for name, (function, operations) in make_cases(dataset, sample).items():
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+            results[name] = summarize_durations(measure(function, repeat), operations)
+            result = results[name]
+            print(f"{name:<34}{result['median_seconds'] * 1000:10.2f} ms   "
+                  f"{result['operations_per_second'] or 0:12.1f} ops/s")
+    return {
+        'metadata': {
+            'commit': git_commit(),
+            'created_at': dt.datetime.now(dt.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'properties': properties,
+            'seed': seed,
+            'sample': sample,
+            'repeat': repeat
+        },
+        'results': results
+    }
+
+
+def compare(report, baseline, threshold=default_threshold):
+    """
+    Prints the change of the median time of every case found in both reports.
+    :return: The names of the cases that regressed by more than threshold
+    """
+    regressions = []
+    print(f"Compared with {baseline['metadata'].get('commit')}")
+    for name, result in report['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        ratio = result['median_seconds'] / before['median_seconds'] if before['median_seconds'] > 0 else 1.0
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print(f"{name:<34}{before['median_seconds'] * 1000:10.2f} ms -> {result['median_seconds'] * 1000:10.2f} ms"
+              f"   x{ratio:6.2f} {flag}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic data.')
+    parser.add_argument('--properties', type=int, default=1000, help='Size of the synthetic dataset, 1k to 1M')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sample', type=int, default=200, help='Properties per case of the per-property cases')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', default=None, help='Comma separated prefixes of the cases to run')
+    parser.add_argument('--output', default=None, help='The JSON file of the results')
+    parser.add_argument('--compare', default=None, help='A JSON file of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=default_threshold)
+    args = parser.parse_args()
+
+    report = run(args.properties, args.seed, args.sample, args.repeat, args.only.split(',') if args.only else None)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results are saved in file: {args.output}")
+    if args.compare is not None:
+        with open(args.compare) as file:
+            if len(compare(report, json.load(file), args.threshold)) > 0:
+                sys.exit(1)
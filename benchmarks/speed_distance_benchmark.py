@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+'''
+Compares the scalar functions of speed_distance with their NumPy array versions.
+The scalar functions are timed on --scalar-points rows and extrapolated to --points, since running them on a million
+rows takes minutes. The largest difference between the two versions is printed next to each timing.
+
+    python benchmarks/speed_distance_benchmark.py --points 1000000
+'''
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import speed_distance as sd
+
+
+def time_it(function, *args):
+    started_at = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started_at
+
+
+def random_points(points, seed=0):
+    rng = np.random.default_rng(seed)
+    lat1 = rng.uniform(-80, 80, points)
+    long1 = rng.uniform(-179, 179, points)
+    # Short hops, like consecutive positions of a device
+    lat2 = np.clip(lat1 + rng.normal(0, 0.05, points), -90, 90)
+    long2 = np.clip(long1 + rng.normal(0, 0.05, points), -180, 180)
+    time1 = pd.Series(pd.Timestamp('2023-01-01') + pd.to_timedelta(np.arange(points), unit='s'))
+    time2 = time1 + pd.to_timedelta(rng.integers(0, 600, points), unit='s')
+    return lat1, long1, lat2, long2, time1, time2
+
+
+def report(name, points, scalar_points, scalar_seconds, array_seconds, max_difference):
+    scalar_estimate = scalar_seconds * points / scalar_points
+    print(f"{name:<16}scalar {scalar_estimate:10.3f} s   array {array_seconds:8.3f} s   "
+          f"speedup {scalar_estimate / array_seconds:8.1f}x   max difference {max_difference:.3g}")
+
+
+def run(points, scalar_points):
+    lat1, long1, lat2, long2, time1, time2 = random_points(points)
+    sample = slice(0, scalar_points)
+    print(f"{points} points, scalar functions timed on {scalar_points} and extrapolated")
+
+    scalar, scalar_seconds = time_it(lambda: [sd.distance_great_circle(*row) for row in
+                                              zip(lat1[sample], long1[sample], lat2[sample], long2[sample])])
+    array, array_seconds = time_it(sd.distance_great_circle_array, lat1, long1, lat2, long2)
+    report('distance', points, scalar_points, scalar_seconds, array_seconds,
+           np.max(np.abs(array[sample] - np.array(scalar))))
+
+    scalar, scalar_seconds = time_it(lambda: [sd.device_speed(*row) for row in
+                                              zip(lat1[sample], long1[sample], lat2[sample], long2[sample],
+                                                  time1[sample], time2[sample])])
+    array, array_seconds = time_it(sd.calculate_speed, lat1, long1, lat2, long2, time1, time2)
+    report('speed', points, scalar_points, scalar_seconds, array_seconds,
+           np.max(np.abs(array.to_numpy()[sample] - np.array(scalar))))
+
+    scalar, scalar_seconds = time_it(lambda: [sd.forward_bearing(*row)[0] for row in
+                                              zip(lat1[sample], long1[sample], lat2[sample], long2[sample])])
+    array, array_seconds = time_it(lambda: sd.forward_bearing_array(lat1, long1, lat2, long2)[0])
+    report('bearing', points, scalar_points, scalar_seconds, array_seconds,
+           np.max(np.abs(array[sample] - np.array(scalar))))
+
+    rows = [{'value': (lat, lon)} for lat, lon in zip(lat1[sample].tolist(), long1[sample].tolist())]
+    scalar, scalar_seconds = time_it(sd.calculate_bounding_box, rows)
+    array, array_seconds = time_it(sd.bounding_box_array, lat1, long1)
+    sample_box = sd.bounding_box_array(lat1[sample], long1[sample])
+    report('bounding box', points, scalar_points, scalar_seconds, array_seconds,
+           np.max(np.abs(np.array(sample_box) - np.array(scalar))))
+
+    radius_km = 5.0
+    scalar, scalar_seconds = time_it(lambda: [sd.circle_to_wkt(lat, lon, radius_km) for lat, lon in
+                                              zip(lat1[sample], long1[sample])])
+    array, array_seconds = time_it(sd.circle_polygons, lat1, long1, radius_km)
+    first_ring = np.array([[float(value) for value in vertex.split()] for vertex in scalar[0][10:-2].split(', ')])
+    report('circle polygon', points, scalar_points, scalar_seconds, array_seconds,
+           max(np.max(np.abs(first_ring[:, 1] - array[0][0])), np.max(np.abs(first_ring[:, 0] - array[1][0]))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the array versions of speed_distance.')
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--scalar-points', type=int, default=50000, help='Rows timed with the scalar functions')
+    args = parser.parse_args()
+    run(args.points, min(args.scalar_points, args.points))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+'''
+Synthetic JOSHUAPROPERTIES and JoshuaConsolidatedRawReviews data for the benchmarks, at any scale.
+The same seed always gives the same data. A consolidated review is generated from the seed and its property id when
+it is asked for, so a million properties do not hold gigabytes of reviews in memory.
+The reviews per property and the words per review follow long-tailed distributions: most properties have a few dozen
+short reviews and some have hundreds, with the quoting, line breaks, accents and emoji of the real exports.
+
+SyntheticPostgres answers the queries of the summarizer and of the server from a dataset, in place of PostgresHelper.
+The dataset can also be written as CSV files to load a real database with COPY:
+
+    python benchmarks/synthetic_data.py --properties 100000 --output /tmp/synthetic
+'''
+import argparse
+import csv
+import os
+import random
+import numpy as np
+
+first_property_id = 10000000
+property_types = ['Entire home', 'Entire cabin', 'Private room', 'Tiny home', 'Entire guesthouse', 'Camper/RV',
+                  'Entire condo', 'Yurt', 'Dome', 'Farm stay']
+cities = [('Joshua Tree', 'California', 34.13, -116.31), ('Twentynine Palms', 'California', 34.14, -116.05),
+          ('Yucca Valley', 'California', 34.11, -116.43), ('Palm Springs', 'California', 33.83, -116.55),
+          ('Landers', 'California', 34.26, -116.40), ('Pioneertown', 'California', 34.16, -116.50),
+          ('Sedona', 'Arizona', 34.87, -111.76), ('Moab', 'Utah', 38.57, -109.55),
+          ('Big Bear Lake', 'California', 34.24, -116.91), ('Borrego Springs', 'California', 33.26, -116.37)]
+title_words = ['Desert', 'Oasis', 'Modern', 'Cozy', 'Retreat', 'Hideaway', 'Cabin', 'Casita', 'Starry', 'Sky',
+               'Joshua', 'Tree', 'Ranch', 'Hot Tub', 'Views', 'Boulder', 'Sunset', 'Haven', 'Dome', 'Escape']
+review_words = ['the', 'the', 'a', 'and', 'and', 'was', 'was', 'with', 'to', 'of', 'we', 'our', 'stay', 'place',
+                'house', 'cabin', 'host', 'clean', 'quiet', 'beautiful', 'amazing', 'great', 'view', 'views', 'desert',
+                'stars', 'hot', 'tub', 'kitchen', 'bed', 'comfortable', 'check-in', 'easy', 'responsive', 'again!',
+                'would', 'recommend', 'park', 'minutes', 'from', 'town.', 'Loved', 'it.', 'Perfect', 'getaway.',
+                'dirt', 'road', 'noisy', 'wind', 'cold', 'at', 'night.', 'café', 'piñata', 'über', '\U0001F31F',
+                '\\"magical\\"', '\n']
+
+
+class SyntheticDataset(object):
+    def __init__(self, properties=1000, seed=0, mean_reviews=40, mean_review_words=60):
+        """
+        :param properties: The number of properties, each one with a consolidated review
+        :param seed: The seed of every random choice
+        :param mean_reviews: The mean number of reviews per property
+        :param mean_review_words: The mean number of words per review
+        """
+        self.seed = seed
+        self.mean_reviews = mean_reviews
+        self.mean_review_words = mean_review_words
+        rng = np.random.default_rng(seed)
+        city_index = rng.integers(0, len(cities), properties)
+        self.latitudes = np.array([cities[i][2] for i in city_index]) + rng.normal(0, 0.08, properties)
+        self.longitudes = np.array([cities[i][3] for i in city_index]) + rng.normal(0, 0.08, properties)
+        self.property_ids = first_property_id + np.arange(properties) * 7
+        self.positions = {int(property_id): position for position, property_id in enumerate(self.property_ids)}
+        self.city_index = city_index
+        self.bedrooms = rng.integers(0, 6, properties)
+        self.bathrooms = rng.integers(1, 4, properties)
+        self.type_index = rng.integers(0, len(property_types), properties)
+        self.title_index = rng.integers(0, len(title_words), (properties, 4))
+
+    def __len__(self):
+        return len(self.property_ids)
+
+    def property_row(self, position):
+        """
+        Returns a property with the columns of the property list query: id, title, bedrooms, bathrooms, property type,
+        zipcode, city, city id, state, latitude and longitude.
+        """
+        city, state, _, _ = cities[self.city_index[position]]
+        title = ' '.join(title_words[i] for i in self.title_index[position])
+        return (str(self.property_ids[position]), f"{title} #{position}", int(self.bedrooms[position]),
+                int(self.bathrooms[position]), property_types[self.type_index[position]],
+                f"9{self.city_index[position]:04d}", city, int(self.city_index[position]) + 1, state,
+                float(self.latitudes[position]), float(self.longitudes[position]))
+
+    def property_rows(self, limit=None, after=None):
+        """
+        Returns the properties by id, at most limit of them and only the ones after the property id after.
+        """
+        start = 0 if after is None else int(np.searchsorted(self.property_ids, after, side='right'))
+        end = len(self) if limit is None else min(start + limit, len(self))
+        return [self.property_row(position) for position in range(start, end)]
+
+    def consolidated_review(self, property_id):
+        """
+        Returns the consolidated review of a property, the most recent review first, quoted like the exports.
+        """
+        rng = random.Random(self.seed * 1000003 + int(property_id))
+        review_count = max(1, int(rng.lognormvariate(np.log(self.mean_reviews) - 0.5, 1.0)))
+        reviews = []
+        for _ in range(review_count):
+            word_count = max(3, int(rng.lognormvariate(np.log(self.mean_review_words) - 0.32, 0.8)))
+            reviews.append(' '.join(rng.choices(review_words, k=word_count)))
+        return '["' + '|||'.join(reviews) + '"]'
+
+    def summary(self, property_id):
+        return f"Summary of property {property_id}: a quiet desert retreat with great views and a responsive host."
+
+    def critical_review(self, property_id):
+        return (f"Property Highlights:\n - Views and privacy of property {property_id}.\nAreas for Improvement:\n"
+                f" - The dirt road.\nOverall Guest Satisfaction:\n - High.")
+
+    def write_csv(self, directory):
+        """
+        Writes joshua_properties.csv and joshua_consolidated_raw_reviews.csv, with a header line, for COPY.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'joshua_properties.csv'), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['AIRBNB_PROPERTY_ID', 'TITLE', 'BEDROOMS', 'BATHROOMS', 'PROPERTY_TYPE', 'ZIPCODE',
+                             'CITY_NAME', 'CITY_ID', 'STATE_NAME', 'LATITUDE', 'LONGITUDE'])
+            for position in range(len(self)):
+                writer.writerow(self.property_row(position))
+        with open(os.path.join(directory, 'joshua_consolidated_raw_reviews.csv'), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['PROPERTY_ID', 'CONSOLIDATED_REVIEW'])
+            for property_id in self.property_ids:
+                writer.writerow([int(property_id), self.consolidated_review(property_id)])
+
+
+class SyntheticCursor(object):
+    """
+    A lazy stream of rows, closed like the cursors of PostgresHelper.stream.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class SyntheticPostgres(object):
+    """
+    Answers the queries of the summarizer and of the server from a SyntheticDataset, every property summarized.
+    Queries are told apart by the method of PostgresHelper and the name they are run with, never by their SQL; the
+    ones it does not model get no rows. Writes are counted and dropped.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.writes = 0
+        self.queries = {
+            'read_model_triggers': lambda params: [(len(params[0]),)],  # The change capture is always installed
+            'read_model_sync': lambda params: [(0, 0, 0)],  # The read model is always up to date
+            'read_model_version': lambda params: [(None, len(self.dataset))],
+            'property_list_page': self.property_list_page,
+            'property_map_properties': lambda params: self.dataset.property_rows(),
+            'property_search_titles': lambda params: [row[:2] for row in self.dataset.property_rows()],
+            'property_neighbor_locations': lambda params: [row[:5] + (row[6], row[8]) + row[9:]
+                                                           for row in self.dataset.property_rows()],
+            'property_reviews': self.property_reviews,
+            'reviews_for_summarized_properties': self.property_reviews,
+        }
+        self.streams = {
+            'property_list_page': self.property_list_page,
+            'property_reviews': self.property_reviews,
+            'reviews_for_summarized_properties': self.property_reviews,
+        }
+
+    def review_row(self, property_id):
+        property_id = int(property_id)
+        if property_id not in self.dataset.positions:
+            return []
+        return [(property_id, self.dataset.consolidated_review(property_id), self.dataset.summary(property_id),
+                 self.dataset.critical_review(property_id))]
+
+    def property_list_page(self, params):
+        """
+        :param params: The (limit + 1,) or (after, limit + 1) of server.property_list_page_query
+        """
+        after = params[0] if len(params) == 2 else None
+        return self.dataset.property_rows(params[-1], after)
+
+    def property_reviews(self, params):
+        """
+        :param params: The (limit,) of a query, None for a stream of all the properties
+        """
+        property_ids = self.dataset.property_ids if params is None else self.dataset.property_ids[:params[0]]
+        return ((int(property_id), self.dataset.consolidated_review(property_id)) for property_id in property_ids)
+
+    def query(self, query_string, params=None, name=''):
+        if name not in self.queries:
+            return []
+        return list(self.queries[name](params))
+
+    def query_prepared(self, name, statement, params):
+        rows = self.review_row(params[0])
+        if name == 'consolidated_review_by_property_id':
+            return [(row[1],) for row in rows]
+        if name == 'summary_by_property_id':
+            return [(row[0], row[2]) for row in rows]
+        return rows
+
+    def stream(self, query_string, params=None, itersize=2000, name=''):
+        if name not in self.streams:
+            return SyntheticCursor([])
+        return SyntheticCursor(self.streams[name](params))
+
+    def execute(self, query_string, params=None):
+        self.writes += 1
+
+    def execute_values(self, query_string, rows, template=None, page_size=1000):
+        self.writes += len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic dataset as CSV files.')
+    parser.add_argument('--properties', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', required=True, help='The directory of the CSV files')
+    args = parser.parse_args()
+    SyntheticDataset(args.properties, args.seed).write_csv(args.output)
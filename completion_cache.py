@@ -0,0 +1,176 @@
+"""
+Content-addressed cache of the chat completions.
+A rerun of the summarizer sends the same reviews with the same prompt to the same model, and paid for the same
+completions again. Every request is named by the SHA-256 of its model, messages, sampling parameters and endpoint, and
+its response (the body and its usage) is stored in a SQLite file under that name. The next identical request is
+answered from the file, without an API call and without going through the rate limiter.
+The file is kept under max_bytes by evicting the least recently used responses. The use times of the hits are kept in
+memory and written touch_batch_size at a time, and before an eviction, rather than with one UPDATE per hit; at worst the
+last of them are lost on exit and those responses look older than they are.
+
+Modes:
+    - 'record' answers from the cache and stores the responses of the requests it did not have
+    - 'replay' only answers from the cache and raises CompletionCacheMiss otherwise, so that the pipeline and its
+      benchmarks run offline with zero API calls
+    - 'off' neither reads nor writes the cache
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from openai.types.chat import ChatCompletion
+import metrics
+
+completion_cache_file = 'completion_cache.sqlite3'
+completion_cache_max_bytes = 512 * 1024 * 1024
+completion_cache_eviction_ratio = 0.9  # An eviction frees the cache down to this share of max_bytes
+touch_batch_size = 100  # The use times of the hits written at once
+completion_cache_modes = ['record', 'replay', 'off']
+completion_cache_mode = 'record'
+
+
+class CompletionCacheMiss(Exception):
+    """
+    Raised in replay mode by a request whose response was never recorded.
+    """
+
+
+def completion_key(request, base_url=None):
+    """
+    Names a request after everything that decides its response.
+    :param request: The keyword arguments of chat.completions.create
+    :param base_url: The endpoint, so that the responses of the fake server never answer the real one
+    """
+    key = json.dumps({'base_url': str(base_url or ''), 'request': request}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class CompletionCache(object):
+    def __init__(self, filename=completion_cache_file, max_bytes=completion_cache_max_bytes, mode=completion_cache_mode):
+        """
+        :param filename: The SQLite file of the cache, created on first use
+        :param max_bytes: The size of the stored responses above which the least recently used ones are evicted
+        :param mode: 'record', 'replay' or 'off'
+        """
+        if mode not in completion_cache_modes:
+            raise ValueError(f"Unknown completion cache mode {mode}, expected one of {completion_cache_modes}")
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.connection = None
+        self.lock = threading.Lock()  # One connection is shared by the threads and the event loop
+        self.total_bytes = 0
+        self.touched = {}  # The use times of the hits not yet written, by key
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def connect(self):
+        """
+        Opens the cache file on first use. Must be called with the lock held.
+        """
+        if self.connection is None:
+            connection = sqlite3.connect(self.filename, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute("""
+            CREATE TABLE IF NOT EXISTS completions (
+                KEY text PRIMARY KEY,
+                MODEL text NOT NULL,
+                BODY text NOT NULL,
+                TOTAL_TOKENS integer NOT NULL,
+                SIZE integer NOT NULL,
+                CREATED_AT real NOT NULL,
+                LAST_USED_AT real NOT NULL
+            )
+            """)
+            connection.execute('CREATE INDEX IF NOT EXISTS completions_last_used_at ON completions (LAST_USED_AT)')
+            self.total_bytes = connection.execute('SELECT COALESCE(SUM(SIZE), 0) FROM completions').fetchone()[0]
+            self.connection = connection
+        return self.connection
+
+    def get(self, key):
+        """
+        :return: The stored response of a request, None when there is none
+        """
+        if self.mode == 'off':
+            return None
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute('SELECT BODY, TOTAL_TOKENS FROM completions WHERE KEY = ?', (key,)).fetchone()
+            if row is not None:
+                self.touched[key] = time.time()
+                if len(self.touched) >= touch_batch_size:
+                    self.write_touches(connection)
+                self.hits += 1
+                self.saved_tokens += row[1]
+            else:
+                self.misses += 1
+        metrics.completion_cache_requests.labels('miss' if row is None else 'hit').inc()
+        if row is None:
+            if self.mode == 'replay':
+                raise CompletionCacheMiss(f"No recorded completion for request {key}")
+            return None
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, key, response):
+        """
+        Stores the response of a request, evicting the least recently used responses once over max_bytes.
+        """
+        if self.mode != 'record':
+            return
+        body = response.model_dump_json()
+        size = len(body.encode('utf-8'))
+        total_tokens = response.usage.total_tokens if response.usage is not None else 0
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            previous = connection.execute('SELECT SIZE FROM completions WHERE KEY = ?', (key,)).fetchone()
+            self.touched.pop(key, None)
+            connection.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, response.model, body, total_tokens, size, now, now))
+            self.total_bytes += size - (previous[0] if previous is not None else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict(connection)
+
+    def write_touches(self, connection):
+        """
+        Writes the use times of the hits in one statement. Must be called with the lock held.
+        """
+        if len(self.touched) > 0:
+            connection.executemany('UPDATE completions SET LAST_USED_AT = ? WHERE KEY = ?',
+                                   [(used_at, key) for key, used_at in self.touched.items()])
+            self.touched = {}
+
+    def evict(self, connection):
+        """
+        Deletes the least recently used responses until the cache is back to its eviction ratio. Must be called with
+        the lock held.
+        """
+        self.write_touches(connection)
+        target = self.max_bytes * completion_cache_eviction_ratio
+        evicted = []
+        for key, size in connection.execute('SELECT KEY, SIZE FROM completions ORDER BY LAST_USED_AT').fetchall():
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        connection.executemany('DELETE FROM completions WHERE KEY = ?', evicted)
+        print(f"Evicted {len(evicted)} completions from the cache, {self.total_bytes} bytes left")
+
+    def complete(self, request, create, base_url=None):
+        """
+        Answers a request from the cache, or with create() whose response is then stored.
+        :param request: The keyword arguments of chat.completions.create
+        :param create: Function sending the request to the API
+        """
+        key = completion_key(request, base_url)
+        response = self.get(key)
+        if response is None:
+            response = create()
+            self.put(key, response)
+        return response
+
+    def report(self):
+        return f"Completion cache: {self.hits} hits, {self.misses} misses, {self.saved_tokens} tokens saved"
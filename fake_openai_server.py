@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+'''
+A local stand-in for the OpenAI chat completions endpoint, used to measure the throughput of the summarization
+pipelines without paying for it. Every completion takes --latency seconds and requests beyond --rpm in a sliding
+minute are answered with a 429 and a Retry-After header, like the real API. Streamed requests get the text word by
+word over the same latency. Requests with a json_schema response format get an object of the fake text for each of
+its properties.
+'''
+from flask import Flask, Response, jsonify, request
+import argparse
+import json
+import threading
+import time
+import collections
+
+app = Flask(__name__)
+settings = {'latency': 1.0, 'rpm': 600}
+request_times = collections.deque()
+request_times_lock = threading.Lock()
+fake_summary = 'This remote and beautiful spot for camping offers privacy, open space and great views. ' \
+               'Overall, guests loved their stay.'
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    now = time.monotonic()
+    with request_times_lock:
+        while len(request_times) > 0 and request_times[0] < now - 60:
+            request_times.popleft()
+        if len(request_times) >= settings['rpm']:
+            retry_after = max(0.1, request_times[0] + 60 - now)
+            response = jsonify({'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}})
+            response.headers['Retry-After'] = f"{retry_after:.2f}"
+            return response, 429
+        request_times.append(now)
+
+    body = request.get_json()
+    prompt_tokens = sum(len(message['content'].split()) for message in body['messages'])
+    content = fake_summary
+    response_format = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        properties = response_format['json_schema']['schema'].get('properties', {})
+        content = json.dumps({name: fake_summary for name in properties})
+    completion_tokens = len(content.split())
+    if body.get('stream'):
+        return Response(stream_completion(body, now), mimetype='text/event-stream')
+    time.sleep(settings['latency'])
+
+    return jsonify({
+        'id': f"chatcmpl-fake-{int(now * 1000000)}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop'
+        }],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+    })
+
+
+def stream_completion(body, now):
+    """
+    Streams the fake summary word by word, spread over the configured latency.
+    """
+    words = fake_summary.split(' ')
+    for index, word in enumerate(words):
+        time.sleep(settings['latency'] / len(words))
+        chunk = {
+            'id': f"chatcmpl-fake-{int(now * 1000000)}",
+            'object': 'chat.completion.chunk',
+            'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{
+                'index': 0,
+                'delta': {'content': word if index == 0 else ' ' + word},
+                'finish_reason': 'stop' if index == len(words) - 1 else None
+            }]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake OpenAI endpoint for throughput measurements.')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=1.0, help='Seconds taken by each completion')
+    parser.add_argument('--rpm', type=int, default=600, help='Requests per minute before answering with 429')
+    args = parser.parse_args()
+    settings['latency'] = args.latency
+    settings['rpm'] = args.rpm
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
@@ -0,0 +1,249 @@
+"""
+Hierarchical (map-reduce) summarization of the properties whose reviews exceed the context budget.
+format_review keeps the newest reviews that fit in 4096 tokens, so heavily reviewed properties lose most of their
+history. Here the reviews are packed into chunks that fit the budget and every chunk is summarized on its own (map),
+all of them in parallel through the rate limiter of the asynchronous pipeline. The partial summaries are then
+summarized into the SUMMARY and the CRITICAL_REVIEW (reduce), both at the same time. When the partial summaries do not
+fit the budget either, they are chunked and summarized once more, one level up.
+A property therefore costs about two calls of wall-clock time: one round of map calls and one round of reduce calls.
+Properties whose reviews fit the budget skip the map and are summarized from the reviews, as before.
+
+The chunks are packed from the oldest review, so that new reviews only change the newest chunk. The summary of each
+chunk is stored in JoshuaReviewChunkSummaries under the hash of the model, prompt and text that produced it, and is
+reused by the later runs instead of paying for it again.
+
+    python hierarchical_summarizer.py --property-id 46394374
+    python hierarchical_summarizer.py --limit 100 --base-url http://localhost:8089/v1
+"""
+import argparse
+import asyncio
+import hashlib
+import time
+from contextlib import closing
+import airbnb_review_summarizer as ars
+import metrics
+from airbnb_review_summarizer import prompt_settings
+from async_review_summarizer import AsyncAirBnbReviewSummarizer
+from completion_cache import completion_cache_modes
+from review_text import printable
+from token_budget import get_token_budget, review_separator
+
+chunk_max_tokens = 4096
+max_summary_levels = 4
+property_concurrency = 4  # Properties summarized at the same time, their calls share the rate limiter
+
+chunk_summary_table = 'JoshuaReviewChunkSummaries'
+
+
+class HierarchicalReviewSummarizer(AsyncAirBnbReviewSummarizer):
+    def __init__(self, chunk_tokens=chunk_max_tokens, **kwargs):
+        """
+        :param chunk_tokens: The token budget of the prompt and the text of every call
+        :param kwargs: The arguments of AsyncAirBnbReviewSummarizer
+        """
+        super().__init__(**kwargs)
+        self.chunk_tokens = chunk_tokens
+        self.request_slots = None
+        self.chunk_table_ready = False
+        self.chunk_calls = 0
+        self.reused_chunks = 0
+        self.grand_token_count = 0
+
+    def ensure_chunk_table(self):
+        """
+        Creates the table of the chunk summaries, which is managed by this module.
+        """
+        if self.chunk_table_ready:
+            return
+        self.postgres_helper.execute(f"""
+        CREATE TABLE IF NOT EXISTS {chunk_summary_table} (
+            PROPERTY_ID bigint NOT NULL,
+            CHUNK_HASH text NOT NULL,
+            LEVEL integer NOT NULL,
+            CHUNK_TOKENS integer NOT NULL,
+            SUMMARY text NOT NULL,
+            CREATED_AT timestamp NOT NULL DEFAULT now(),
+            PRIMARY KEY (PROPERTY_ID, CHUNK_HASH)
+        )
+        """)
+        self.chunk_table_ready = True
+
+    def chunk_hash(self, level, text):
+        """
+        Names the summary of a chunk after everything that went into it, so that a changed prompt or model is not
+        served the summaries of the previous one.
+        """
+        key = '\n'.join([ars.openai_model, prompt_settings['chunk_summary']['prompt'], str(level), text])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def load_chunk_summaries(self, property_id, chunk_hashes):
+        """
+        :return: A dictionary of the stored summaries by chunk hash
+        """
+        self.ensure_chunk_table()
+        sql = f"""
+        SELECT CHUNK_HASH, SUMMARY
+        FROM {chunk_summary_table}
+        WHERE PROPERTY_ID = %s AND CHUNK_HASH = ANY(%s)
+        """
+        return {row[0]: row[1] for row in self.postgres_helper.query(sql, (int(property_id), list(chunk_hashes)))}
+
+    def save_chunk_summaries(self, property_id, rows):
+        """
+        :param rows: A list of (chunk hash, level, chunk tokens, summary)
+        """
+        self.ensure_chunk_table()
+        sql = f"""
+        INSERT INTO {chunk_summary_table} (PROPERTY_ID, CHUNK_HASH, LEVEL, CHUNK_TOKENS, SUMMARY)
+        VALUES %s
+        ON CONFLICT (PROPERTY_ID, CHUNK_HASH) DO NOTHING
+        """
+        self.postgres_helper.execute_values(sql, [(int(property_id),) + tuple(row) for row in rows])
+
+    async def run_blocking(self, function, *args):
+        """
+        Runs a database call off the event loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def complete(self, kind, text, token_count):
+        """
+        Runs one completion with at most self.concurrency of them in flight.
+        :return: The generated text
+        """
+        if self.request_slots is None:
+            self.request_slots = asyncio.Semaphore(self.concurrency)
+        async with self.request_slots:
+            response = await self.create_completion(kind, text, token_count)
+        self.grand_token_count += response.usage.total_tokens
+        return response.choices[0].message.content
+
+    async def summarize_level(self, property_id, level, pieces):
+        """
+        Map step: packs the pieces into chunks and summarizes the chunks that were not summarized before, in parallel.
+        :param pieces: Reviews or partial summaries, oldest first
+        :return: The summaries of the chunks, oldest first
+        """
+        chunks = get_token_budget(self.chunk_tokens, prompt_settings['chunk_summary']['prompt']).chunks(pieces)
+        chunk_hashes = [self.chunk_hash(level, text) for text, _ in chunks]
+        summaries = await self.run_blocking(self.load_chunk_summaries, property_id, chunk_hashes)
+        missing = [i for i, chunk_hash in enumerate(chunk_hashes) if chunk_hash not in summaries]
+        self.reused_chunks += len(chunks) - len(missing)
+        self.chunk_calls += len(missing)
+
+        texts = await asyncio.gather(*[self.complete('chunk_summary', chunks[i][0], chunks[i][1]) for i in missing])
+        new_rows = [(chunk_hashes[i], level, chunks[i][1], text) for i, text in zip(missing, texts)]
+        if len(new_rows) > 0:
+            await self.run_blocking(self.save_chunk_summaries, property_id, new_rows)
+        summaries.update({chunk_hash: text for chunk_hash, _, _, text in new_rows})
+        print(f"Property Id {property_id}: level {level} has {len(chunks)} chunks, {len(missing)} summarized")
+        return [summaries[chunk_hash] for chunk_hash in chunk_hashes]
+
+    async def summarize_property(self, property_id, consolidated_review):
+        """
+        Summarizes the whole history of reviews of a property and queues the results for the database.
+        :param consolidated_review: The consolidated review, most recent first
+        :return: A dictionary of the summary and the critical review
+        """
+        _, cleaned_review = next(self.clean_review_stream([(property_id, consolidated_review)]))
+        reviews = [printable(review).strip() for review in cleaned_review.split(review_separator)]
+        pieces = [review for review in reversed(reviews) if len(review) > 0]  # Oldest first
+        if len(pieces) == 0:
+            print(f"Skipped property Id {property_id}. No tokens found.")
+            self.review_writer.add(property_id, 'summary', "")
+            return {'summary': "", 'critical_review': None}
+
+        kinds = ['summary', 'critical_review']
+        level = 0
+        while True:
+            final_kinds = kinds if level == 0 else ['reduce_summary', 'reduce_critical_review']
+            # The budget of the longest of the two prompts
+            budget = min([get_token_budget(self.chunk_tokens, prompt_settings[kind]['prompt']) for kind in final_kinds],
+                         key=lambda token_budget: token_budget.budget)
+            final_text = review_separator.join(reversed(pieces))  # Most recent first, like the consolidated review
+            token_count = budget.count(final_text)
+            if token_count <= budget.budget or len(pieces) == 1 or level >= max_summary_levels:
+                break
+            pieces = await self.summarize_level(property_id, level, pieces)
+            level += 1
+        if token_count > budget.budget:
+            final_text, token_count = budget.fit(final_text)
+
+        texts = await asyncio.gather(*[self.complete(kind, final_text, token_count) for kind in final_kinds])
+        for kind, text in zip(kinds, texts):
+            self.review_writer.add(property_id, kind, text)
+        return dict(zip(kinds, texts))
+
+    async def summarize_single_property(self, property_id):
+        consolidated_review = await self.run_blocking(self.get_consolidated_reviews_for_single_property, property_id)
+        result = await self.summarize_property(property_id, consolidated_review)
+        await self.run_blocking(self.review_writer.flush)
+        return result
+
+    async def generate_hierarchical_summaries(self, limit=10, concurrency=property_concurrency):
+        """
+        Summarizes the properties without a summary, concurrency of them at the same time.
+        :param limit: The number of properties, None for all of them
+        """
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+        failures = 0
+        property_counter = 0
+
+        async def summarize(property_id, consolidated_review):
+            nonlocal failures
+            try:
+                await self.summarize_property(property_id, consolidated_review)
+            except Exception as err:
+                failures += 1
+                print(f"Failed to summarize property Id {property_id}: {err}")
+            finally:
+                slots.release()
+
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with closing(self.stream_property_reviews()) as property_reviews:
+            row_iterator = iter(property_reviews)
+            while limit is None or property_counter < limit:
+                row = await loop.run_in_executor(None, next, row_iterator, None)
+                if row is None:
+                    break
+                await slots.acquire()
+                task = asyncio.create_task(summarize(row[0], row[1]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                property_counter += 1
+            await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - start_time
+
+        await self.run_blocking(self.review_writer.flush)
+        total_cost = self.grand_token_count * ars.cost_per_100k_tokens / 100000
+        print(f"Total properties: {property_counter} ({failures} failed, {self.retry_count} retries)")
+        print(f"Chunks summarized: {self.chunk_calls}, reused: {self.reused_chunks}")
+        print(self.completion_cache.report())
+        print(f"Elapsed: {elapsed:.1f} seconds")
+        print(f"Total tokens: {self.grand_token_count}")
+        print(f"Cost of generating model: ${total_cost}")
+        print(metrics.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the whole history of reviews with map-reduce.')
+    parser.add_argument('--property-id', type=int, default=None, help='Summarize a single property')
+    parser.add_argument('--limit', type=int, default=10, help='The number of properties, 0 for all of them')
+    parser.add_argument('--properties-in-flight', type=int, default=property_concurrency)
+    parser.add_argument('--concurrency', type=int, default=ars.max_concurrent_requests)
+    parser.add_argument('--rpm', type=int, default=ars.requests_per_minute)
+    parser.add_argument('--tpm', type=int, default=ars.tokens_per_minute)
+    parser.add_argument('--base-url', default=None, help='OpenAI compatible endpoint, e.g. the fake server')
+    parser.add_argument('--cache-mode', choices=completion_cache_modes, default=ars.completion_cache_mode,
+                        help='replay runs offline from the completion cache')
+    args = parser.parse_args()
+
+    generator = HierarchicalReviewSummarizer(concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                             tokens_per_minute=args.tpm, base_url=args.base_url,
+                                             cache_mode=args.cache_mode)
+    if args.property_id is not None:
+        print(asyncio.run(generator.summarize_single_property(args.property_id)))
+    else:
+        asyncio.run(generator.generate_hierarchical_summaries(args.limit or None, args.properties_in_flight))
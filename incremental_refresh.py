@@ -0,0 +1,244 @@
+"""
+Incremental refresh of the summaries when new reviews come in.
+A summarized property used to stay as it was, or be summarized again from its whole consolidated review. Instead, a
+high-water mark is kept per property in JoshuaSummaryWatermarks (see summary_watermarks): the date of the newest review
+its summary covers, recorded when the summary is saved. A refresh only reads the properties of
+JOSHUA_REVIEWS_WITH_METADATA that have reviews past their mark, and merges those new reviews into the existing SUMMARY
+and CRITICAL_REVIEW, so it only pays for the new tokens. When the new reviews do not fit the budget, they are condensed
+first by the map step of the hierarchical summarizer.
+
+The summaries written before the marks were recorded have none. The baseline command, run once, marks them as covering
+all the reviews present at that time.
+
+    python incremental_refresh.py baseline
+    python incremental_refresh.py refresh --limit 100
+"""
+import argparse
+import asyncio
+import time
+from contextlib import closing
+import airbnb_review_summarizer as ars
+import metrics
+from airbnb_review_summarizer import prompt_settings
+from hierarchical_summarizer import HierarchicalReviewSummarizer, max_summary_levels, property_concurrency
+from completion_cache import completion_cache_modes
+from review_text import printable
+from summary_watermarks import (ensure_watermark_table, review_date_sql, review_property_id_sql, review_text_sql,
+                                reviews_table, watermark_table)
+from token_budget import get_token_budget, review_separator
+
+watermark_flush_size = 100  # Properties refreshed between two saves of their marks
+new_reviews_marker = '\n###\n'
+
+
+class IncrementalSummaryRefresher(HierarchicalReviewSummarizer):
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: The arguments of HierarchicalReviewSummarizer
+        """
+        super().__init__(**kwargs)
+        # The marks of the merged summaries are the reviews actually merged, saved by save_watermarks
+        self.review_writer.mark_summaries = False
+        self.pending_watermarks = []
+
+    def ensure_watermark_table(self):
+        ensure_watermark_table(self.postgres_helper)
+
+    def mark_baseline(self):
+        """
+        Gives a mark to the summarized properties that have none, covering all their current reviews. Only the
+        summaries saved before the marks were recorded with them need it.
+        """
+        self.ensure_watermark_table()
+        sql = f"""
+        INSERT INTO {watermark_table} (PROPERTY_ID, LAST_REVIEW_DATE, REVIEW_COUNT)
+        SELECT {review_property_id_sql}, MAX({review_date_sql}), COUNT(*)
+        FROM {reviews_table} R
+        WHERE {review_property_id_sql} IN (
+            SELECT PROPERTY_ID FROM JoshuaConsolidatedRawReviews WHERE length(SUMMARY) > 0
+        )
+        AND NOT EXISTS (SELECT 1 FROM {watermark_table} W WHERE W.PROPERTY_ID = {review_property_id_sql})
+        GROUP BY {review_property_id_sql}
+        ON CONFLICT (PROPERTY_ID) DO NOTHING
+        """
+        self.postgres_helper.execute(sql)
+
+    def stream_changed_properties(self):
+        """
+        Streams the (property_id, summary, critical review, last review date, review count) of the summarized
+        properties that have reviews past their mark.
+        """
+        self.ensure_watermark_table()
+        sql = f"""
+        SELECT
+            W.PROPERTY_ID, JCR.SUMMARY, JCR.CRITICAL_REVIEW, W.LAST_REVIEW_DATE, W.REVIEW_COUNT
+        FROM {watermark_table} W
+        JOIN JoshuaConsolidatedRawReviews JCR
+            ON JCR.PROPERTY_ID = W.PROPERTY_ID
+        WHERE length(JCR.SUMMARY) > 0
+        AND EXISTS (
+            SELECT 1 FROM {reviews_table} R
+            WHERE {review_property_id_sql} = W.PROPERTY_ID AND {review_date_sql} > W.LAST_REVIEW_DATE
+        )
+        """
+        return self.postgres_helper.stream(sql)
+
+    def get_new_reviews(self, property_id, last_review_date):
+        """
+        :return: The (review date, review) of a property past its mark, most recent first
+        """
+        sql = f"""
+        SELECT {review_date_sql}, {review_text_sql}
+        FROM {reviews_table} R
+        WHERE {review_property_id_sql} = %s AND {review_date_sql} > %s
+        ORDER BY {review_date_sql} DESC
+        """
+        return self.postgres_helper.query(sql, (int(property_id), last_review_date))
+
+    def save_watermarks(self, rows):
+        """
+        Saves the marks of the refreshed properties, once their summaries are in the database, so that a crash
+        merges the same reviews again rather than never.
+        :param rows: A list of (property_id, last review date, review count), whose summaries are already queued
+        """
+        self.review_writer.flush()
+        if len(rows) == 0:
+            return
+        sql = f"""
+        INSERT INTO {watermark_table} (PROPERTY_ID, LAST_REVIEW_DATE, REVIEW_COUNT, SUMMARIZED_AT)
+        VALUES %s
+        ON CONFLICT (PROPERTY_ID) DO UPDATE
+        SET LAST_REVIEW_DATE = EXCLUDED.LAST_REVIEW_DATE,
+            REVIEW_COUNT = EXCLUDED.REVIEW_COUNT,
+            SUMMARIZED_AT = EXCLUDED.SUMMARIZED_AT
+        """
+        self.postgres_helper.execute_values(sql, rows, template='(%s::bigint, %s::timestamp, %s::integer, now())')
+
+    async def refresh_property(self, property_id, summary, critical_review, last_review_date, review_count):
+        """
+        Merges the reviews past the mark of a property into its summary and critical review.
+        :return: The number of new reviews
+        """
+        rows = await self.run_blocking(self.get_new_reviews, property_id, last_review_date)
+        texts = [text for _, text in self.clean_review_stream((property_id, text or '') for _, text in rows)]
+        pieces = [printable(text).strip() for text in reversed(texts)]
+        pieces = [piece for piece in pieces if len(piece) > 0]  # Oldest first
+
+        existing = {'summary': summary, 'critical_review': critical_review}
+        kinds = [kind for kind in ['summary', 'critical_review'] if existing[kind]]
+        if len(pieces) > 0:
+            new_reviews, token_count = await self.condense_new_reviews(property_id, existing, kinds, pieces)
+            texts = await asyncio.gather(*[self.complete(f"merge_{kind}", existing[kind] + new_reviews_marker + new_reviews,
+                                                         token_count + self.count_tokens(existing[kind] + new_reviews_marker))
+                                           for kind in kinds])
+            for kind, text in zip(kinds, texts):
+                self.review_writer.add(property_id, kind, text)
+        if len(rows) > 0:
+            self.pending_watermarks.append((int(property_id), rows[0][0], review_count + len(rows)))
+        return len(rows)
+
+    def count_tokens(self, text):
+        return get_token_budget(self.chunk_tokens).count(text)
+
+    async def condense_new_reviews(self, property_id, existing, kinds, pieces):
+        """
+        Fits the new reviews in the room that the prompt and the existing texts leave, summarizing them with the map
+        step of the hierarchical summarizer when they are too many.
+        :return: The new reviews, most recent first, and their number of tokens
+        """
+        room = None
+        for kind in kinds:
+            merge_budget = get_token_budget(self.chunk_tokens, prompt_settings[f"merge_{kind}"]['prompt'])
+            kind_room = merge_budget.budget - self.count_tokens(existing[kind] + new_reviews_marker)
+            room = kind_room if room is None else min(room, kind_room)
+        room = max(room, self.chunk_tokens // 4)
+        reviews_budget = get_token_budget(room)
+
+        level = 0
+        while True:
+            new_reviews = review_separator.join(reversed(pieces))
+            token_count = reviews_budget.count(new_reviews)
+            if token_count <= room or len(pieces) == 1 or level >= max_summary_levels:
+                break
+            pieces = await self.summarize_level(property_id, level, pieces)
+            level += 1
+        if token_count > room:
+            new_reviews, token_count = reviews_budget.fit(new_reviews)
+        return new_reviews, token_count
+
+    async def flush_watermarks(self):
+        # Taken on the event loop, so every mark taken has its summaries queued before the flush
+        rows, self.pending_watermarks = self.pending_watermarks, []
+        await self.run_blocking(self.save_watermarks, rows)
+
+    async def refresh_summaries(self, limit=None, concurrency=property_concurrency):
+        """
+        Merges the new reviews of every changed property into its summaries.
+        :param limit: The number of properties, None for all of them
+        """
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+        failures = 0
+        property_counter = 0
+        review_counter = 0
+
+        async def refresh(row):
+            nonlocal failures, review_counter
+            try:
+                new_review_count = await self.refresh_property(*row)
+                review_counter += new_review_count
+            except Exception as err:
+                failures += 1
+                print(f"Failed to refresh property Id {row[0]}: {err}")
+            finally:
+                slots.release()
+
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with closing(self.stream_changed_properties()) as changed_properties:
+            row_iterator = iter(changed_properties)
+            while limit is None or property_counter < limit:
+                row = await loop.run_in_executor(None, next, row_iterator, None)
+                if row is None:
+                    break
+                await slots.acquire()
+                task = asyncio.create_task(refresh(row))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                property_counter += 1
+                if len(self.pending_watermarks) >= watermark_flush_size:
+                    await self.flush_watermarks()
+            await asyncio.gather(*tasks)
+        await self.flush_watermarks()
+        elapsed = time.monotonic() - start_time
+
+        total_cost = self.grand_token_count * ars.cost_per_100k_tokens / 100000
+        print(f"Refreshed properties: {property_counter} ({failures} failed) with {review_counter} new reviews")
+        print(f"Chunks summarized: {self.chunk_calls}, reused: {self.reused_chunks}")
+        print(self.completion_cache.report())
+        print(f"Elapsed: {elapsed:.1f} seconds")
+        print(f"Total tokens: {self.grand_token_count}")
+        print(f"Cost of generating model: ${total_cost}")
+        print(metrics.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the new reviews into the existing summaries.')
+    parser.add_argument('command', choices=['baseline', 'refresh'])
+    parser.add_argument('--limit', type=int, default=0, help='The number of properties, 0 for all of them')
+    parser.add_argument('--properties-in-flight', type=int, default=property_concurrency)
+    parser.add_argument('--concurrency', type=int, default=ars.max_concurrent_requests)
+    parser.add_argument('--rpm', type=int, default=ars.requests_per_minute)
+    parser.add_argument('--tpm', type=int, default=ars.tokens_per_minute)
+    parser.add_argument('--base-url', default=None, help='OpenAI compatible endpoint, e.g. the fake server')
+    parser.add_argument('--cache-mode', choices=completion_cache_modes, default=ars.completion_cache_mode,
+                        help='replay runs offline from the completion cache')
+    args = parser.parse_args()
+
+    refresher = IncrementalSummaryRefresher(concurrency=args.concurrency, requests_per_minute=args.rpm,
+                                            tokens_per_minute=args.tpm, base_url=args.base_url,
+                                            cache_mode=args.cache_mode)
+    if args.command == 'baseline':
+        refresher.mark_baseline()
+    else:
+        asyncio.run(refresher.refresh_summaries(args.limit or None, args.properties_in_flight))
@@ -0,0 +1,144 @@
+"""
+Prometheus metrics of the OpenAI calls, of the database queries and of the Flask routes.
+    - openai_request_seconds, openai_requests_total, openai_tokens_total, openai_finish_reasons_total and
+      openai_cost_dollars_total by model and kind of generation (summary, critical_review, chunk_summary...), the
+      cost being counted as the responses come in, at the price the run was configured with
+    - openai_completion_tokens_per_second, the generation speed of every call
+    - db_query_seconds and db_errors_total by operation and prepared statement, db_pool_wait_seconds for a connection
+    - http_request_seconds by method, route and status
+server.py exposes them on /metrics; the batch scripts print summary() at the end of a run.
+Responses answered by the completion cache cost nothing and are counted by completion_cache_requests_total instead.
+"""
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+import request_timing
+
+openai_latency_buckets = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+db_latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+tokens_per_second_buckets = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+openai_request_seconds = Histogram('openai_request_seconds', 'Latency of the successful OpenAI calls',
+                                   ['model', 'kind'], buckets=openai_latency_buckets)
+openai_requests = Counter('openai_requests_total', 'OpenAI calls by outcome, ok or the exception raised',
+                          ['model', 'kind', 'status'])
+openai_tokens = Counter('openai_tokens_total', 'Tokens of the OpenAI calls', ['model', 'kind', 'type'])
+openai_finish_reasons = Counter('openai_finish_reasons_total', 'Finish reasons of the OpenAI completions',
+                                ['model', 'kind', 'finish_reason'])
+openai_cost = Counter('openai_cost_dollars_total', 'Estimated cost of the OpenAI calls', ['model', 'kind'])
+openai_tokens_per_second = Histogram('openai_completion_tokens_per_second', 'Completion tokens per second of a call',
+                                     ['model', 'kind'], buckets=tokens_per_second_buckets)
+completion_cache_requests = Counter('completion_cache_requests_total', 'Lookups of the completion cache', ['result'])
+
+db_query_seconds = Histogram('db_query_seconds', 'Latency of the database queries', ['operation', 'statement'],
+                             buckets=db_latency_buckets)
+db_errors = Counter('db_errors_total', 'Failed database queries', ['operation', 'statement'])
+db_pool_wait_seconds = Histogram('db_pool_wait_seconds', 'Wait for a pooled database connection',
+                                 buckets=db_latency_buckets)
+
+http_request_seconds = Histogram('http_request_seconds', 'Latency of the Flask routes, up to the first byte of the body',
+                                 ['method', 'route', 'status'])
+
+
+def observe_completion(model, kind, response, seconds, cost_per_100k_tokens):
+    """
+    Records a successful chat completion.
+    :param response: The response of the OpenAI API, or the one assembled from a stream
+    :param seconds: The duration of the call
+    :param cost_per_100k_tokens: The price the cost is estimated with
+    """
+    openai_requests.labels(model, kind, 'ok').inc()
+    openai_request_seconds.labels(model, kind).observe(seconds)
+    for choice in response.choices or []:
+        if choice.finish_reason is not None:
+            openai_finish_reasons.labels(model, kind, choice.finish_reason).inc()
+    usage = response.usage
+    if usage is not None:
+        openai_tokens.labels(model, kind, 'prompt').inc(usage.prompt_tokens)
+        openai_tokens.labels(model, kind, 'completion').inc(usage.completion_tokens)
+        openai_cost.labels(model, kind).inc(usage.total_tokens * cost_per_100k_tokens / 100000)
+        if seconds > 0:
+            openai_tokens_per_second.labels(model, kind).observe(usage.completion_tokens / seconds)
+
+
+def observe_completion_error(model, kind, err):
+    openai_requests.labels(model, kind, type(err).__name__).inc()
+
+
+@contextmanager
+def timed_query(operation, statement=''):
+    """
+    Times a database query and counts it as failed when the block raises. The time is also added to the 'db' span of
+    the request being served, if any.
+    :param operation: The method of PostgresHelper
+    :param statement: The name of the prepared statement or of the query, if any
+    """
+    started_at = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        db_errors.labels(operation, statement).inc()
+        raise
+    finally:
+        seconds = time.perf_counter() - started_at
+        db_query_seconds.labels(operation, statement).observe(seconds)
+        timer = request_timing.current()
+        if timer is not None:
+            timer.add('db', seconds)
+
+
+def observe_http_request(method, route, status, seconds):
+    http_request_seconds.labels(method, route, str(status)).observe(seconds)
+
+
+def exposition():
+    """
+    :return: The body and the content type of the /metrics endpoint
+    """
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def samples(metric, suffix=''):
+    """
+    :return: A dictionary of the values of a metric by the tuple of their label values
+    """
+    values = {}
+    for family in metric.collect():
+        for sample in family.samples:
+            if sample.name == family.name + suffix:
+                values[tuple(sample.labels.values())] = sample.value
+    return values
+
+
+def summary():
+    """
+    Summarizes the OpenAI calls and the database queries of the process so far, for the end of a batch run.
+    """
+    lines = []
+    calls = samples(openai_request_seconds, '_count')
+    seconds = samples(openai_request_seconds, '_sum')
+    tokens = samples(openai_tokens, '_total')
+    costs = samples(openai_cost, '_total')
+    statuses = samples(openai_requests, '_total')
+    finish_reasons = samples(openai_finish_reasons, '_total')
+    for model, kind in sorted(set(calls) | {labels[:2] for labels in statuses}):
+        count = int(calls.get((model, kind), 0))
+        total_seconds = seconds.get((model, kind), 0.0)
+        completion_tokens = int(tokens.get((model, kind, 'completion'), 0))
+        errors = {labels[2]: int(value) for labels, value in statuses.items()
+                  if labels[:2] == (model, kind) and labels[2] != 'ok' and value > 0}
+        reasons = {labels[2]: int(value) for labels, value in finish_reasons.items() if labels[:2] == (model, kind)}
+        lines.append(f"OpenAI {model} {kind}: {count} calls, {total_seconds / max(count, 1):.2f} s mean latency, "
+                     f"{int(tokens.get((model, kind, 'prompt'), 0))} prompt + {completion_tokens} completion tokens, "
+                     f"{completion_tokens / total_seconds if total_seconds > 0 else 0:.1f} completion tokens/s, "
+                     f"${costs.get((model, kind), 0.0):.4f}, finish reasons {reasons}, errors {errors}")
+    queries = samples(db_query_seconds, '_count')
+    query_seconds = samples(db_query_seconds, '_sum')
+    query_errors = samples(db_errors, '_total')
+    for operation, statement in sorted(queries):
+        count = int(queries[(operation, statement)])
+        name = f"{operation} {statement}".strip()
+        lines.append(f"Database {name}: {count} queries, "
+                     f"{1000.0 * query_seconds.get((operation, statement), 0.0) / max(count, 1):.1f} ms mean, "
+                     f"{int(query_errors.get((operation, statement), 0))} errors")
+    return '\n'.join(lines)
@@ -0,0 +1,291 @@
+"""
+Offline summarization through the OpenAI Batch API.
+Batches are half the price of synchronous calls and do not count against the per-minute limits, which makes them
+the cheapest way to backfill thousands of properties. The workflow is:
+    1. generate_openai_jsonl(limit, with_property_id=True, kind) writes the reviews of the properties missing that kind
+       of text, cropped to the budget of its prompt, to /tmp/token_worthy_reviews_<kind>_*.jsonl
+    2. submit shards that file into batch files with custom_id = property_id, uploads and submits them
+    3. status refreshes the state of the submitted batches
+    4. ingest downloads the output of the finished batches and bulk updates SUMMARY or CRITICAL_REVIEW. The errors
+       of the requests that failed are downloaded and reported, and those requests are written to a retry shard
+    5. retry submits the retry shards
+
+    python openai_batch.py export --limit 5000 --kind summary
+    python openai_batch.py submit --jsonl /tmp/token_worthy_reviews_summary_240101_120000.jsonl --kind summary
+    python openai_batch.py status
+    python openai_batch.py ingest
+    python openai_batch.py retry
+
+Submitted batches are tracked in a JSON manifest so that the steps can run hours apart and be resumed.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import airbnb_review_summarizer as ars
+from airbnb_review_summarizer import AirBnbReviewSummarizer, prompt_settings
+from PostgresHelper import PostgresHelper
+from review_writer import bulk_update_reviews
+
+batch_manifest_file = 'openai_batches.json'
+batch_size = 10000  # The Batch API accepts up to 50,000 requests and 200 MB per file
+batch_endpoint = '/v1/chat/completions'
+completion_window = '24h'
+finished_states = ['completed', 'failed', 'expired', 'cancelled']
+
+
+class OpenAIBatchSummarizer(object):
+    def __init__(self, manifest_file=batch_manifest_file):
+        self.manifest_file = manifest_file
+        self.manifest = self.load_manifest()
+        self.postgres_helper = PostgresHelper()
+
+    def load_manifest(self):
+        """
+        Loads the list of submitted batches.
+        """
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as manifest:
+                return json.load(manifest)
+        return {'batches': []}
+
+    def save_manifest(self):
+        """
+        Saves the list of submitted batches, replacing the file atomically so that a crash can not corrupt it.
+        """
+        temp_filename = self.manifest_file + '.tmp'
+        with open(temp_filename, 'w') as manifest:
+            json.dump(self.manifest, manifest, indent=2)
+        os.replace(temp_filename, self.manifest_file)
+
+    def shard_jsonl(self, jsonl_filename, kind='summary', size=batch_size):
+        """
+        Converts the output of generate_openai_jsonl into Batch API request files of at most size lines.
+        :param jsonl_filename: A file written by generate_openai_jsonl with with_property_id=True and the same kind
+        :param kind: 'summary' or 'critical_review', selects the system prompt and the sampling parameters
+        :param size: The maximum number of requests per batch
+        :return: The list of shard file names
+        """
+        settings = prompt_settings[kind]
+        basename = os.path.splitext(jsonl_filename)[0]
+        shard_filenames = []
+        shard_file = None
+        line_counter = 0
+
+        with open(jsonl_filename, 'r') as jsonl_file:
+            for line in jsonl_file:
+                if len(line.strip()) == 0:
+                    continue
+                message = json.loads(line)
+                if 'property_id' not in message:
+                    raise ValueError(f"{jsonl_filename} has no property_id, generate it with with_property_id=True")
+                if message.get('kind') != kind:
+                    raise ValueError(f"{jsonl_filename} was exported for {message.get('kind')}, not {kind}: "
+                                     f"export it with --kind {kind}")
+
+                if line_counter % size == 0:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shard_filename = f"{basename}_batch_{len(shard_filenames):04d}.jsonl"
+                    shard_filenames.append(shard_filename)
+                    shard_file = open(shard_filename, 'w')
+
+                user_messages = [m for m in message['messages'] if m['role'] == 'user']
+                request = {
+                    'custom_id': str(message['property_id']),
+                    'method': 'POST',
+                    'url': batch_endpoint,
+                    'body': {
+                        'model': ars.openai_model,
+                        'messages': [{'role': 'system', 'content': settings['prompt']}] + user_messages,
+                        'temperature': settings['temperature'],
+                        'max_tokens': ars.max_completion_tokens,
+                        'top_p': 1,
+                        'frequency_penalty': 0,
+                        'presence_penalty': 0
+                    }
+                }
+                shard_file.write(f"{json.dumps(request)}\n")
+                line_counter += 1
+
+        if shard_file is not None:
+            shard_file.close()
+        print(f"Wrote {line_counter} requests into {len(shard_filenames)} batch files")
+        return shard_filenames
+
+    def submit(self, jsonl_filename, kind='summary', size=batch_size):
+        """
+        Shards the JSONL file, then uploads and submits every shard that was not submitted before.
+        """
+        for shard_filename in self.shard_jsonl(jsonl_filename, kind, size):
+            self.submit_shard(shard_filename, kind)
+
+    def submit_shard(self, shard_filename, kind):
+        """
+        Uploads and submits a batch file, unless it was submitted before.
+        """
+        if shard_filename in [batch['shard_file'] for batch in self.manifest['batches']]:
+            print(f"Skipping {shard_filename}, it was already submitted")
+            return
+        with open(shard_filename, 'rb') as shard_file:
+            input_file = ars.client.files.create(file=shard_file, purpose='batch')
+        batch = ars.client.batches.create(input_file_id=input_file.id,
+                                          endpoint=batch_endpoint,
+                                          completion_window=completion_window,
+                                          metadata={'kind': kind})
+        self.manifest['batches'].append({
+            'batch_id': batch.id,
+            'kind': kind,
+            'shard_file': shard_filename,
+            'input_file_id': input_file.id,
+            'output_file_id': None,
+            'error_file_id': None,
+            'status': batch.status,
+            'submitted_at': dt.datetime.now().isoformat(),
+            'ingested': False
+        })
+        self.save_manifest()  # Save after every submission so that a crash never resubmits a paid batch
+        print(f"Submitted {shard_filename} as batch {batch.id}")
+
+    def refresh_status(self):
+        """
+        Fetches the current state of all unfinished batches.
+        """
+        for entry in self.manifest['batches']:
+            if entry['status'] in finished_states:
+                continue
+            batch = ars.client.batches.retrieve(entry['batch_id'])
+            entry['status'] = batch.status
+            entry['output_file_id'] = batch.output_file_id
+            entry['error_file_id'] = batch.error_file_id
+            if batch.request_counts is not None:
+                entry['request_counts'] = {'total': batch.request_counts.total,
+                                           'completed': batch.request_counts.completed,
+                                           'failed': batch.request_counts.failed}
+        self.save_manifest()
+        for entry in self.manifest['batches']:
+            print(f"{entry['batch_id']}\t{entry['kind']}\t{entry['status']}\t"
+                  f"{entry.get('request_counts', '')}\tingested={entry['ingested']}")
+
+    def parse_output(self, output_text):
+        """
+        Parses a batch output file.
+        :return: A tuple of the (property_id, text) rows and the total number of tokens used
+        """
+        rows = []
+        total_tokens = 0
+        for line in output_text.splitlines():
+            if len(line.strip()) == 0:
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') is not None or response.get('status_code') != 200:
+                print(f"Batch request for property Id {result['custom_id']} failed: {result.get('error')}")
+                continue
+            body = response['body']
+            rows.append((int(result['custom_id']), body['choices'][0]['message']['content']))
+            total_tokens += body['usage']['total_tokens']
+        return rows, total_tokens
+
+    def parse_errors(self, error_text):
+        """
+        Parses a batch error file.
+        :return: A list of the (property_id, error message) of the failed requests
+        """
+        errors = []
+        for line in error_text.splitlines():
+            if len(line.strip()) == 0:
+                continue
+            result = json.loads(line)
+            error = result.get('error') or ((result.get('response') or {}).get('body') or {}).get('error') or {}
+            errors.append((int(result['custom_id']), error.get('message', str(error))))
+        return errors
+
+    def write_retry_shard(self, shard_filename, succeeded_ids):
+        """
+        Writes the requests of a batch file that did not succeed into a new batch file.
+        :param succeeded_ids: The property ids whose results were ingested
+        :return: The name of the retry file and its number of requests, None when every request succeeded
+        """
+        retry_filename = f"{os.path.splitext(shard_filename)[0]}_retry.jsonl"
+        retry_counter = 0
+        with open(shard_filename, 'r') as shard_file, open(retry_filename, 'w') as retry_file:
+            for line in shard_file:
+                if len(line.strip()) > 0 and int(json.loads(line)['custom_id']) not in succeeded_ids:
+                    retry_file.write(line)
+                    retry_counter += 1
+        if retry_counter == 0:
+            os.remove(retry_filename)
+            return None, 0
+        return retry_filename, retry_counter
+
+    def ingest(self):
+        """
+        Downloads the output of every finished batch that was not ingested yet and saves it to the database. The
+        requests that failed, or were never run because the batch failed, expired or was cancelled, are written to a
+        retry shard.
+        """
+        self.refresh_status()
+        grand_token_count = 0
+        property_counter = 0
+        for entry in self.manifest['batches']:
+            if entry['status'] not in finished_states or entry['ingested']:
+                continue
+            rows = []
+            total_tokens = 0
+            if entry['output_file_id'] is not None:
+                output_text = ars.client.files.content(entry['output_file_id']).text
+                rows, total_tokens = self.parse_output(output_text)
+            if entry['error_file_id'] is not None:
+                for property_id, message in self.parse_errors(ars.client.files.content(entry['error_file_id']).text):
+                    print(f"Batch request for property Id {property_id} failed: {message}")
+            bulk_update_reviews(self.postgres_helper, entry['kind'], rows)
+            retry_filename, retry_counter = self.write_retry_shard(entry['shard_file'],
+                                                                   set(property_id for property_id, _ in rows))
+            entry['retry_shard_file'] = retry_filename
+            entry['ingested'] = True
+            entry['ingested_at'] = dt.datetime.now().isoformat()
+            self.save_manifest()
+            grand_token_count += total_tokens
+            property_counter += len(rows)
+            print(f"Ingested {len(rows)} {entry['kind']} results of {entry['status']} batch {entry['batch_id']}")
+            if retry_filename is not None:
+                print(f"{retry_counter} requests did not succeed, they are in {retry_filename} for the retry command")
+
+        # Batches are billed at half the price of the synchronous calls
+        total_cost = grand_token_count * ars.cost_per_100k_tokens / 100000 / 2
+        print(f"Total properties: {property_counter}")
+        print(f"Total tokens: {grand_token_count}")
+        print(f"Cost of generating model: ${total_cost}")
+
+    def retry(self):
+        """
+        Submits the retry shards written by ingest that were not submitted yet.
+        """
+        for entry in list(self.manifest['batches']):
+            if entry.get('retry_shard_file') is not None:
+                self.submit_shard(entry['retry_shard_file'], entry['kind'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize reviews offline with the OpenAI Batch API.')
+    parser.add_argument('command', choices=['export', 'submit', 'status', 'ingest', 'retry'])
+    parser.add_argument('--jsonl', help='The JSONL file written by the export command')
+    parser.add_argument('--kind', choices=['summary', 'critical_review'], default='summary')
+    parser.add_argument('--limit', type=int, default=1000, help='The number of properties to export')
+    parser.add_argument('--batch-size', type=int, default=batch_size)
+    parser.add_argument('--manifest', default=batch_manifest_file)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(AirBnbReviewSummarizer().generate_openai_jsonl(args.limit, with_property_id=True, kind=args.kind))
+    else:
+        batch_summarizer = OpenAIBatchSummarizer(args.manifest)
+        if args.command == 'submit':
+            batch_summarizer.submit(args.jsonl, args.kind, args.batch_size)
+        elif args.command == 'status':
+            batch_summarizer.refresh_status()
+        elif args.command == 'ingest':
+            batch_summarizer.ingest()
+        else:
+            batch_summarizer.retry()
@@ -0,0 +1,123 @@
+"""
+Compact, compressed and cacheable JSON payloads for the large responses of the API.
+    - columnar() turns a list of dicts into one array per field, the fields with few distinct values (city, state,
+      property type) holding indexes into a dictionary of their values instead of repeating them
+    - encode_payload() serializes a payload once and names its version with a hash of its content, so a reload of
+      unchanged data is answered with 304 Not Modified through ETag/If-None-Match
+    - payload_response() compresses with brotli or gzip, as negotiated with Accept-Encoding, and keeps the compressed
+      bodies so that each version is compressed only once per encoding
+    - streamed_response() sends a body made of many chunks as they are produced, compressed on the fly with gzip and
+      flushed after every chunk, so that the client can parse it progressively
+brotli is optional, gzip is used when it is not installed.
+"""
+import gzip
+import hashlib
+import json
+import zlib
+from contextlib import closing
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+gzip_compression_level = 6
+brotli_quality = 5
+min_compressed_size = 1024  # Bytes, smaller bodies are sent as is
+
+
+def columnar(rows, fields, dictionary_fields=()):
+    """
+    Converts a list of dicts into parallel arrays.
+    :param rows: The dicts, all having the fields
+    :param fields: The fields to keep, in order
+    :param dictionary_fields: The fields whose values are replaced by their index in a dictionary of the distinct values
+    :return: A dictionary of the columns and of the dictionaries
+    """
+    columns = {field: [row[field] for row in rows] for field in fields}
+    dictionaries = {}
+    for field in dictionary_fields:
+        codes = {}
+        columns[field] = [codes.setdefault(value, len(codes)) for value in columns[field]]
+        dictionaries[field] = list(codes)
+    return {'fields': list(fields), 'columns': columns, 'dictionaries': dictionaries}
+
+
+def encode_payload(payload):
+    """
+    Serializes a payload and computes its version.
+    :return: An encoded payload, to be cached and passed to payload_response
+    """
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return {'etag': hashlib.blake2b(body, digest_size=16).hexdigest(), 'bodies': {'identity': body}}
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=gzip_compression_level)
+    return body
+
+
+def negotiate_encoding(body):
+    """
+    Picks the best compression that the client accepts.
+    """
+    if len(body) < min_compressed_size:
+        return 'identity'
+    supported = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(supported) or 'identity'
+
+
+def payload_response(encoded_payload, max_age=0):
+    """
+    Answers the current request with an encoded payload, or with 304 when the client already has this version.
+    :param max_age: Seconds the client may use the payload without revalidating it
+    """
+    etag = encoded_payload['etag']
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        encoding = negotiate_encoding(encoded_payload['bodies']['identity'])
+        body = encoded_payload['bodies'].get(encoding)
+        if body is None:
+            body = compress(encoded_payload['bodies']['identity'], encoding)
+            encoded_payload['bodies'][encoding] = body
+        response = Response(body, mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = f"max-age={max_age}, must-revalidate" if max_age > 0 else 'no-cache'
+    return response
+
+
+def gzip_chunks(chunks):
+    """
+    Compresses a stream of chunks into one gzip member, flushed after every chunk.
+    """
+    compressor = zlib.compressobj(gzip_compression_level, zlib.DEFLATED, 31)
+    with closing(chunks):
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if len(data) > 0:
+                yield data
+    yield compressor.flush()
+
+
+def streamed_response(chunks, mimetype='application/json'):
+    """
+    Answers the current request with a body produced chunk by chunk, gzip compressed when the client accepts it.
+    :param chunks: A generator of strings, closed when the client disconnects
+    """
+    if request.accept_encodings.best_match(['gzip']) == 'gzip':
+        response = Response(gzip_chunks(chunks), mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(chunks, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
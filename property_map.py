@@ -0,0 +1,316 @@
+"""
+In-memory spatial index for the map.
+The map used to download up to 10,000 properties at once, whatever part of the world was on screen. Instead, the
+properties are loaded once into a uniform grid of cell_degrees wide cells and the map only asks for its viewport:
+    - the cells overlapping the viewport are looked up, the points of the cells on its edges are checked one by one
+    - when more than marker_limit properties are visible, they are grouped into clusters of about
+      cluster_cell_pixels on screen; cells smaller than a cluster are added as a whole from their running totals
+The grid is kept at grid_levels sizes, each grid_level_factor times coarser than the previous one, so that a zoomed
+out viewport reads a few coarse cells instead of every fine one.
+The index is refreshed in the background by applying the difference with the database, not by rebuilding it.
+"""
+import math
+import threading
+import time
+import speed_distance as sd
+from property_read_model import read_model_table
+
+map_grid_cell_degrees = 0.1
+grid_levels = 3
+grid_level_factor = 8
+viewport_marker_limit = 500
+cluster_cell_pixels = 64
+tile_size_pixels = 256
+map_index_refresh_interval = 300  # Seconds
+
+
+def longitude_ranges(west, east):
+    """
+    Splits a viewport that crosses the antimeridian into two ranges of longitudes within [-180, 180].
+    """
+    if east - west >= 360:
+        return [(-180.0, 180.0)]
+    west = (west + 180) % 360 - 180
+    east = (east + 180) % 360 - 180
+    if west <= east:
+        return [(west, east)]
+    return [(west, 180.0), (-180.0, east)]
+
+
+class PropertyMapIndex(object):
+    def __init__(self, postgres_helper, cell_degrees=map_grid_cell_degrees, refresh_interval=map_index_refresh_interval,
+                 read_model=None):
+        """
+        :param postgres_helper: The PostgresHelper to load the properties with
+        :param cell_degrees: The size of the grid cells in degrees of latitude and longitude
+        :param refresh_interval: Seconds between two refreshes from the database, None to never refresh
+        :param read_model: The PropertyReadModel the properties are read from, made ready before they are first read
+        """
+        self.postgres_helper = postgres_helper
+        self.read_model = read_model
+        self.level_degrees = [cell_degrees * grid_level_factor ** level for level in range(grid_levels)]
+        self.refresh_interval = refresh_interval
+        self.properties = {}  # property id -> marker
+        self.levels = [{} for _ in self.level_degrees]  # (row, column) -> {'property_ids', 'latitude_sum', 'longitude_sum'}
+        self.info = None
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.refresh_thread = None
+
+    def load_properties(self):
+        """
+        Fetches the marker of every property that has reviews and a location.
+        """
+        if self.read_model is not None:
+            self.read_model.ensure_ready()
+        query_string = f"""
+        SELECT
+            CAST(PROPERTY_ID AS text),
+            TITLE,
+            BEDROOMS,
+            BATHROOMS,
+            PROPERTY_TYPE,
+            ZIPCODE,
+            CITY_NAME,
+            CITY_ID,
+            STATE_NAME,
+            LATITUDE,
+            LONGITUDE
+        FROM {read_model_table}
+        WHERE LATITUDE IS NOT NULL AND LONGITUDE IS NOT NULL
+        """
+        properties = {}
+        for row in self.postgres_helper.query(query_string, name='property_map_properties'):
+            properties[row[0]] = {
+                'property_id': row[0],
+                'title': row[1],
+                'bedrooms': row[2],
+                'bathrooms': row[3],
+                'property_type': row[4],
+                'zipcode': row[5],
+                'city': row[6],
+                'city_id': row[7],
+                'state': row[8],
+                'latitude': float(row[9]),
+                'longitude': float(row[10])
+            }
+        return properties
+
+    def cell_of(self, marker, level):
+        """
+        Returns the key of the cell of a property, derived from the finest level so that the levels nest exactly.
+        """
+        row = math.floor(marker['latitude'] / self.level_degrees[0])
+        column = math.floor(marker['longitude'] / self.level_degrees[0])
+        return row // grid_level_factor ** level, column // grid_level_factor ** level
+
+    def add(self, marker):
+        with self.lock:
+            self.remove(marker['property_id'])
+            self.properties[marker['property_id']] = marker
+            for level, cells in enumerate(self.levels):
+                key = self.cell_of(marker, level)
+                cell = cells.setdefault(key, {'property_ids': set(), 'latitude_sum': 0.0, 'longitude_sum': 0.0})
+                cell['property_ids'].add(marker['property_id'])
+                cell['latitude_sum'] += marker['latitude']
+                cell['longitude_sum'] += marker['longitude']
+
+    def remove(self, property_id):
+        with self.lock:
+            marker = self.properties.pop(property_id, None)
+            if marker is None:
+                return
+            for level, cells in enumerate(self.levels):
+                key = self.cell_of(marker, level)
+                cell = cells[key]
+                cell['property_ids'].discard(property_id)
+                cell['latitude_sum'] -= marker['latitude']
+                cell['longitude_sum'] -= marker['longitude']
+                if len(cell['property_ids']) == 0:
+                    del cells[key]
+
+    def refresh(self):
+        """
+        Applies the differences with the database to the index.
+        :return: The number of properties added or changed and the number removed
+        """
+        properties = self.load_properties()
+        with self.lock:
+            changed = [marker for property_id, marker in properties.items() if self.properties.get(property_id) != marker]
+            removed = [property_id for property_id in self.properties if property_id not in properties]
+            for marker in changed:
+                self.add(marker)
+            for property_id in removed:
+                self.remove(property_id)
+            if len(changed) > 0 or len(removed) > 0 or self.info is None:
+                self.info = self.catalog_info()
+            self.loaded = True
+        return len(changed), len(removed)
+
+    def ensure_loaded(self):
+        """
+        Loads the index on first use and starts refreshing it in the background.
+        """
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            started_at = time.monotonic()
+            changed, _ = self.refresh()
+            print(f"Indexed {changed} properties for the map in {time.monotonic() - started_at:.2f} seconds")
+            if self.refresh_interval is not None:
+                self.refresh_thread = threading.Thread(target=self.run_refresh, name='map-index-refresh', daemon=True)
+                self.refresh_thread.start()
+
+    def run_refresh(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except (RuntimeError, Exception) as err:
+                print(f"Failed to refresh the property map index: {err}")
+
+    def catalog_info(self):
+        """
+        Computes the bounding box, center and zoom that show every property.
+        """
+        if len(self.properties) == 0:
+            return {'center': {'lat': 0.0, 'lon': 0.0}, 'bottom_left': {'lat': -90.0, 'lon': -180.0},
+                    'top_right': {'lat': 90.0, 'lon': 180.0}, 'zoom': 2}
+        latitudes = [marker['latitude'] for marker in self.properties.values()]
+        longitudes = [marker['longitude'] for marker in self.properties.values()]
+        min_lat, max_lat = min(latitudes), max(latitudes)
+        min_lon, max_lon = min(longitudes), max(longitudes)
+        if min_lat == max_lat and min_lon == max_lon:
+            zoom_factor = 10
+        else:
+            zoom_factor = int(1200000 / sd.distance_great_circle(min_lat, min_lon, max_lat, max_lon))
+        return {
+            'center': {'lat': (min_lat + max_lat) / 2.0, 'lon': (min_lon + max_lon) / 2.0},
+            'bottom_left': {'lat': min_lat, 'lon': min_lon},
+            'top_right': {'lat': max_lat, 'lon': max_lon},
+            'zoom': min(max(6, zoom_factor), 12)
+        }
+
+    def cells_in(self, level, south, north, west, east):
+        """
+        Finds the cells of a grid level overlapping a viewport that does not cross the antimeridian.
+        :return: A tuple of the keys of the cells entirely inside the viewport and of the cells on its edges
+        """
+        degrees = self.level_degrees[level]
+        cells = self.levels[level]
+        rows = range(math.floor(south / degrees), math.floor(north / degrees) + 1)
+        columns = range(math.floor(west / degrees), math.floor(east / degrees) + 1)
+        if len(rows) * len(columns) <= len(cells):
+            keys = [(row, column) for row in rows for column in columns if (row, column) in cells]
+        else:
+            # Zoomed out: fewer cells hold properties than the viewport covers
+            keys = [key for key in cells if key[0] in rows and key[1] in columns]
+        inner_keys = []
+        edge_keys = []
+        for row, column in keys:
+            if south <= row * degrees and (row + 1) * degrees <= north \
+                    and west <= column * degrees and (column + 1) * degrees <= east:
+                inner_keys.append((row, column))
+            else:
+                edge_keys.append((row, column))
+        return inner_keys, edge_keys
+
+    def collect(self, level, south, north, west, east, inner_cells, edge_markers, parent_key=None):
+        """
+        Adds the (level, key) of the cells entirely inside a viewport to inner_cells and the properties of the
+        other cells that are inside it to edge_markers. The edge cells of the coarse levels are read from the finest.
+        :param parent_key: The coarse cell being read from the finest level, the only one whose cells are collected
+        """
+        degrees = self.level_degrees[level]
+        inner_keys, edge_keys = self.cells_in(level, south, north, west, east)
+        if parent_key is not None:
+            parent_level, (parent_row, parent_column) = parent_key
+            scale = grid_level_factor ** parent_level
+            inner_keys = [key for key in inner_keys if key[0] // scale == parent_row and key[1] // scale == parent_column]
+            edge_keys = [key for key in edge_keys if key[0] // scale == parent_row and key[1] // scale == parent_column]
+        inner_cells.extend((level, key) for key in inner_keys)
+        for row, column in edge_keys:
+            if level > 0:
+                self.collect(0, max(south, row * degrees), min(north, (row + 1) * degrees),
+                             max(west, column * degrees), min(east, (column + 1) * degrees), inner_cells, edge_markers,
+                             (level, (row, column)))
+                continue
+            for property_id in self.levels[0][(row, column)]['property_ids']:
+                marker = self.properties[property_id]
+                if south <= marker['latitude'] <= north and west <= marker['longitude'] <= east:
+                    edge_markers.append(marker)
+
+    def viewport(self, south, west, north, east, zoom, marker_limit=viewport_marker_limit):
+        """
+        Returns the properties visible in a viewport, grouped into clusters when there are too many of them.
+        :param south: The latitude of the bottom of the map
+        :param west: The longitude of the left of the map, may be below -180 when the map wraps around
+        :param north: The latitude of the top of the map
+        :param east: The longitude of the right of the map, may be above 180 when the map wraps around
+        :param zoom: The zoom level of the map, sets the size of the clusters
+        :param marker_limit: The number of visible properties above which they are clustered
+        :return: A dictionary of the markers, the clusters and the number of visible properties
+        """
+        self.ensure_loaded()
+        south, north = max(-90.0, min(south, north)), min(90.0, max(south, north))
+        cluster_degrees = cluster_cell_pixels * 360.0 / (tile_size_pixels * 2 ** max(0, zoom))
+        # The coarsest level whose cells fit in a cluster
+        level = max([0] + [level for level, degrees in enumerate(self.level_degrees) if degrees <= cluster_degrees])
+        with self.lock:
+            inner_cells = []
+            edge_markers = []
+            for range_west, range_east in longitude_ranges(west, east):
+                self.collect(level, south, north, range_west, range_east, inner_cells, edge_markers)
+            count = sum(len(self.levels[level][key]['property_ids']) for level, key in inner_cells) + len(edge_markers)
+
+            if count <= marker_limit:
+                markers = [self.properties[property_id] for level, key in inner_cells
+                           for property_id in self.levels[level][key]['property_ids']]
+                return {'data': markers + edge_markers, 'clusters': [], 'count': count, 'clustered': False}
+
+            clusters = {}
+
+            def accumulate(latitude, longitude, property_ids, latitude_sum, longitude_sum, bounds):
+                key = (math.floor(latitude / cluster_degrees), math.floor(longitude / cluster_degrees))
+                cluster = clusters.get(key)
+                if cluster is None:
+                    clusters[key] = cluster = {'count': 0, 'property_id': next(iter(property_ids)),
+                                               'latitude_sum': 0.0, 'longitude_sum': 0.0, 'bounds': bounds}
+                cluster['count'] += len(property_ids)
+                cluster['latitude_sum'] += latitude_sum
+                cluster['longitude_sum'] += longitude_sum
+                cluster['bounds'] = (min(cluster['bounds'][0], bounds[0]), min(cluster['bounds'][1], bounds[1]),
+                                     max(cluster['bounds'][2], bounds[2]), max(cluster['bounds'][3], bounds[3]))
+
+            for level, (row, column) in inner_cells:
+                cell = self.levels[level][(row, column)]
+                degrees = self.level_degrees[level]
+                if degrees <= cluster_degrees:
+                    size = len(cell['property_ids'])
+                    bounds = (row * degrees, column * degrees, (row + 1) * degrees, (column + 1) * degrees)
+                    accumulate(cell['latitude_sum'] / size, cell['longitude_sum'] / size, cell['property_ids'],
+                               cell['latitude_sum'], cell['longitude_sum'], bounds)
+                else:
+                    edge_markers.extend(self.properties[property_id] for property_id in cell['property_ids'])
+            for marker in edge_markers:
+                accumulate(marker['latitude'], marker['longitude'], [marker['property_id']],
+                           marker['latitude'], marker['longitude'],
+                           (marker['latitude'], marker['longitude'], marker['latitude'], marker['longitude']))
+
+            markers = []
+            output_clusters = []
+            for cluster in clusters.values():
+                size = cluster['count']
+                if size == 1:
+                    markers.append(self.properties[cluster['property_id']])
+                    continue
+                output_clusters.append({
+                    'count': size,
+                    'latitude': cluster['latitude_sum'] / size,
+                    'longitude': cluster['longitude_sum'] / size,
+                    'bottom_left': {'lat': cluster['bounds'][0], 'lon': cluster['bounds'][1]},
+                    'top_right': {'lat': cluster['bounds'][2], 'lon': cluster['bounds'][3]}
+                })
+            return {'data': markers, 'clusters': output_clusters, 'count': count, 'clustered': True}
@@ -0,0 +1,217 @@
+"""
+Radius and nearest-neighbour queries over the reviewed properties, for comparable analysis.
+The latitudes and longitudes of the property read model are converted to points on the unit sphere and indexed in a KD-tree,
+in which the straight-line (chord) distance grows with the great-circle distance. Both queries therefore run on the
+tree and only the candidates it returns get their exact haversine distance.
+A KD-tree can not be updated in place, so the index is rebuilt in the background and swapped in one assignment.
+"""
+import threading
+import time
+import numpy as np
+from scipy.spatial import cKDTree
+import speed_distance as sd
+from property_read_model import read_model_table
+
+neighbor_index_refresh_interval = 900  # Seconds
+max_neighbors = 500
+max_radius_km = 200.0
+_AVG_EARTH_RADIUS_KM = 6371.0088  # The radius of distance_great_circle_array
+
+
+def unit_vectors(latitudes, longitudes):
+    """
+    Converts latitudes and longitudes in degrees to (x, y, z) points on the unit sphere.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    return np.column_stack((np.cos(latitudes) * np.cos(longitudes),
+                            np.cos(latitudes) * np.sin(longitudes),
+                            np.sin(latitudes)))
+
+
+class PropertyNeighborIndex(object):
+    def __init__(self, postgres_helper, refresh_interval=neighbor_index_refresh_interval, read_model=None):
+        """
+        :param postgres_helper: The PostgresHelper to load the properties with
+        :param refresh_interval: Seconds between two rebuilds from the database, None to never rebuild
+        :param read_model: The PropertyReadModel the properties are read from, made ready before they are first read
+        """
+        self.postgres_helper = postgres_helper
+        self.read_model = read_model
+        self.refresh_interval = refresh_interval
+        self.index = None  # Replaced as a whole, so a query always sees a consistent tree and columns
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+
+    def load_properties(self):
+        """
+        Fetches the location and the filterable columns of every property that has reviews and a location.
+        """
+        if self.read_model is not None:
+            self.read_model.ensure_ready()
+        query_string = f"""
+        SELECT
+            CAST(PROPERTY_ID AS text),
+            TITLE,
+            BEDROOMS,
+            BATHROOMS,
+            PROPERTY_TYPE,
+            CITY_NAME,
+            STATE_NAME,
+            LATITUDE,
+            LONGITUDE
+        FROM {read_model_table}
+        WHERE LATITUDE IS NOT NULL AND LONGITUDE IS NOT NULL
+        """
+        return self.postgres_helper.query(query_string, name='property_neighbor_locations')
+
+    def build(self, rows):
+        """
+        Builds the tree and the columns used to filter and describe the neighbours.
+        """
+        latitudes = np.array([row[7] for row in rows], dtype=float)
+        longitudes = np.array([row[8] for row in rows], dtype=float)
+        property_types = [(row[4] or '').lower() for row in rows]
+        type_codes = {property_type: code for code, property_type in enumerate(sorted(set(property_types)))}
+        property_ids = [str(row[0]) for row in rows]
+        return {
+            'tree': cKDTree(unit_vectors(latitudes, longitudes)) if len(rows) > 0 else None,
+            'rows': rows,
+            'latitudes': latitudes,
+            'longitudes': longitudes,
+            'bedrooms': np.array([row[2] for row in rows], dtype=int),
+            'property_types': np.array([type_codes[property_type] for property_type in property_types], dtype=int),
+            'type_codes': type_codes,
+            'positions': {property_id: position for position, property_id in enumerate(property_ids)}
+        }
+
+    def refresh(self):
+        started_at = time.monotonic()
+        self.index = self.build(self.load_properties())
+        print(f"Indexed {len(self.index['rows'])} properties for neighbour queries "
+              f"in {time.monotonic() - started_at:.2f} seconds")
+
+    def ensure_loaded(self):
+        """
+        Builds the index on first use and starts rebuilding it in the background.
+        """
+        if self.index is not None:
+            return
+        with self.lock:
+            if self.index is not None:
+                return
+            self.refresh()
+            if self.refresh_interval is not None:
+                self.refresh_thread = threading.Thread(target=self.run_refresh, name='neighbor-index-refresh',
+                                                       daemon=True)
+                self.refresh_thread.start()
+
+    def run_refresh(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except (RuntimeError, Exception) as err:
+                print(f"Failed to rebuild the property neighbour index: {err}")
+
+    def location_of(self, property_id):
+        """
+        Returns the (latitude, longitude) of a property, None when it is not indexed.
+        """
+        self.ensure_loaded()
+        index = self.index
+        position = index['positions'].get(str(property_id))
+        if position is None:
+            return None
+        return float(index['latitudes'][position]), float(index['longitudes'][position])
+
+    def matches(self, index, positions, bedrooms=None, property_type=None, exclude_property_id=None):
+        """
+        Keeps the positions that pass the filters.
+        """
+        keep = np.ones(len(positions), dtype=bool)
+        if bedrooms is not None:
+            keep &= index['bedrooms'][positions] == bedrooms
+        if property_type is not None:
+            code = index['type_codes'].get(property_type.lower())
+            if code is None:
+                return positions[:0]
+            keep &= index['property_types'][positions] == code
+        if exclude_property_id is not None:
+            excluded = index['positions'].get(str(exclude_property_id))
+            if excluded is not None:
+                keep &= positions != excluded
+        return positions[keep]
+
+    def distances(self, index, positions, latitude, longitude):
+        """
+        Returns the haversine distances in meters between a location and the properties at the positions.
+        """
+        return sd.distance_great_circle_array(latitude, longitude,
+                                              index['latitudes'][positions], index['longitudes'][positions])
+
+    def describe(self, index, positions, distances, limit):
+        """
+        Formats the limit closest neighbours, closest first.
+        """
+        order = np.argsort(distances, kind='stable')[:limit]
+        neighbors = []
+        for position, distance in zip(positions[order], distances[order]):
+            row = index['rows'][position]
+            neighbors.append({
+                'property_id': row[0],
+                'title': row[1],
+                'bedrooms': row[2],
+                'bathrooms': row[3],
+                'property_type': row[4],
+                'city': row[5],
+                'state': row[6],
+                'latitude': row[7],
+                'longitude': row[8],
+                'distance_km': round(float(distance) / 1000.0, 3)
+            })
+        return neighbors
+
+    def within_radius(self, latitude, longitude, radius_km, limit=max_neighbors, bedrooms=None, property_type=None,
+                      exclude_property_id=None):
+        """
+        Finds the properties within radius_km of a location, closest first.
+        :param limit: The maximum number of properties returned
+        :param bedrooms: Only the properties with this number of bedrooms
+        :param property_type: Only the properties of this type, case insensitive
+        :param exclude_property_id: A property left out of the results, usually the one at the center
+        :return: A tuple of the number of matching properties and the closest limit of them
+        """
+        self.ensure_loaded()
+        index = self.index
+        if index['tree'] is None:
+            return 0, []
+        # The chord subtending the arc of radius_km on the unit sphere, widened by rounding errors
+        chord = 2.0 * np.sin(min(radius_km / _AVG_EARTH_RADIUS_KM, np.pi) / 2.0) * (1 + 1e-9) + 1e-12
+        positions = np.array(index['tree'].query_ball_point(unit_vectors([latitude], [longitude])[0], chord),
+                             dtype=int)
+        positions = self.matches(index, positions, bedrooms, property_type, exclude_property_id)
+        distances = self.distances(index, positions, latitude, longitude)
+        # The haversine distance decides at the boundary
+        inside = distances <= radius_km * 1000.0
+        return int(inside.sum()), self.describe(index, positions[inside], distances[inside], limit)
+
+    def nearest(self, latitude, longitude, k, bedrooms=None, property_type=None, exclude_property_id=None):
+        """
+        Finds the k properties closest to a location that pass the filters, closest first.
+        The tree knows nothing of the filters, so the number of neighbours asked to it grows until enough pass them.
+        """
+        self.ensure_loaded()
+        index = self.index
+        if index['tree'] is None:
+            return []
+        size = len(index['rows'])
+        query_k = min(size, k + 1)
+        while True:
+            _, positions = index['tree'].query(unit_vectors([latitude], [longitude])[0], k=query_k)
+            positions = np.atleast_1d(positions)
+            positions = positions[positions < size]
+            matching = self.matches(index, positions, bedrooms, property_type, exclude_property_id)
+            if len(matching) >= k or query_k >= size:
+                return self.describe(index, matching, self.distances(index, matching, latitude, longitude), k)
+            query_k = min(size, query_k * 4)
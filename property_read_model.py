@@ -0,0 +1,252 @@
+"""
+Read model of the properties for the map, the property list and the autocomplete.
+Their queries joined JoshuaConsolidatedRawReviews to JOSHUAPROPERTIES on
+JCR.PROPERTY_ID = CAST(JP.AIRBNB_PROPERTY_ID AS bigint): the cast defeats the indexes of JOSHUAPROPERTIES, and the
+list dragged the table of the huge consolidated reviews into the join for a few map fields. Instead, the result of
+that join is kept in JoshuaPropertyReadModel, one row per reviewed property with only the columns they need, a bigint
+PROPERTY_ID under a unique index and an index on (LATITUDE, LONGITUDE).
+
+The table is maintained from the rows that changed rather than rebuilt. Triggers on both source tables record the ids
+of the properties whose rows were inserted, deleted or had a read column updated in JoshuaPropertyReadModelChanges,
+and every refresh_interval seconds sync() consumes that change log: it upserts those properties from the join, through
+an expression index on CAST(AIRBNB_PROPERTY_ID AS bigint), and deletes the ones that left it. Writing a summary does
+not touch the columns the triggers watch, so it records nothing. The whole join is read only once, when the change
+capture is installed.
+"""
+import threading
+import time
+
+read_model_table = 'JoshuaPropertyReadModel'
+read_model_changes_table = 'JoshuaPropertyReadModelChanges'
+read_model_refresh_interval = 300  # Seconds
+read_model_sync_batch_size = 10000  # Changed properties applied per statement
+
+read_model_columns = ['PROPERTY_ID', 'TITLE', 'BEDROOMS', 'BATHROOMS', 'PROPERTY_TYPE', 'ZIPCODE', 'CITY_NAME',
+                      'CITY_ID', 'STATE_NAME', 'LATITUDE', 'LONGITUDE']
+
+# The columns of JOSHUAPROPERTIES whose updates change the read model
+source_property_columns = ['AIRBNB_PROPERTY_ID', 'TITLE', 'BEDROOMS', 'BATHROOMS', 'PROPERTY_TYPE', 'ZIPCODE',
+                           'CITY_NAME', 'CITY_ID', 'STATE_NAME', 'LATITUDE', 'LONGITUDE']
+
+
+def read_model_source_sql(condition=''):
+    """
+    One row per reviewed property, the columns typed as the read model stores them. A property listed more than once in
+    JOSHUAPROPERTIES keeps the same row from one sync to the next, the duplicates being ordered by all their columns.
+    :param condition: A WHERE clause restricting the properties, e.g. to the changed ones
+    :return: The SQL of the query
+    """
+    return f"""
+    SELECT DISTINCT ON (JCR.PROPERTY_ID)
+        JCR.PROPERTY_ID::bigint AS PROPERTY_ID,
+        JP.TITLE AS TITLE,
+        COALESCE(JP.BEDROOMS,0)::INT AS BEDROOMS,
+        COALESCE(JP.BATHROOMS,0)::INT AS BATHROOMS,
+        JP.PROPERTY_TYPE AS PROPERTY_TYPE,
+        JP.ZIPCODE AS ZIPCODE,
+        JP.CITY_NAME AS CITY_NAME,
+        JP.CITY_ID AS CITY_ID,
+        JP.STATE_NAME AS STATE_NAME,
+        JP.LATITUDE::FLOAT AS LATITUDE,
+        JP.LONGITUDE::FLOAT AS LONGITUDE
+    FROM JoshuaConsolidatedRawReviews JCR
+    JOIN JOSHUAPROPERTIES JP
+        ON JCR.PROPERTY_ID = CAST(JP.AIRBNB_PROPERTY_ID AS bigint)
+    {condition}
+    ORDER BY JCR.PROPERTY_ID, JP.TITLE, JP.BEDROOMS, JP.BATHROOMS, JP.PROPERTY_TYPE, JP.ZIPCODE, JP.CITY_NAME,
+        JP.CITY_ID, JP.STATE_NAME, JP.LATITUDE, JP.LONGITUDE
+    """
+
+
+# Records the property id of the old and the new row, read from the column named by the argument of the trigger
+record_change_function_sql = f"""
+CREATE OR REPLACE FUNCTION {read_model_changes_table}_record() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO {read_model_changes_table} (PROPERTY_ID)
+        SELECT CHANGED.PROPERTY_ID FROM (SELECT (to_jsonb(OLD) ->> TG_ARGV[0])::bigint AS PROPERTY_ID) CHANGED
+        WHERE CHANGED.PROPERTY_ID IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {read_model_changes_table} (PROPERTY_ID)
+        SELECT CHANGED.PROPERTY_ID FROM (SELECT (to_jsonb(NEW) ->> TG_ARGV[0])::bigint AS PROPERTY_ID) CHANGED
+        WHERE CHANGED.PROPERTY_ID IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+# The triggers recording the changes, by name: the table, the updated columns and the column of the property id
+change_triggers = {
+    f"{read_model_changes_table}_reviews": ('JoshuaConsolidatedRawReviews', ['PROPERTY_ID'], 'property_id'),
+    f"{read_model_changes_table}_properties": ('JOSHUAPROPERTIES', source_property_columns, 'airbnb_property_id'),
+}
+
+
+class PropertyReadModel(object):
+    def __init__(self, postgres_helper, refresh_interval=read_model_refresh_interval, on_change=None):
+        """
+        :param postgres_helper: The PostgresHelper to maintain the table with
+        :param refresh_interval: Seconds between two syncs with the source tables, None to never sync in the background
+        :param on_change: Function called when a sync finds the table changed, by this process or another one
+        """
+        self.postgres_helper = postgres_helper
+        self.refresh_interval = refresh_interval
+        self.on_change = on_change
+        self.version = None
+        self.ready = False
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+
+    def ensure_table(self):
+        """
+        Creates the table and its indexes, the columns having the types of the source query, and the capture of the
+        changes of the source tables.
+        :return: True if the change capture was installed by this call, the changes before it having been missed
+        """
+        self.postgres_helper.execute(f"""
+        CREATE TABLE IF NOT EXISTS {read_model_table} AS
+        SELECT *, now()::timestamp AS UPDATED_AT FROM ({read_model_source_sql()}) SOURCE
+        WITH NO DATA
+        """)
+        self.postgres_helper.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {read_model_table}_property_id ON {read_model_table} (PROPERTY_ID)")
+        self.postgres_helper.execute(
+            f"CREATE INDEX IF NOT EXISTS {read_model_table}_location ON {read_model_table} (LATITUDE, LONGITUDE)")
+        # Lets the join of the changed properties find their rows of JOSHUAPROPERTIES despite the cast
+        self.postgres_helper.execute(
+            "CREATE INDEX IF NOT EXISTS JOSHUAPROPERTIES_airbnb_property_id_bigint "
+            "ON JOSHUAPROPERTIES ((CAST(AIRBNB_PROPERTY_ID AS bigint)))")
+        self.postgres_helper.execute(
+            f"CREATE TABLE IF NOT EXISTS {read_model_changes_table} (PROPERTY_ID bigint PRIMARY KEY)")
+        trigger_names = list(change_triggers.keys())
+        installed = self.postgres_helper.query("SELECT COUNT(*) FROM pg_trigger WHERE tgname = ANY(%s)",
+                                               ([name.lower() for name in trigger_names],),
+                                               name='read_model_triggers')[0][0]
+        if installed == len(trigger_names):
+            return False
+        self.postgres_helper.execute(record_change_function_sql)
+        for name, (table, columns, property_id_column) in change_triggers.items():
+            self.postgres_helper.execute(f"""
+            DROP TRIGGER IF EXISTS {name} ON {table};
+            CREATE TRIGGER {name}
+            AFTER INSERT OR DELETE OR UPDATE OF {', '.join(columns)} ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {read_model_changes_table}_record('{property_id_column}')
+            """)
+        return True
+
+    def upsert(self, batch_size=read_model_sync_batch_size):
+        """
+        Consumes the change log: writes the rows of the changed properties that differ from the read model and deletes
+        the changed properties that left the source, in one statement so that a failure leaves the changes logged.
+        :param batch_size: The number of changed properties to apply, None to apply the whole source and clear the log
+        :return: The number of changes consumed, of rows written and of rows deleted
+        """
+        updated_columns = [column for column in read_model_columns if column != 'PROPERTY_ID']
+        assignments = ', '.join(f"{column} = EXCLUDED.{column}" for column in updated_columns)
+        current = ', '.join(f"{read_model_table}.{column}" for column in updated_columns)
+        excluded = ', '.join(f"EXCLUDED.{column}" for column in updated_columns)
+        columns = ', '.join(read_model_columns)
+        if batch_size is None:
+            consumed = f"DELETE FROM {read_model_changes_table} RETURNING PROPERTY_ID"
+            source_condition = ''
+            deleted_condition = ''
+            params = None
+        else:
+            consumed = f"""
+            DELETE FROM {read_model_changes_table}
+            WHERE PROPERTY_ID IN (
+                SELECT PROPERTY_ID FROM {read_model_changes_table}
+                ORDER BY PROPERTY_ID
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING PROPERTY_ID
+            """
+            source_condition = "WHERE JCR.PROPERTY_ID IN (SELECT PROPERTY_ID FROM CHANGED)"
+            deleted_condition = "RM.PROPERTY_ID IN (SELECT PROPERTY_ID FROM CHANGED) AND"
+            params = (batch_size,)
+        return tuple(self.postgres_helper.query(f"""
+        WITH CHANGED AS (
+            {consumed}
+        ),
+        WRITTEN AS (
+            INSERT INTO {read_model_table} ({columns}, UPDATED_AT)
+            SELECT {columns}, now() FROM ({read_model_source_sql(source_condition)}) SOURCE
+            ON CONFLICT (PROPERTY_ID) DO UPDATE
+            SET {assignments}, UPDATED_AT = now()
+            WHERE ({current}) IS DISTINCT FROM ({excluded})
+            RETURNING 1
+        ),
+        DELETED AS (
+            DELETE FROM {read_model_table} RM
+            WHERE {deleted_condition} NOT EXISTS (
+                SELECT 1
+                FROM JoshuaConsolidatedRawReviews JCR
+                JOIN JOSHUAPROPERTIES JP
+                    ON JCR.PROPERTY_ID = CAST(JP.AIRBNB_PROPERTY_ID AS bigint)
+                WHERE JCR.PROPERTY_ID = RM.PROPERTY_ID
+            )
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM CHANGED), (SELECT COUNT(*) FROM WRITTEN), (SELECT COUNT(*) FROM DELETED)
+        """, params, name='read_model_sync')[0])
+
+    def sync(self, full=False):
+        """
+        Applies the logged changes of the source tables to the read model, batch by batch until the log is empty.
+        :param full: True to apply the whole source, when changes may have been missed
+        :return: The number of rows written and the number of rows deleted
+        """
+        started_at = time.monotonic()
+        written = deleted = 0
+        while True:
+            consumed, batch_written, batch_deleted = self.upsert(None if full else read_model_sync_batch_size)
+            written += batch_written
+            deleted += batch_deleted
+            if full or consumed < read_model_sync_batch_size:
+                break
+        print(f"Synced the property read model: {written} properties written, {deleted} removed "
+              f"in {time.monotonic() - started_at:.2f} seconds")
+        self.check_version()
+        return written, deleted
+
+    def check_version(self):
+        """
+        Calls on_change when the table differs from the last check. The changes are consumed by the sync of a single
+        process, so the others tell them from the newest UPDATED_AT, which a write moves, and the count, which a delete
+        moves.
+        """
+        version = tuple(self.postgres_helper.query(f"SELECT MAX(UPDATED_AT), COUNT(*) FROM {read_model_table}",
+                                                   name='read_model_version')[0])
+        changed = self.version is not None and version != self.version
+        self.version = version
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def ensure_ready(self):
+        """
+        Creates and fills the read model on first use and starts syncing it in the background.
+        """
+        if self.ready:
+            return
+        with self.lock:
+            if self.ready:
+                return
+            self.sync(full=self.ensure_table())
+            self.ready = True
+            if self.refresh_interval is not None:
+                self.refresh_thread = threading.Thread(target=self.run_refresh, name='property-read-model-refresh',
+                                                       daemon=True)
+                self.refresh_thread.start()
+
+    def run_refresh(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.sync()
+            except (RuntimeError, Exception) as err:
+                print(f"Failed to sync the property read model: {err}")
@@ -0,0 +1,220 @@
+"""
+In-memory search index for the property autocomplete.
+Every keystroke of the autocomplete used to scan and join both tables with ILIKE '%term%'. Instead, the titles and
+ids of the properties are loaded once into two indexes:
+    - a trigram index, mapping every 3 character substring to the properties containing it, for terms of 3 or more
+      characters; the intersection of the posting sets of the term's trigrams holds every match
+    - a sorted word list, for the 1 and 2 character terms, which only match the beginning of a word
+Matches are ranked: exact id, id prefix, title prefix, word prefix, then any substring, earlier and shorter first.
+search_page pages through them with a cursor made of the rank and the property id of the last match of a page.
+The index is refreshed in the background by applying the difference with the database, not by rebuilding it.
+"""
+import bisect
+import collections
+import heapq
+import re
+import threading
+import time
+from property_read_model import read_model_table
+
+search_result_limit = 10
+max_search_result_limit = 50
+search_index_refresh_interval = 300  # Seconds
+
+_word_pattern = re.compile(r"\w+")
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class PropertySearchIndex(object):
+    def __init__(self, postgres_helper, refresh_interval=search_index_refresh_interval, read_model=None):
+        """
+        :param postgres_helper: The PostgresHelper to load the properties with
+        :param refresh_interval: Seconds between two refreshes from the database, None to never refresh
+        :param read_model: The PropertyReadModel the properties are read from, made ready before they are first read
+        """
+        self.postgres_helper = postgres_helper
+        self.read_model = read_model
+        self.refresh_interval = refresh_interval
+        self.documents = {}  # property id -> (display name, lower case searchable text, lower case title)
+        self.postings = collections.defaultdict(set)  # trigram -> property ids
+        self.words = []  # Sorted (word, property id)
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.refresh_thread = None
+
+    def load_properties(self):
+        """
+        Fetches the (property id, title) of every property that has reviews.
+        """
+        if self.read_model is not None:
+            self.read_model.ensure_ready()
+        query_string = f"""
+        SELECT
+            CAST(PROPERTY_ID AS text), TITLE
+        FROM {read_model_table}
+        WHERE TITLE IS NOT NULL
+        """
+        return {str(row[0]): row[1] for row in self.postgres_helper.query(query_string, name='property_search_titles')}
+
+    def upsert(self, property_id, title):
+        """
+        Adds a property to the index, replacing its previous title.
+        """
+        property_id = str(property_id)
+        with self.lock:
+            self.remove(property_id)
+            for word in self.add(property_id, title):
+                bisect.insort(self.words, word)
+
+    def add(self, property_id, title):
+        """
+        Indexes a property that is not in the index yet, except in the word list.
+        :return: The (word, property id) entries to insert in the word list
+        """
+        title_lower = title.lower()
+        text = property_id + ' ' + title_lower
+        self.documents[property_id] = (f"{property_id}: {title}", text, title_lower)
+        for trigram in trigrams(text):
+            self.postings[trigram].add(property_id)
+        return [(word, property_id) for word in set(_word_pattern.findall(text))]
+
+    def remove(self, property_id):
+        property_id = str(property_id)
+        with self.lock:
+            document = self.documents.pop(property_id, None)
+            if document is None:
+                return
+            for trigram in trigrams(document[1]):
+                self.postings[trigram].discard(property_id)
+                if len(self.postings[trigram]) == 0:
+                    del self.postings[trigram]
+            for word in set(_word_pattern.findall(document[1])):
+                index = bisect.bisect_left(self.words, (word, property_id))
+                if index < len(self.words) and self.words[index] == (word, property_id):
+                    del self.words[index]
+
+    def refresh(self):
+        """
+        Applies the differences with the database to the index.
+        :return: The number of properties added or changed and the number removed
+        """
+        properties = self.load_properties()
+        with self.lock:
+            changed = [(property_id, title) for property_id, title in properties.items()
+                       if property_id not in self.documents or self.documents[property_id][2] != title.lower()]
+            removed = [property_id for property_id in self.documents if property_id not in properties]
+            for property_id in removed + [property_id for property_id, _ in changed]:
+                self.remove(property_id)
+            words = []
+            for property_id, title in changed:
+                words.extend(self.add(property_id, title))
+            if len(words) > 0:
+                # Sorting once is much cheaper than inserting the words of thousands of properties one by one
+                self.words.extend(words)
+                self.words.sort()
+            self.loaded = True
+        return len(changed), len(removed)
+
+    def ensure_loaded(self):
+        """
+        Loads the index on first use and starts refreshing it in the background.
+        """
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            started_at = time.monotonic()
+            changed, _ = self.refresh()
+            print(f"Indexed {changed} properties for search in {time.monotonic() - started_at:.2f} seconds")
+            if self.refresh_interval is not None:
+                self.refresh_thread = threading.Thread(target=self.run_refresh, name='search-index-refresh', daemon=True)
+                self.refresh_thread.start()
+
+    def run_refresh(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except (RuntimeError, Exception) as err:
+                print(f"Failed to refresh the property search index: {err}")
+
+    def rank(self, property_id, term):
+        """
+        Returns the sort key of a matching property, lower is better, None when it does not match.
+        """
+        display_name, text, title_lower = self.documents[property_id]
+        if property_id == term:
+            return 0, 0, len(title_lower)
+        if property_id.startswith(term):
+            return 1, 0, len(title_lower)
+        position = title_lower.find(term)
+        if position == 0:
+            return 2, 0, len(title_lower)
+        if position > 0 and not title_lower[position - 1].isalnum():
+            return 3, position, len(title_lower)
+        if position > 0:
+            return 4, position, len(title_lower)
+        if term in text:
+            return 5, 0, len(title_lower)
+        return None
+
+    def candidates(self, term):
+        if len(term) >= 3:
+            posting_sets = sorted((self.postings.get(trigram, set()) for trigram in trigrams(term)), key=len)
+            return set.intersection(*posting_sets) if len(posting_sets) > 0 else set()
+        # Too short for trigrams, match the beginning of the words
+        matches = set()
+        index = bisect.bisect_left(self.words, (term, ''))
+        while index < len(self.words) and self.words[index][0].startswith(term):
+            matches.add(self.words[index][1])
+            index += 1
+        return matches
+
+    def search(self, term, limit=search_result_limit):
+        """
+        Returns the display names of the best matches of the term.
+        :param term: The text typed by the user
+        :param limit: The number of results, capped to max_search_result_limit
+        """
+        return self.search_page(term, limit)[0]
+
+    def search_page(self, term, limit=search_result_limit, after=None):
+        """
+        Returns a page of the matches of the term, best first. The matches are ordered by their rank and then by
+        property id, so a page starts right after the (rank, property id) of the last match of the previous one.
+        :param limit: The number of results, capped to max_search_result_limit
+        :param after: The cursor of the previous page, None for the first page
+        :return: The display names and the cursor of the next page, None after the last page
+        """
+        self.ensure_loaded()
+        term = (term or '').strip().lower()
+        if len(term) == 0:
+            return [], None
+        limit = max(1, min(limit, max_search_result_limit))
+        after = decode_search_cursor(after) if after is not None else None
+        with self.lock:
+            # Every candidate is ranked, only the best ones are kept in a heap of the size of the page
+            ranked = ((self.rank(property_id, term), property_id) for property_id in self.candidates(term))
+            best = heapq.nsmallest(limit + 1, (match for match in ranked
+                                               if match[0] is not None and (after is None or match > after)))
+            next_cursor = encode_search_cursor(*best[limit - 1]) if len(best) > limit else None
+            return [self.documents[property_id][0] for _, property_id in best[:limit]], next_cursor
+
+
+def encode_search_cursor(key, property_id):
+    return '.'.join(str(value) for value in key) + '.' + property_id
+
+
+def decode_search_cursor(cursor):
+    """
+    :return: The (rank, property id) encoded in a cursor
+    :raise ValueError: When the cursor was not made by encode_search_cursor
+    """
+    values = cursor.split('.')
+    if len(values) != 4 or not all(value.isdigit() for value in values[:3]):
+        raise ValueError(f"Invalid search cursor {cursor}")
+    return tuple(int(value) for value in values[:3]), values[3]
@@ -0,0 +1,141 @@
+"""
+In-memory cache for the results of the Flask API.
+Entries are grouped by namespace (one per endpoint), expire after the time-to-live of their namespace and the least
+recently used entries are evicted once the cache holds max_entries. Entries can be invalidated when the data behind
+them changes, e.g. when a summary is written for a property.
+Persistence is optional: when a snapshot file is given, the live entries are written to it periodically and at exit,
+and loaded back on startup.
+"""
+import atexit
+import collections
+import os
+import pickle
+import threading
+import time
+
+
+class QueryCache(object):
+    def __init__(self, max_entries=10000, ttls=None, default_ttl=300):
+        """
+        :param max_entries: The number of entries kept before the least recently used ones are evicted
+        :param ttls: The time-to-live in seconds of each namespace
+        :param default_ttl: The time-to-live of the namespaces not in ttls
+        """
+        self.max_entries = max_entries
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.entries = collections.OrderedDict()  # (namespace, key) -> (expires_at, value), oldest use first
+        self.lock = threading.Lock()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.evictions = 0
+        self.snapshot_file = None
+        self.snapshot_thread = None
+
+    def get(self, namespace, key):
+        """
+        Returns a tuple of whether the entry was found and its value.
+        """
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end((namespace, key))
+                self.hits[namespace] += 1
+                return True, entry[1]
+            if entry is not None:
+                del self.entries[(namespace, key)]  # Expired
+            self.misses[namespace] += 1
+            return False, None
+
+    def put(self, namespace, key, value):
+        with self.lock:
+            self.entries[(namespace, key)] = (time.time() + self.ttls.get(namespace, self.default_ttl), value)
+            self.entries.move_to_end((namespace, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, namespace, key, loader):
+        """
+        Returns the cached value, or calls loader() and caches what it returns.
+        """
+        found, value = self.get(namespace, key)
+        if not found:
+            value = loader()
+            self.put(namespace, key, value)
+        return value
+
+    def invalidate(self, namespace, key=None):
+        """
+        Removes one entry of a namespace, or all of its entries when no key is given.
+        """
+        with self.lock:
+            if key is not None:
+                self.entries.pop((namespace, key), None)
+            else:
+                for entry_key in [entry_key for entry_key in self.entries if entry_key[0] == namespace]:
+                    del self.entries[entry_key]
+
+    def stats(self):
+        with self.lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'evictions': self.evictions,
+                'namespaces': {namespace: {'hits': self.hits[namespace],
+                                           'misses': self.misses[namespace],
+                                           'ttl': self.ttls.get(namespace, self.default_ttl)}
+                               for namespace in namespaces}
+            }
+
+    def save_snapshot(self):
+        """
+        Writes the live entries to the snapshot file, replacing it atomically.
+        """
+        if self.snapshot_file is None:
+            return
+        now = time.time()
+        with self.lock:
+            live_entries = [(key, entry) for key, entry in self.entries.items() if entry[0] > now]
+        temp_filename = self.snapshot_file + '.tmp'
+        with open(temp_filename, 'wb') as snapshot:
+            pickle.dump(live_entries, snapshot)
+        os.replace(temp_filename, self.snapshot_file)
+
+    def load_snapshot(self):
+        """
+        Loads the entries of the snapshot file that have not expired yet.
+        """
+        if self.snapshot_file is None or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'rb') as snapshot:
+                live_entries = pickle.load(snapshot)
+        except (RuntimeError, Exception) as err:
+            print(f"Ignoring the unreadable query cache snapshot {self.snapshot_file}: {err}")
+            return
+        now = time.time()
+        with self.lock:
+            for key, entry in live_entries[-self.max_entries:]:
+                if entry[0] > now:
+                    self.entries[key] = entry
+
+    def enable_snapshots(self, snapshot_file, interval=300):
+        """
+        Loads the snapshot file, then saves the cache to it every interval seconds and at exit.
+        """
+        self.snapshot_file = snapshot_file
+        self.load_snapshot()
+        atexit.register(self.save_snapshot)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save_snapshot()
+                except (RuntimeError, Exception) as err:
+                    print(f"Failed to save the query cache snapshot: {err}")
+
+        self.snapshot_thread = threading.Thread(target=run, name='query-cache-snapshot', daemon=True)
+        self.snapshot_thread.start()
@@ -0,0 +1,100 @@
+"""
+Token-bucket rate limiting for the OpenAI calls.
+OpenAI enforces two independent limits per model: requests per minute (RPM) and tokens per minute (TPM).
+Each limit is modelled as a bucket that refills continuously at limit / 60 units per second and holds at most
+one minute worth of units. A request may only be sent once both buckets can pay for it.
+"""
+import asyncio
+import random
+import time
+
+
+class TokenBucket(object):
+    def __init__(self, capacity_per_minute, clock=time.monotonic):
+        """
+        Creates a bucket that starts full.
+        :param capacity_per_minute: The number of units that can be spent in a minute
+        :param clock: The monotonic clock to use, overridable for tests
+        """
+        self.capacity = float(capacity_per_minute)
+        self.fill_rate = self.capacity / 60.0  # Units per second
+        self.available = self.capacity
+        self.clock = clock
+        self.last_refill = clock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available = min(self.capacity, self.available + elapsed * self.fill_rate)
+
+    def time_until_available(self, amount):
+        """
+        Returns the number of seconds to wait before the given amount can be spent, zero if it can be spent now.
+        Amounts larger than the bucket are capped to the capacity, so an oversized request waits for a full bucket
+        instead of waiting forever.
+        """
+        self._refill()
+        amount = min(float(amount), self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.fill_rate
+
+    def consume(self, amount):
+        self._refill()
+        self.available -= min(float(amount), self.capacity)
+
+    def drain(self, seconds):
+        """
+        Empties the bucket so that it only becomes usable again after the given number of seconds.
+        Used when the server tells us to back off; concurrent back offs do not add up.
+        """
+        self._refill()
+        self.available = min(self.available, -seconds * self.fill_rate)
+
+
+class RateLimiter(object):
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        """
+        Combines a request bucket and a token bucket.
+        :param requests_per_minute: The RPM limit of the account for the model
+        :param tokens_per_minute: The TPM limit of the account for the model
+        """
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, token_count):
+        """
+        Waits until one request spending token_count tokens is allowed, then pays for it.
+        Waiters are served in arrival order, so a large request can not be starved by smaller ones.
+        """
+        async with self.lock:
+            while True:
+                wait_time = max(self.request_bucket.time_until_available(1),
+                                self.token_bucket.time_until_available(token_count))
+                if wait_time <= 0:
+                    break
+                await asyncio.sleep(wait_time)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(token_count)
+
+    def back_off(self, seconds):
+        """
+        Pauses every sender for the given number of seconds, e.g. after a 429 response.
+        The next acquire() waits for the pause, so callers should not sleep on their own.
+        """
+        self.request_bucket.drain(seconds)
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0, retry_after=None):
+    """
+    Returns the delay before retrying a failed request using exponential backoff with full jitter.
+    :param attempt: Zero-based number of the retry
+    :param base: Delay of the first retry in seconds
+    :param cap: Upper bound of the delay in seconds
+    :param retry_after: The server provided Retry-After in seconds, which takes precedence when present
+    """
+    if retry_after is not None:
+        return min(cap, float(retry_after))
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,140 @@
+"""
+Timing breakdown and opt-in profiling of the requests of the server.
+    - span(name) times a block of the current request, the spans of a request are sent back in a Server-Timing header
+      (db, wrap, split, jsonify...) that the network panel of the browser shows next to the request
+    - the database queries of PostgresHelper are added to the 'db' span by metrics.timed_query
+    - requests slower than slow_request_threshold are printed with their spans
+    - a request carrying the profile_header set to the profile_token, or every request while the profile_flag_file
+      exists, runs under cProfile and its stats are dumped in profile_directory, to be read with pstats or snakeviz.
+      Profiling is switched on and off by touching and removing the flag file, without restarting the server. Without
+      a profile_token the header is ignored, so that anonymous clients cannot slow the server down and fill the disk
+The timer of a request lives in a thread local, so that span() can be used by modules that know nothing of Flask and
+is a no-op outside of a request.
+"""
+import cProfile
+import hmac
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+slow_request_threshold = 0.5  # Seconds, set to None to log no request
+profile_header = 'X-Profile'
+profile_token = os.environ.get('PROFILE_REQUESTS_TOKEN')  # The value of profile_header that asks for a profile
+profile_flag_file = '/tmp/airbnb_summarizer_profile_requests'
+profile_directory = '/tmp/airbnb_summarizer_profiles'
+
+local = threading.local()
+
+
+class RequestTimer(object):
+    def __init__(self, profile=False):
+        """
+        :param profile: Whether to run the request under cProfile
+        """
+        self.started_at = time.perf_counter()
+        self.spans = {}  # Name: [seconds, count], in the order the spans were first entered
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError as err:  # Another request of the process is already being profiled
+                print(f"The request is not profiled: {err}")
+                self.profiler = None
+
+    def add(self, name, seconds):
+        span = self.spans.setdefault(name, [0.0, 0])
+        span[0] += seconds
+        span[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def server_timing(self, total):
+        """
+        :param total: The duration of the request in seconds
+        :return: The value of the Server-Timing header, a metric per span and the total, in milliseconds
+        """
+        entries = []
+        for name, (seconds, count) in self.spans.items():
+            entry = f"{name};dur={seconds * 1000:.2f}"
+            if count > 1:
+                entry += f';desc="{count} calls"'
+            entries.append(entry)
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ', '.join(entries)
+
+    def describe(self):
+        return ', '.join(f"{name} {seconds * 1000:.1f} ms" + (f" x{count}" if count > 1 else '')
+                         for name, (seconds, count) in self.spans.items())
+
+    def dump_profile(self, label):
+        """
+        Writes the stats of the profiled request in profile_directory.
+        :param label: Names the file, e.g. the method and the path of the request
+        :return: The name of the file, None when the request was not profiled
+        """
+        if self.profiler is None:
+            return None
+        os.makedirs(profile_directory, exist_ok=True)
+        safe_label = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_')[:100]
+        filename = os.path.join(profile_directory, f"{int(time.time() * 1000)}_{os.getpid()}_{threading.get_ident()}_"
+                                                   f"{safe_label}.pstats")
+        self.profiler.dump_stats(filename)
+        return filename
+
+
+def profile_requested(headers):
+    """
+    :param headers: The headers of the request
+    :return: Whether the request is to be profiled
+    """
+    if profile_token and hmac.compare_digest(headers.get(profile_header, '').encode(), profile_token.encode()):
+        return True
+    return profile_flag_file is not None and os.path.exists(profile_flag_file)
+
+
+def start(profile=False):
+    """
+    Starts the timer of the request handled by the current thread.
+    """
+    local.timer = RequestTimer(profile)
+    return local.timer
+
+
+def current():
+    return getattr(local, 'timer', None)
+
+
+def finish():
+    """
+    Stops the timer of the current thread and its profiler.
+    :return: The timer, None when no request was being timed
+    """
+    timer = current()
+    local.timer = None
+    if timer is not None:
+        timer.stop_profiler()
+    return timer
+
+
+@contextmanager
+def span(name):
+    """
+    Times a block and adds its duration to the span of that name of the current request.
+    """
+    timer = current()
+    if timer is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started_at)
@@ -0,0 +1,57 @@
+"""
+Normalization of the review text, shared by every export and summarization path.
+    - clean_review() turns the line breaks and tabs into spaces and strips the JSON array quoting of a consolidated
+      review. It stays a chain of str.replace, each a single C-level scan that returns the string as is when there is
+      nothing to replace, which measured faster than one regular expression or a translate table.
+    - printable() keeps the characters of string.printable. Those are all ASCII, so the text is encoded to ASCII
+      dropping everything else and the ASCII control characters are deleted with bytes.translate, instead of looking
+      every character up in string.printable from Python. Text that is already printable is returned as is.
+    - map_reviews() applies either of them to a page of reviews, optionally across worker processes.
+
+    python benchmarks/review_text_benchmark.py
+"""
+import string
+from concurrent.futures import ProcessPoolExecutor
+
+normalize_processes = 1  # Worker processes of map_reviews, 1 to normalize in the calling process
+min_parallel_reviews = 64  # Smaller pages are not worth shipping to the worker processes
+
+# The ASCII characters missing from string.printable, deleted by printable()
+_non_printable_ascii = bytes(code for code in range(128) if chr(code) not in string.printable)
+_pools = {}
+
+
+def clean_review(text):
+    """
+    Cleans up a consolidated review, as the summarizer always did.
+    """
+    return text.replace('\n', ' ').replace('\t', ' ').replace('["', '').replace('"]', '').replace('\\"', '"')
+
+
+def printable(text):
+    """
+    Keeps the characters of a text that are in string.printable, in order.
+    """
+    if text.isascii() and text.isprintable():
+        return text
+    return text.encode('ascii', 'ignore').translate(None, _non_printable_ascii).decode('ascii')
+
+
+def get_pool(processes):
+    pool = _pools.get(processes)
+    if pool is None:
+        pool = _pools[processes] = ProcessPoolExecutor(processes)
+    return pool
+
+
+def map_reviews(function, texts, processes=normalize_processes):
+    """
+    Applies clean_review or printable to a page of reviews.
+    :param function: A module-level function, so that it can be sent to the worker processes
+    :param texts: The reviews
+    :param processes: The number of worker processes, 1 to run in the calling process
+    :return: The list of the results, in the order of texts
+    """
+    if processes <= 1 or len(texts) < min_parallel_reviews:
+        return [function(text) for text in texts]
+    return list(get_pool(processes).map(function, texts, chunksize=max(1, len(texts) // (4 * processes))))
@@ -0,0 +1,156 @@
+"""
+Buffered write-back of the generated summaries and critical reviews.
+Saving one property at a time costs a round trip and a commit per row, which becomes the bottleneck once the
+summaries are generated concurrently. The writer collects the results in memory and a background thread writes them
+with one UPDATE ... FROM (VALUES ...) statement per page of rows, whenever flush_size results are pending or every
+flush_interval seconds, and once more when the process exits.
+"""
+import atexit
+import threading
+import weakref
+from summary_watermarks import ensure_watermark_table, mark_covered_reviews_sql
+
+summary_flush_size = 500
+summary_flush_interval = 5.0  # Seconds
+
+# The writers still open, closed when the process exits. The set holds them weakly, so that the writers of the
+# summarizers that are dropped can be collected; a started writer is kept alive by its thread until it is closed.
+_open_writers = weakref.WeakSet()
+_close_hook_registered = False
+_close_hook_lock = threading.Lock()
+
+# The column every kind of generated text is saved to
+review_columns = {
+    'summary': 'SUMMARY',
+    'critical_review': 'CRITICAL_REVIEW',
+}
+
+
+def _close_open_writers():
+    for writer in list(_open_writers):
+        writer.close()
+
+
+def _register_close_hook():
+    """
+    Registers the exit hook of the writers once, when the first one is created. The connection pool of PostgresHelper
+    exists by then, and atexit runs the hooks in reverse order, so the writers are flushed before the pool is closed.
+    """
+    global _close_hook_registered
+    with _close_hook_lock:
+        if not _close_hook_registered:
+            atexit.register(_close_open_writers)
+            _close_hook_registered = True
+
+
+def bulk_update_reviews(postgres_helper, kind, rows, mark_summaries=True):
+    """
+    Saves many generated texts of one kind in a single transaction. The summaries that are not empty get the mark of
+    the reviews they cover in the same statement.
+    :param postgres_helper: The PostgresHelper to write with
+    :param kind: 'summary' or 'critical_review'
+    :param rows: A list of (property_id, text)
+    :param mark_summaries: False when the caller records the marks of the summaries itself
+    """
+    if len(rows) == 0:
+        return
+    sql = f"""
+    UPDATE JoshuaConsolidatedRawReviews AS JCR
+    SET {review_columns[kind]} = RESULTS.TEXT
+    FROM (VALUES %s) AS RESULTS (PROPERTY_ID, TEXT)
+    WHERE JCR.PROPERTY_ID = RESULTS.PROPERTY_ID
+    """
+    if kind == 'summary' and mark_summaries:
+        ensure_watermark_table(postgres_helper)
+        sql = f"""
+        WITH SAVED AS ({sql} RETURNING JCR.PROPERTY_ID, RESULTS.TEXT)
+        {mark_covered_reviews_sql('SELECT PROPERTY_ID FROM SAVED WHERE length(TEXT) > 0')}
+        """
+    postgres_helper.execute_values(sql, rows, template='(%s::bigint, %s::text)')
+
+
+class BufferedReviewWriter(object):
+    def __init__(self, postgres_helper, flush_size=summary_flush_size, flush_interval=summary_flush_interval):
+        """
+        :param postgres_helper: The PostgresHelper to write with
+        :param flush_size: The number of pending results that triggers a flush
+        :param flush_interval: The maximum number of seconds a result stays in memory
+        """
+        self.postgres_helper = postgres_helper
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {kind: {} for kind in review_columns}  # Keyed by property id, the latest text wins
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.rows_written = 0
+        self.mark_summaries = True
+        _open_writers.add(self)
+        _register_close_hook()
+
+    def add(self, property_id, kind, text):
+        """
+        Queues a generated text, it is written to the database by the background thread.
+        :param property_id: The property the text belongs to
+        :param kind: 'summary' or 'critical_review'
+        :param text: The generated text
+        """
+        with self.pending_lock:
+            self.pending[kind][int(property_id)] = text
+            pending_count = sum(len(rows) for rows in self.pending.values())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='review-writer', daemon=True)
+                self.thread.start()
+        if pending_count >= self.flush_size:
+            self.flush_requested.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.flush_requested.wait(self.flush_interval)
+            self.flush_requested.clear()
+            try:
+                self.flush()
+            except (RuntimeError, Exception) as err:
+                print(f"Failed to save the generated reviews, will retry in {self.flush_interval} seconds: {err}")
+
+    def flush(self):
+        """
+        Writes everything that is pending. Results that fail to be written are queued again, unless a newer text
+        for the same property arrived in the meantime.
+        """
+        with self.flush_lock:
+            with self.pending_lock:
+                batches = self.pending
+                self.pending = {kind: {} for kind in review_columns}
+
+            error = None
+            for kind, rows in batches.items():
+                if error is None:
+                    try:
+                        bulk_update_reviews(self.postgres_helper, kind, list(rows.items()), self.mark_summaries)
+                        self.rows_written += len(rows)
+                        continue
+                    except (RuntimeError, Exception) as err:
+                        error = err
+                with self.pending_lock:
+                    for property_id, text in rows.items():
+                        self.pending[kind].setdefault(property_id, text)
+            if error is not None:
+                raise error
+
+    def close(self):
+        """
+        Stops the background thread and writes the remaining results.
+        """
+        _open_writers.discard(self)
+        self.stopped.set()
+        self.flush_requested.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        try:
+            self.flush()
+        except (RuntimeError, Exception) as err:
+            lost_count = sum(len(rows) for rows in self.pending.values())
+            print(f"Failed to save {lost_count} generated reviews on shutdown: {err}")
@@ -4,16 +4,28 @@
 This is the main Flask server.
 '''
 from flask import Flask, jsonify
-from flask import abort, request
+from flask import abort, request, Response, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
-import os
+import json
+import math
 import sys
-import pickle
 import logging
+from contextlib import closing
+from urllib.parse import urlencode
 from textwrap3 import wrap
 from PostgresHelper import PostgresHelper
-from airdna_review_summarizer import AirDNAReviewSummarizer
+from query_cache import QueryCache
+from property_search import PropertySearchIndex, search_result_limit
+from property_map import PropertyMapIndex, viewport_marker_limit
+from payload_encoding import columnar, encode_payload, payload_response, streamed_response
+from property_read_model import PropertyReadModel, read_model_table
+from property_neighbors import PropertyNeighborIndex, max_neighbors, max_radius_km
+from summary_jobs import SummaryJobExecutor
+import metrics
+import request_timing
+from request_timing import span
+from airbnb_review_summarizer import AirBnbReviewSummarizer
 import speed_distance as sd
 
 # Global variables for this file
@@ -22,8 +34,72 @@ app = Flask(__name__,
             static_folder='web/static',
             template_folder='web/templates')
 cors = CORS(app, resources={r"/v1/api/*": {"origins": "*"}})
-query_cache = {}
-query_cache_file_store = 'query_cache.txt'
+query_cache_max_entries = 10000
+query_cache_ttls = {  # Seconds
+    'review_summary': 24 * 3600,  # Complete summaries only, invalidated when the summary is written
+    'property_list': 600
+}
+property_list_fields = ['property_id', 'title', 'bedrooms', 'bathrooms', 'property_type', 'zipcode', 'city', 'city_id',
+                        'state', 'latitude', 'longitude']
+list_stream_min_rows = 5000  # Larger pages of the property list are streamed instead of cached
+list_default_limit = list_stream_min_rows  # The default page is cached, it is streamed only when asked for more
+list_max_columnar_limit = list_stream_min_rows  # Columnar pages are built in memory, larger limits are capped
+list_stream_flush_rows = 500  # Properties per chunk of a streamed page
+query_cache_file_store = 'query_cache.pickle'  # Set to None to keep the cache in memory only
+query_cache = QueryCache(max_entries=query_cache_max_entries, ttls=query_cache_ttls)
+postgres = PostgresHelper()  # Shares the connection pool of the process across requests
+review_summarizer = AirBnbReviewSummarizer()
+# The property list reads the read model, its cached pages are dropped whenever a sync changes it
+property_read_model = PropertyReadModel(postgres, on_change=lambda: query_cache.invalidate('property_list'))
+property_search = PropertySearchIndex(postgres, read_model=property_read_model)
+property_map = PropertyMapIndex(postgres, read_model=property_read_model)
+property_neighbors = PropertyNeighborIndex(postgres, read_model=property_read_model)
+
+
+def on_summary_saved(property_id):
+    """
+    Drops the cached summary of the property and the cached pages of the property list once its summary job completes.
+    """
+    query_cache.invalidate('review_summary', property_id)
+    query_cache.invalidate('property_list')
+
+
+summary_jobs = SummaryJobExecutor(review_summarizer, on_complete=on_summary_saved)
+
+
+@app.before_request
+def start_request_timer():
+    request_timing.start(profile=request_timing.profile_requested(request.headers))
+
+
+@app.after_request
+def observe_request(response):
+    """
+    Records the latency of the request by route, so that the ids in the URLs do not multiply the series, returns its
+    spans in a Server-Timing header, logs it when it is slow and dumps its profile when it was profiled.
+    """
+    timer = request_timing.finish()
+    if timer is not None:
+        elapsed = timer.elapsed()
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_http_request(request.method, route, response.status_code, elapsed)
+        response.headers['Server-Timing'] = timer.server_timing(elapsed)
+        threshold = request_timing.slow_request_threshold
+        if threshold is not None and elapsed > threshold:
+            print(f"Slow request: {request.method} {request.full_path.rstrip('?')} {response.status_code} "
+                  f"in {elapsed * 1000:.1f} ms ({timer.describe()})")
+        profile_filename = timer.dump_profile(f"{request.method}_{request.path}")
+        if profile_filename is not None:
+            print(f"Profile of {request.method} {request.path} is saved in file: {profile_filename}")
+    return response
+
+
+@app.teardown_request
+def stop_request_timer(err=None):
+    """
+    Stops the timer and the profiler of a request that failed before its response was made.
+    """
+    request_timing.finish()
 
 
 @app.route('/')
@@ -54,107 +130,300 @@ def get_review_summary(property_id):
     :param property_id: The property Id
     :return: The results of the query as a dictionary
     """
-    review_summarizer = AirDNAReviewSummarizer()
-    if not review_summarizer.is_summary_available(property_id):
-        print(f"New property encountered. Summarizing reviews for property Id {property_id}. Please wait...")
-        review_summarizer.fetch_save_summary_of_reviews_for_single_property(property_id)
-        print(f"Summary of reviews are now saved for property id {property_id}")
-
-    postgres = PostgresHelper()
-    query_string = f"SELECT" \
-                   f"    PROPERTY_ID," \
-                   f"    CONSOLIDATED_REVIEW," \
-                   f"    SUMMARY, " \
-                   f"    CRITICAL_REVIEW " \
-                   f"FROM JoshuaConsolidatedRawReviews " \
-                   f"WHERE PROPERTY_ID = {property_id}"
-    if query_string in query_cache:
-        rows = query_cache[query_string]  # Get from cache
-    else:
-        rows = postgres.query(query_string)
-        saveObjectLocally(query_cache_file_store)
+    if not property_id.isdigit():
+        abort(400)
+    with span('cache'):
+        found, response = query_cache.get('review_summary', int(property_id))
+    if found:
+        with span('jsonify'):
+            return jsonify(response)
 
-    output = {'property_id': rows[0][0], 'ai_generated_summary': rows[0][2]}
-    all_lines_of_review = rows[0][3].split('\n')
-    final_lines = []
-    for line in all_lines_of_review:
-        wrapped_lines = wrap(line, 100)
-        line_counter = 0
-        for wrapped_line in wrapped_lines:
-            if line_counter > 0:
-                final_lines.append('  ' + wrapped_line)
-            else:
-                final_lines.append(wrapped_line)
-            line_counter += 1
+    # New properties are summarized in the background, the page polls the status URL until the summary is saved
+    job = summary_jobs.status(property_id)
+    in_flight = job is not None and job['status'] in ['pending', 'running']
+    if in_flight or not review_summarizer.is_summary_available(property_id):
+        raw_review = review_summarizer.get_consolidated_reviews_for_single_property(property_id)
+        if raw_review == '':
+            abort(404)  # No reviews to summarize
+        response = {
+            'title': f"Summary and Raw review for property Id {property_id}",
+            'status_url': f"/v1/api/reviews/summary/{property_id}/status",
+            'data': {
+                'property_id': int(property_id),
+                'ai_generated_summary': None,
+                'ai_generated_critical_review': None,
+                'reviews': raw_review.split('|||')
+            }
+        }
+        retry_delay = summary_jobs.retry_delay(job)
+        if retry_delay > 0:
+            # The last job failed recently, it is retried once the backoff is over rather than on every poll
+            response.update({'status': 'failed', 'error': job['error'], 'retry_after': math.ceil(retry_delay)})
+            return jsonify(response), 503, {'Retry-After': str(math.ceil(retry_delay))}
+        if not in_flight:
+            print(f"New property encountered. Summarizing reviews for property Id {property_id} in the background.")
+            job = summary_jobs.submit(property_id)
+        response['status'] = job['status']
+        return jsonify(response), 202
 
-    output['ai_generated_critical_review'] = '\n'.join(final_lines)
-    output['reviews'] = rows[0][1].split('|||')
+    query_string = "SELECT" \
+                   "    PROPERTY_ID," \
+                   "    CONSOLIDATED_REVIEW," \
+                   "    SUMMARY, " \
+                   "    CRITICAL_REVIEW " \
+                   "FROM JoshuaConsolidatedRawReviews " \
+                   "WHERE PROPERTY_ID = $1"
+    rows = postgres.query_prepared('review_summary_by_property_id', query_string, (int(property_id),))
 
-    return jsonify({
+    output = {'property_id': rows[0][0], 'ai_generated_summary': rows[0][2]}
+    with span('wrap'):
+        output['ai_generated_critical_review'] = wrap_critical_review(rows[0][3])
+    with span('split'):
+        output['reviews'] = rows[0][1].split('|||')
+
+    response = {
         'title': f"Summary and Raw review for property Id {property_id}",
-        'query': query_string,
+        'status': 'completed',
         'data': output
-    })
+    }
+    if rows[0][2] is not None and rows[0][3] is not None:
+        # A property whose critical review is still being written is not cached: the process writing it only
+        # invalidates its own cache, the others would serve the incomplete summary until the entry expires
+        query_cache.put('review_summary', int(property_id), response)
+    with span('jsonify'):
+        return jsonify(response)
+
+
+# curl -i -N http://localhost:5000/v1/api/reviews/summary/46394374/stream
+@app.route('/v1/api/reviews/summary/<string:property_id>/stream', methods=['GET'])
+def stream_review_summary(property_id):
+    """
+    Streams the summary and the critical review of a property as Server-Sent Events while they are generated.
+    Events: 'reviews' with the raw reviews, 'summary' and 'critical_review' with text deltas, 'pending' when a
+    background job is already summarizing the property, 'failed' and finally 'done'.
+    Properties that are already summarized get their texts in one event each. When the client disconnects, the
+    generation is finished and saved by summary_jobs.
+    :param property_id: The property Id
+    """
+    if not property_id.isdigit():
+        abort(400)
+    raw_review = review_summarizer.get_consolidated_reviews_for_single_property(property_id)
+    if raw_review == '':
+        abort(404)  # No reviews to summarize
+
+    def generate():
+        yield server_sent_event('reviews', {'property_id': int(property_id), 'reviews': raw_review.split('|||')})
+
+        job = summary_jobs.status(property_id)
+        in_flight = job is not None and job['status'] in ['pending', 'running']
+        if not in_flight and review_summarizer.is_summary_available(property_id):
+            query_string = "SELECT SUMMARY, CRITICAL_REVIEW FROM JoshuaConsolidatedRawReviews WHERE PROPERTY_ID = $1"
+            rows = postgres.query_prepared('summaries_by_property_id', query_string, (int(property_id),))
+            yield server_sent_event('summary', {'delta': rows[0][0] or ''})
+            yield server_sent_event('critical_review', {'delta': wrap_critical_review(rows[0][1])})
+            yield server_sent_event('done', {'status': 'completed'})
+            return
+
+        retry_delay = summary_jobs.retry_delay(job)
+        if retry_delay > 0:
+            yield server_sent_event('failed', {'error': job['error'], 'retry_after': math.ceil(retry_delay)})
+            return
+
+        if not summary_jobs.claim(property_id):
+            yield server_sent_event('pending', {'status_url': f"/v1/api/reviews/summary/{property_id}/status"})
+            return
+
+        deltas = review_summarizer.stream_summary_of_reviews_for_single_property(property_id)
+        error = None
+        handed_off = False
+        try:
+            for kind, delta in deltas:
+                yield server_sent_event(kind, {'delta': delta})
+            yield server_sent_event('done', {'status': 'completed'})
+        except GeneratorExit:
+            # The client left, the texts are still generated and saved in the background
+            summary_jobs.finish(property_id, deltas)
+            handed_off = True
+            raise
+        except (RuntimeError, Exception) as err:
+            error = str(err)
+            yield server_sent_event('failed', {'error': error})
+        finally:
+            if not handed_off:
+                summary_jobs.release(property_id, error)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# curl -i -H "Content-Type: application/json" http://localhost:5000/v1/api/reviews/summary/46394374/status
+@app.route('/v1/api/reviews/summary/<string:property_id>/status', methods=['GET'])
+def get_review_summary_status(property_id):
+    """
+    Gets the status of the background summarization of a property
+    :param property_id: The property Id
+    :return: The status, one of pending, running, completed, failed or not_found, and for a failed job the seconds
+    after which it is retried
+    """
+    if not property_id.isdigit():
+        abort(400)
+    job = summary_jobs.status(property_id)
+    if job is None:
+        status = 'completed' if review_summarizer.is_summary_available(property_id) else 'not_found'
+        job = {'property_id': int(property_id), 'status': status, 'error': None}
+    elif job['status'] == 'failed':
+        job['retry_after'] = math.ceil(summary_jobs.retry_delay(job))
+    return jsonify(job)
 
 
 # curl -i -H "Content-Type: application/json" http://localhost:5000/v1/api/property/seek?term=cottage
 @app.route('/v1/api/property/seek', methods=['GET'])
 def seek_property():
     """
-    Gets the summary along with the raw reviews for a given property
-    :return: The results of the query as a dictionary
+    Finds the properties whose id or title match the term typed in the autocomplete, best matches first
+    The next page, if any, is linked in the Link header and its cursor is sent in X-Next-Cursor, to be passed as after.
+    :return: At most limit property names, capped to max_search_result_limit
     """
-    term = request.args.get('term')
-    postgres = PostgresHelper()
-    query_string = f"""
-    SELECT
-    AIRBNB_PROPERTY_ID || ': ' || TITLE AS PROPERTY_NAME
-    FROM JoshuaConsolidatedRawReviews JCR
-    LEFT JOIN JOSHUAPROPERTIES JP
-        ON JCR.PROPERTY_ID = CAST(JP.AIRBNB_PROPERTY_ID AS bigint)
-    WHERE (jp.AIRBNB_PROPERTY_ID::VARCHAR ILIKE '%{term}%' OR jp.TITLE ILIKE '%{term}%')
-    """
-    if query_string in query_cache:
-        rows = query_cache[query_string]  # Get from cache
-    else:
-        rows = postgres.query(query_string)
-        saveObjectLocally(query_cache_file_store)
-
-    property_names = []
-    for row in rows:
-        property_names.append(row[0])
-
-    return jsonify(property_names)
+    term = request.args.get('term') or ''
+    limit = request.args.get('limit', default=search_result_limit, type=int)
+    with span('search'):
+        try:
+            results, next_cursor = property_search.search_page(term, limit, request.args.get('after'))
+        except ValueError:
+            abort(400)
+    response = jsonify(results)
+    if next_cursor is not None:
+        response.headers['Link'] = f"<{next_page_url(next_cursor)}>; rel=\"next\""
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
 
 
 # curl -i -H "Content-Type: application/json" http://localhost:5000/v1/api/property/list/all
 @app.route('/v1/api/property/list/all', methods=['GET'])
 def list_all_properties_with_lat_lon():
-    limit = request.args.get('limit') or 10000
-    postgres = PostgresHelper()
+    """
+    Gets a page of the properties with their location, by property id, as one dict per property or, with
+    format=columnar, as one array per field. next_cursor is passed as after to get the next page, it is null after the
+    last one.
+    Pages of up to list_stream_min_rows, which the default limit is, are compressed as negotiated and carry an ETag,
+    reloads of unchanged data get a 304. Larger pages of dicts are streamed while they are read from the database,
+    columnar pages are capped to list_max_columnar_limit properties.
+    """
+    limit = request.args.get('limit', default=list_default_limit, type=int)
+    layout = request.args.get('format', default='rows')
+    after = request.args.get('after')
+    if layout not in ['rows', 'columnar'] or limit is None or limit < 1 or (after is not None and not after.isdigit()):
+        abort(400)
+    after = int(after) if after is not None else None
+    if layout == 'columnar':
+        limit = min(limit, list_max_columnar_limit)
+    property_read_model.ensure_ready()
+    if layout == 'rows' and limit > list_stream_min_rows:
+        return streamed_response(stream_property_list(limit, after))
+    with span('cache'):
+        encoded_payload = query_cache.get_or_load('property_list', (limit, layout, after),
+                                                  lambda: encode_property_list(limit, layout, after))
+    with span('compress'):
+        response = payload_response(encoded_payload)
+    next_cursor = encoded_payload.get('next_cursor')
+    if next_cursor is not None:
+        response.headers['Link'] = f"<{next_page_url(next_cursor)}>; rel=\"next\""
+    return response
+
+
+def encode_property_list(limit, layout, after):
+    payload = load_property_list(limit, layout, after)
+    with span('encode'):
+        encoded_payload = encode_payload(payload)
+    encoded_payload['next_cursor'] = payload['next_cursor']
+    return encoded_payload
+
+
+def property_list_page_query(limit, after):
+    """
+    Builds the query of a page of the property list, which reads one row more than limit to tell whether another
+    page follows.
+    :param after: The property id the page starts after, None for the first page
+    :return: The query and its parameters
+    """
+    property_id_condition = 'AND PROPERTY_ID > %s' if after is not None else ''
     query_string = f"""
     SELECT
-        JP.AIRBNB_PROPERTY_ID,
-        JP.TITLE,
-        COALESCE(JP.BEDROOMS,0)::INT,
-        COALESCE(JP.BATHROOMS,0)::INT,
-        JP.PROPERTY_TYPE,
-        JP.ZIPCODE,
-        JP.CITY_NAME,
-        JP.CITY_ID,
-        JP.STATE_NAME,
-        JP.LATITUDE::FLOAT,
-        JP.LONGITUDE::FLOAT
-    FROM JoshuaConsolidatedRawReviews JCR
-    LEFT JOIN JOSHUAPROPERTIES JP
-        ON JCR.PROPERTY_ID = CAST(JP.AIRBNB_PROPERTY_ID AS bigint)
-    LIMIT {limit}
-    """
-    if query_string in query_cache:
-        rows = query_cache[query_string]  # Get from cache
+        CAST(PROPERTY_ID AS text),
+        TITLE,
+        BEDROOMS,
+        BATHROOMS,
+        PROPERTY_TYPE,
+        ZIPCODE,
+        CITY_NAME,
+        CITY_ID,
+        STATE_NAME,
+        LATITUDE,
+        LONGITUDE
+    FROM {read_model_table}
+    WHERE LATITUDE IS NOT NULL AND LONGITUDE IS NOT NULL
+    {property_id_condition}
+    ORDER BY PROPERTY_ID
+    LIMIT %s
+    """
+    params = (after, limit + 1) if after is not None else (limit + 1,)
+    return query_string, params
+
+
+def property_list_row(row):
+    return {
+        'property_id': row[0],
+        'title': row[1],
+        'bedrooms': row[2],
+        'bathrooms': row[3],
+        'property_type': row[4],
+        'zipcode': row[5],
+        'city': row[6],
+        'city_id': row[7],
+        'state': row[8],
+        'latitude': float(row[9]),
+        'longitude': float(row[10])
+    }
+
+
+def property_list_info(min_lat, min_lon, max_lat, max_lon):
+    """
+    Computes the viewport that shows the properties of a page.
+    """
+    if min_lat > max_lat:  # An empty page
+        return {'center': {'lat': 0.0, 'lon': 0.0}, 'bottom_left': {'lat': -90.0, 'lon': -180.0},
+                'top_right': {'lat': 90.0, 'lon': 180.0}, 'zoom': 2}
+    if min_lat == max_lat and min_lon == max_lon:
+        zoom_factor = 10
     else:
-        rows = postgres.query(query_string)
-        saveObjectLocally(query_cache_file_store)
+        zoom_factor = int(1200000/sd.distance_great_circle(min_lat, min_lon, max_lat, max_lon))
+    return {
+        'center': {
+            'lat': (max_lat + min_lat) / 2.0,
+            'lon': (max_lon + min_lon) / 2.0
+        },
+        'bottom_left': {
+            'lat': min_lat,
+            'lon': min_lon
+        },
+        'top_right': {
+            'lat': max_lat,
+            'lon': max_lon
+        },
+        'zoom': min(max(6, zoom_factor), 12)
+    }
+
+
+def load_property_list(limit, layout, after=None):
+    """
+    Queries a page of the properties of the list and computes the viewport that shows all of them.
+    :param layout: 'rows' or 'columnar'
+    :param after: The property id the page starts after, None for the first page
+    """
+    query_string, params = property_list_page_query(limit, after)
+    rows = postgres.query(query_string, params, name='property_list_page')
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    rows = rows[:limit]
 
     global_min_lat = sys.float_info.max
     global_min_lon = sys.float_info.max
@@ -162,84 +431,237 @@ def list_all_properties_with_lat_lon():
     global_max_lon = -sys.float_info.max
 
     output_rows = []
-    for row in rows:
-        latitude = float(row[9])
-        longitude = float(row[10])
-
-        if latitude > global_max_lat:
-            global_max_lat = latitude
-        if latitude < global_min_lat:
-            global_min_lat = latitude
-        if longitude > global_max_lon:
-            global_max_lon = longitude
-        if longitude < global_min_lon:
-            global_min_lon = longitude
-
-        output_rows.append({
-            'property_id': row[0],
-            'title': row[1],
-            'bedrooms': row[2],
-            'bathrooms': row[3],
-            'property_type': row[4],
-            'zipcode': row[5],
-            'city': row[6],
-            'city_id': row[7],
-            'state': row[8],
-            'latitude': float(row[9]),
-            'longitude': float(row[10])
-        })
-
-    global_mid_lon = (global_max_lon + global_min_lon) / 2.0
-    global_mid_lat = (global_max_lat + global_min_lat) / 2.0
-
-    if global_min_lat == global_max_lat and global_min_lon == global_max_lon:
-        zoom_factor = 10
+    with span('rows'):
+        for row in rows:
+            latitude = float(row[9])
+            longitude = float(row[10])
+
+            if latitude > global_max_lat:
+                global_max_lat = latitude
+            if latitude < global_min_lat:
+                global_min_lat = latitude
+            if longitude > global_max_lon:
+                global_max_lon = longitude
+            if longitude < global_min_lon:
+                global_min_lon = longitude
+
+            output_rows.append(property_list_row(row))
+
+    response = {
+        'title': f"List of all properties",
+        'info': property_list_info(global_min_lat, global_min_lon, global_max_lat, global_max_lon),
+        'next_cursor': next_cursor
+    }
+    if layout == 'columnar':
+        response['format'] = 'columnar'
+        with span('columnar'):
+            response.update(columnar(output_rows, property_list_fields, ['property_type', 'city', 'state']))
     else:
-        zoom_factor = int(1200000/sd.distance_great_circle(global_min_lat, global_min_lon, global_max_lat, global_max_lon))
+        response['data'] = output_rows
+    return response
+
+
+def stream_property_list(limit, after=None):
+    """
+    Writes a page of the property list as JSON while its rows are read from the database, list_stream_flush_rows
+    properties per chunk. The viewport and the cursor of the next page follow the data.
+    """
+    query_string, params = property_list_page_query(limit, after)
+    rows = postgres.stream(query_string, params, name='property_list_page')
+    with closing(rows):
+        yield '{"title":"List of all properties","data":['
+        min_lat = min_lon = sys.float_info.max
+        max_lat = max_lon = -sys.float_info.max
+        count = 0
+        next_cursor = None
+        last_property_id = None
+        chunk = []
+        for row in rows:
+            if count == limit:
+                next_cursor = last_property_id
+                break
+            output_row = property_list_row(row)
+            min_lat = min(min_lat, output_row['latitude'])
+            max_lat = max(max_lat, output_row['latitude'])
+            min_lon = min(min_lon, output_row['longitude'])
+            max_lon = max(max_lon, output_row['longitude'])
+            chunk.append(output_row)
+            last_property_id = output_row['property_id']
+            count += 1
+            if len(chunk) >= list_stream_flush_rows:
+                # The rows of the chunk without the brackets of their array
+                yield (',' if count > len(chunk) else '') + json.dumps(chunk, separators=(',', ':'))[1:-1]
+                chunk = []
+        if len(chunk) > 0:
+            yield (',' if count > len(chunk) else '') + json.dumps(chunk, separators=(',', ':'))[1:-1]
+        info = property_list_info(min_lat, min_lon, max_lat, max_lon)
+        yield f'],"info":{json.dumps(info, separators=(",", ":"))},"next_cursor":{json.dumps(next_cursor)}}}'
+
+
+# curl -i -H "Content-Type: application/json" "http://localhost:5000/v1/api/property/viewport?south=34.0&west=-118.5&north=34.2&east=-118.1&zoom=12"
+@app.route('/v1/api/property/viewport', methods=['GET'])
+def get_properties_in_viewport():
+    """
+    Gets the properties visible in the map, clustered when there are more than limit of them.
+    Without a bounding box, the viewport that shows every property is used and returned in info.
+    :return: The markers and clusters of the viewport
+    """
+    bounds = [request.args.get(name, type=float) for name in ['south', 'west', 'north', 'east']]
+    zoom = request.args.get('zoom', type=int)
+    limit = request.args.get('limit', default=viewport_marker_limit, type=int)
+    if all(bound is None for bound in bounds):
+        property_map.ensure_loaded()
+        info = property_map.info
+        bounds = [info['bottom_left']['lat'], info['bottom_left']['lon'], info['top_right']['lat'], info['top_right']['lon']]
+        zoom = info['zoom'] if zoom is None else zoom
+    elif any(bound is None for bound in bounds) or zoom is None:
+        abort(400)
+    south, west, north, east = bounds
+    result = property_map.viewport(south, west, north, east, zoom, max(1, limit))
 
     return jsonify({
-        'title': f"List of all properties",
-        'query': query_string,
-        'data': output_rows,
+        'title': "Properties in viewport",
+        'data': result['data'],
+        'clusters': result['clusters'],
         'info': {
-            'center': {
-                'lat': global_mid_lat,
-                'lon': global_mid_lon
-            },
-            'bottom_left': {
-                'lat': global_min_lat,
-                'lon': global_min_lon
-            },
-            'top_right': {
-                'lat': global_max_lat,
-                'lon': global_max_lon
-            },
-            'zoom': min(max(6, zoom_factor), 12)
+            'center': {'lat': (south + north) / 2.0, 'lon': (west + east) / 2.0},
+            'bottom_left': {'lat': south, 'lon': west},
+            'top_right': {'lat': north, 'lon': east},
+            'zoom': zoom,
+            'count': result['count'],
+            'clustered': result['clustered']
         }
     })
 
-def saveObjectLocally(dumpfile):
+
+# curl -i -H "Content-Type: application/json" "http://localhost:5000/v1/api/property/nearby?property_id=46394374&radius_km=5&bedrooms=2"
+@app.route('/v1/api/property/nearby', methods=['GET'])
+def get_properties_within_radius():
     """
-    Saves the in-memory data to a file.
+    Gets the properties within radius_km of a property or of a lat/lon, closest first.
+    Optional filters: bedrooms, property_type.
+    :return: The number of matching properties and the closest limit of them
     """
-    if len(query_cache) > 0:
-        with open(dumpfile, 'wb') as query_cache_file:
-            pickle.dump(query_cache, query_cache_file)
+    property_id, latitude, longitude = neighbor_query_center()
+    radius_km = request.args.get('radius_km', default=5.0, type=float)
+    limit = request.args.get('limit', default=100, type=int)
+    if radius_km is None or radius_km <= 0 or radius_km > max_radius_km:
+        abort(400)
+    count, neighbors = property_neighbors.within_radius(latitude, longitude, radius_km,
+                                                        limit=max(1, min(limit, max_neighbors)),
+                                                        bedrooms=request.args.get('bedrooms', type=int),
+                                                        property_type=request.args.get('property_type'),
+                                                        exclude_property_id=property_id)
+    return jsonify({
+        'title': f"Properties within {radius_km} km",
+        'data': neighbors,
+        'info': {'center': {'lat': latitude, 'lon': longitude}, 'property_id': property_id,
+                 'radius_km': radius_km, 'count': count}
+    })
 
 
-def loadFromTextFile(dumpfile):
+# curl -i -H "Content-Type: application/json" "http://localhost:5000/v1/api/property/nearest?property_id=46394374&k=20"
+@app.route('/v1/api/property/nearest', methods=['GET'])
+def get_nearest_properties():
     """
-    Loads previously saved data from file to memory.
+    Gets the k properties closest to a property or to a lat/lon, closest first.
+    Optional filters: bedrooms, property_type.
+    :return: The nearest properties with their distance
     """
-    if os.path.exists(dumpfile):
-        with open(dumpfile, 'rb') as sensor_readings_file:
-            return pickle.load(sensor_readings_file)
-    else:
-        return {}
+    property_id, latitude, longitude = neighbor_query_center()
+    k = request.args.get('k', default=20, type=int)
+    if k is None or k < 1 or k > max_neighbors:
+        abort(400)
+    neighbors = property_neighbors.nearest(latitude, longitude, k,
+                                           bedrooms=request.args.get('bedrooms', type=int),
+                                           property_type=request.args.get('property_type'),
+                                           exclude_property_id=property_id)
+    return jsonify({
+        'title': f"{k} nearest properties",
+        'data': neighbors,
+        'info': {'center': {'lat': latitude, 'lon': longitude}, 'property_id': property_id, 'k': k}
+    })
+
+
+# curl -i -H "Content-Type: application/json" http://localhost:5000/v1/api/cache/stats
+@app.route('/v1/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """
+    Gets the hit and miss counters of the query cache
+    """
+    return jsonify(query_cache.stats())
+
+
+# curl http://localhost:5000/metrics
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Exposes the metrics of the OpenAI calls, the database queries and the routes to Prometheus
+    """
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
+
+def wrap_critical_review(critical_review):
+    """
+    Wraps the lines of the critical review at 100 characters, indenting the continuation lines.
+    """
+    all_lines_of_review = (critical_review or '').split('\n')
+    final_lines = []
+    for line in all_lines_of_review:
+        wrapped_lines = wrap(line, 100)
+        line_counter = 0
+        for wrapped_line in wrapped_lines:
+            if line_counter > 0:
+                final_lines.append('  ' + wrapped_line)
+            else:
+                final_lines.append(wrapped_line)
+            line_counter += 1
+    return '\n'.join(final_lines)
+
+
+def next_page_url(cursor):
+    """
+    :return: The URL of the current request with its after argument set to the cursor of the next page
+    """
+    args = request.args.to_dict()
+    args['after'] = cursor
+    return f"{request.path}?{urlencode(args)}"
+
+
+def neighbor_query_center():
+    """
+    Reads the center of a neighbour query, either the property_id or the lat and lon arguments.
+    :return: A tuple of the property id (None for a lat/lon), the latitude and the longitude
+    """
+    property_id = request.args.get('property_id')
+    if property_id is not None:
+        if not property_id.isdigit():
+            abort(400)
+        location = property_neighbors.location_of(property_id)
+        if location is None:
+            abort(404)
+        return property_id, location[0], location[1]
+    latitude = request.args.get('lat', type=float)
+    longitude = request.args.get('lon', type=float)
+    if latitude is None or longitude is None or not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        abort(400)
+    return None, latitude, longitude
+
+
+def server_sent_event(event, data):
+    """
+    Formats one Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 if __name__ == '__main__':
-    query_cache = loadFromTextFile(query_cache_file_store)
+    if query_cache_file_store is not None:
+        query_cache.enable_snapshots(query_cache_file_store)
+    property_search.ensure_loaded()  # Makes the property read model ready first
+    property_map.ensure_loaded()
+    property_neighbors.ensure_loaded()
     logging.getLogger().setLevel(logging.INFO)
     postgres_logger = logging.getLogger("postgres.connector")
     postgres_logger.setLevel(logging.INFO)
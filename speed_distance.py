@@ -1,4 +1,6 @@
 from haversine import haversine
+import functools
+import numpy as np
 import pandas as pd
 import pyproj
 from polygon_geohasher import polygon_geohasher
@@ -7,6 +9,8 @@ import sys
 import math
 
 _EARTH_RADIUS_KM = 6378.1
+_AVG_EARTH_RADIUS_KM = 6371.0088  # The mean radius used by the haversine package
+_SAME_TIME_SPEED = 1000000000  # float('inf') causes problems with the UI
 
 def calculate_speed(lat1, long1, lat2, long2, time1, time2):
     """
@@ -21,7 +25,8 @@ def calculate_speed(lat1, long1, lat2, long2, time1, time2):
     """
     frame = {'lat1': lat1, 'long1': long1, 'lat2': lat2, 'long2': long2, 'time1': time1, 'time2': time2}
     result = pd.DataFrame(frame)
-    result['speed'] = result.apply(lambda x: device_speed(x['lat1'], x['long1'], x['lat2'], x['long2'], x['time1'], x['time2']), axis=1)
+    result['speed'] = device_speed_array(result['lat1'], result['long1'], result['lat2'], result['long2'],
+                                         result['time1'], result['time2'])
     return result['speed']
 
 
@@ -54,8 +59,7 @@ def device_speed(lat1: float, long1: float, lat2: float, long2: float, time1, ti
     destination = (lat2, long2)
     distance_km = haversine(origin, destination)
     if time1 == time2:
-        # return float('inf') # Causes problem with the UI
-        return 1000000000
+        return _SAME_TIME_SPEED
     else:
         duration_hr = (time2 - time1).total_seconds() / 3600.0
         return distance_km / duration_hr
@@ -78,8 +82,16 @@ def area_bounding_box(lat_span, long_span):
     return height_km * width_km
 
 
+@functools.lru_cache(maxsize=None)
+def get_geod():
+    """
+    Returns the WGS84 geodesic, which is costly to build.
+    """
+    return pyproj.Geod(ellps='WGS84')
+
+
 def forward_bearing(lat1: float, long1: float, lat2: float, long2: float):
-    geodesic = pyproj.Geod(ellps='WGS84')
+    geodesic = get_geod()
     fwd_azimuth, back_azimuth, distance = geodesic.inv(long1, lat1, long2, lat2)
     # print(fwd_azimuth, back_azimuth, distance)
     return fwd_azimuth, distance
@@ -158,3 +170,89 @@ def circle_to_wkt(center_lat, center_lon, radius_km):
 
     poly_wkt += '))'
     return poly_wkt
+
+
+# Array versions of the functions above, they take NumPy arrays (or pandas Series) and compute every row in one call
+
+def distance_great_circle_array(lat1, long1, lat2, long2):
+    """
+    Calculates the great-circle distances between arrays of (lat, lon)s with the haversine method
+    :param lat1: latitudes of origin
+    :param long1: longitudes of origin
+    :param lat2: latitudes of destination
+    :param long2: longitudes of destination
+    :return: the array of distances in meters
+    """
+    return _haversine_array(lat1, long1, lat2, long2) * _AVG_EARTH_RADIUS_KM * 1000.0
+
+
+def device_speed_array(lat1, long1, lat2, long2, time1, time2):
+    """
+    Calculates the speeds of travel between arrays of points
+    :param lat1: latitudes of origin
+    :param long1: longitudes of origin
+    :param lat2: latitudes of destination
+    :param long2: longitudes of destination
+    :param time1: datetime stamps of origin time
+    :param time2: datetime stamps of destination time
+    :return: the array of speeds in Km/hr
+    """
+    distance_km = _haversine_array(lat1, long1, lat2, long2) * _AVG_EARTH_RADIUS_KM
+    duration_hr = (pd.DatetimeIndex(time2) - pd.DatetimeIndex(time1)).total_seconds().to_numpy() / 3600.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(duration_hr == 0, _SAME_TIME_SPEED, distance_km / duration_hr)
+
+
+def forward_bearing_array(lat1, long1, lat2, long2):
+    """
+    Calculates the forward azimuths and the WGS84 geodesic distances between arrays of points
+    :return: a tuple of the array of azimuths in degrees and the array of distances in meters
+    """
+    fwd_azimuth, back_azimuth, distance = get_geod().inv(np.asarray(long1, dtype=float), np.asarray(lat1, dtype=float),
+                                                         np.asarray(long2, dtype=float), np.asarray(lat2, dtype=float))
+    return fwd_azimuth, distance
+
+
+def bounding_box_array(latitudes, longitudes):
+    """
+    Calculates the bounding box of arrays of latitudes and longitudes, like calculate_bounding_box
+    :return: ([min_lat, min_lon], [max_lat, max_lon])
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    if latitudes.size == 0:
+        return ([sys.float_info.max, sys.float_info.max], [-sys.float_info.max, -sys.float_info.max])
+    return ([float(latitudes.min()), float(longitudes.min())], [float(latitudes.max()), float(longitudes.max())])
+
+
+def circle_polygons(center_lats, center_lons, radius_km, step_deg=30):
+    """
+    Calculates the vertices of the circles drawn by circle_to_wkt around arrays of centers
+    :param center_lats: latitudes of the centers
+    :param center_lons: longitudes of the centers
+    :param radius_km: radius of the circles, a scalar or an array
+    :param step_deg: degrees between two vertices
+    :return: a tuple of the latitudes and longitudes of the vertices, one row per center, the last closes the ring
+    """
+    bearings = np.radians(np.arange(0, 360 + step_deg, step_deg, dtype=float))
+    lat1 = np.radians(np.asarray(center_lats, dtype=float))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(center_lons, dtype=float))[:, np.newaxis]
+    angular_distance = (np.asarray(radius_km, dtype=float) / _EARTH_RADIUS_KM).reshape(-1, 1)
+
+    lat2 = np.arcsin(np.sin(lat1) * np.cos(angular_distance) +
+                     np.cos(lat1) * np.sin(angular_distance) * np.cos(bearings))
+    lon2 = lon1 + np.arctan2(np.sin(bearings) * np.sin(angular_distance) * np.cos(lat1),
+                             np.cos(angular_distance) - np.sin(lat1) * np.sin(lat2))
+    return np.degrees(lat2), np.degrees(lon2)
+
+
+def _haversine_array(lat1, long1, lat2, long2):
+    """
+    Calculates the haversine distances on the unit sphere, like the haversine package does for a single pair
+    """
+    lat1 = np.radians(np.asarray(lat1, dtype=float))
+    long1 = np.radians(np.asarray(long1, dtype=float))
+    lat2 = np.radians(np.asarray(lat2, dtype=float))
+    long2 = np.radians(np.asarray(long2, dtype=float))
+    d = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) * 0.5) ** 2
+    return 2 * np.arcsin(np.sqrt(d))
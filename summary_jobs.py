@@ -0,0 +1,147 @@
+"""
+Background summarization of properties requested through the API.
+Summarizing a property takes two GPT-4 calls and tens of seconds, so the request threads only submit a job and
+return. Concurrent requests for the same property share the job that is already in flight instead of paying for the
+same completions again. Finished jobs are remembered for a while so that the pages polling for them can see the result,
+and a failed property is only summarized again after a backoff that doubles with each consecutive failure.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+summary_job_workers = 4
+finished_job_retention = 600  # Seconds
+failed_job_retry_backoff = 30  # Seconds before a failed property is summarized again, doubled per failure
+
+
+class SummaryJobExecutor(object):
+    def __init__(self, review_summarizer, max_workers=summary_job_workers, on_complete=None):
+        """
+        :param review_summarizer: The AirBnbReviewSummarizer that runs the jobs
+        :param max_workers: The number of properties summarized at the same time
+        :param on_complete: Called with the property id after its summary is saved
+        """
+        self.review_summarizer = review_summarizer
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='summary-job')
+        self.on_complete = on_complete
+        self.jobs = collections.OrderedDict()  # property id -> job, oldest first
+        self.lock = threading.Lock()
+
+    def submit(self, property_id):
+        """
+        Starts summarizing a property, unless a job for it is already pending or running.
+        :return: A copy of the job of the property
+        """
+        property_id = int(property_id)
+        with self.lock:
+            self.forget_finished_jobs()
+            job = self.jobs.get(property_id)
+            if job is not None and job['status'] in ['pending', 'running']:
+                return dict(job)
+            job = {'property_id': property_id, 'status': 'pending', 'submitted_at': time.time(),
+                   'finished_at': None, 'error': None, 'failures': self.failures(job)}
+            self.jobs[property_id] = job
+            self.jobs.move_to_end(property_id)
+            self.executor.submit(self.run, job)
+            return dict(job)
+
+    def run(self, job):
+        job['status'] = 'running'
+        try:
+            print(f"Summarizing reviews for property Id {job['property_id']} in the background...")
+            self.review_summarizer.fetch_save_summary_of_reviews_for_single_property(job['property_id'])
+            if self.on_complete is not None:
+                self.on_complete(job['property_id'])
+            job['status'] = 'completed'
+            print(f"Summary of reviews are now saved for property id {job['property_id']}")
+        except (RuntimeError, Exception) as err:
+            job['status'] = 'failed'
+            job['error'] = str(err)
+            job['failures'] += 1
+            print(f"Failed to summarize property Id {job['property_id']}: {err}")
+        finally:
+            job['finished_at'] = time.time()
+
+    def claim(self, property_id):
+        """
+        Registers a summarization that runs outside the executor, e.g. one streamed to the browser, so that no job
+        is started for the same property meanwhile.
+        :return: False when a job for the property is already in flight
+        """
+        property_id = int(property_id)
+        with self.lock:
+            self.forget_finished_jobs()
+            job = self.jobs.get(property_id)
+            if job is not None and job['status'] in ['pending', 'running']:
+                return False
+            self.jobs[property_id] = {'property_id': property_id, 'status': 'running', 'submitted_at': time.time(),
+                                      'finished_at': None, 'error': None, 'failures': self.failures(job)}
+            self.jobs.move_to_end(property_id)
+            return True
+
+    def release(self, property_id, error=None):
+        """
+        Marks a claimed summarization as finished.
+        :param error: The reason it failed, None when the summary was saved
+        """
+        property_id = int(property_id)
+        if error is None and self.on_complete is not None:
+            self.on_complete(property_id)
+        with self.lock:
+            job = self.jobs.get(property_id)
+            if job is not None:
+                job['status'] = 'completed' if error is None else 'failed'
+                job['error'] = error
+                job['failures'] += 0 if error is None else 1
+                job['finished_at'] = time.time()
+
+    def finish(self, property_id, deltas):
+        """
+        Finishes a claimed summarization in the background, e.g. one whose client disconnected mid-stream, so that
+        every text is still generated and saved, then releases it.
+        :param deltas: The rest of the generator of the summarization, which saves the texts as they complete
+        """
+        def run():
+            error = None
+            try:
+                for _ in deltas:
+                    pass
+                print(f"Summary of reviews are now saved for property id {property_id}")
+            except (RuntimeError, Exception) as err:
+                error = str(err)
+                print(f"Failed to summarize property Id {property_id}: {err}")
+            self.release(property_id, error)
+
+        self.executor.submit(run)
+
+    def status(self, property_id):
+        """
+        Returns a copy of the latest job of the property, None when there is none.
+        """
+        with self.lock:
+            job = self.jobs.get(int(property_id))
+            return dict(job) if job is not None else None
+
+    @staticmethod
+    def failures(job):
+        """
+        Returns the number of consecutive failures of a property, carried over from its previous job.
+        """
+        return job['failures'] if job is not None and job['status'] == 'failed' else 0
+
+    @staticmethod
+    def retry_delay(job):
+        """
+        Returns the seconds until a failed job may be submitted again, 0 when it may be now or did not fail.
+        """
+        if job is None or job['status'] != 'failed':
+            return 0
+        backoff = min(failed_job_retry_backoff * 2 ** (job['failures'] - 1), finished_job_retention)
+        return max(0.0, job['finished_at'] + backoff - time.time())
+
+    def forget_finished_jobs(self):
+        expired_at = time.time() - finished_job_retention
+        for property_id in [property_id for property_id, job in self.jobs.items()
+                            if job['finished_at'] is not None and job['finished_at'] < expired_at]:
+            del self.jobs[property_id]
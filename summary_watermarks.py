@@ -0,0 +1,62 @@
+"""
+High-water marks of the summaries, kept per property in JoshuaSummaryWatermarks: the date of the newest review a
+summary covers and the number of its reviews. The incremental refresh merges only the reviews past the mark.
+
+A mark is recorded in the statement that saves the summary, from the reviews of the property at that moment, rather
+than later when the refresh runs: the reviews that arrive in between are then past the mark and get merged. The
+incremental refresh records its own marks, from the reviews it actually merged.
+
+The columns of JOSHUA_REVIEWS_WITH_METADATA are configured below as SQL expressions over the alias R. Drop the casts
+when the columns already have these types, so that an index on (property id, review date) can be used.
+"""
+import threading
+
+reviews_table = 'JOSHUA_REVIEWS_WITH_METADATA'
+review_property_id_sql = 'CAST(R.PROPERTY_ID AS bigint)'
+review_date_sql = 'CAST(R.REVIEW_DATE AS timestamp)'
+review_text_sql = 'R.REVIEW_TEXT'
+
+watermark_table = 'JoshuaSummaryWatermarks'
+
+_watermark_table_ready = False
+_watermark_table_lock = threading.Lock()
+
+
+def ensure_watermark_table(postgres_helper):
+    """
+    Creates the table of the marks, once per process.
+    """
+    global _watermark_table_ready
+    if _watermark_table_ready:
+        return
+    with _watermark_table_lock:
+        if _watermark_table_ready:
+            return
+        postgres_helper.execute(f"""
+        CREATE TABLE IF NOT EXISTS {watermark_table} (
+            PROPERTY_ID bigint PRIMARY KEY,
+            LAST_REVIEW_DATE timestamp NOT NULL,
+            REVIEW_COUNT integer NOT NULL,
+            SUMMARIZED_AT timestamp NOT NULL DEFAULT now()
+        )
+        """)
+        _watermark_table_ready = True
+
+
+def mark_covered_reviews_sql(property_ids_sql):
+    """
+    Returns the statement that sets the marks of properties to all their current reviews, to follow the saves of their
+    summaries in the same statement.
+    :param property_ids_sql: A query of the ids of the properties whose summaries were saved
+    """
+    return f"""
+    INSERT INTO {watermark_table} (PROPERTY_ID, LAST_REVIEW_DATE, REVIEW_COUNT, SUMMARIZED_AT)
+    SELECT {review_property_id_sql}, MAX({review_date_sql}), COUNT(*), now()
+    FROM {reviews_table} R
+    WHERE {review_property_id_sql} IN ({property_ids_sql})
+    GROUP BY {review_property_id_sql}
+    ON CONFLICT (PROPERTY_ID) DO UPDATE
+    SET LAST_REVIEW_DATE = EXCLUDED.LAST_REVIEW_DATE,
+        REVIEW_COUNT = EXCLUDED.REVIEW_COUNT,
+        SUMMARIZED_AT = EXCLUDED.SUMMARIZED_AT
+    """
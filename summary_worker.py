@@ -0,0 +1,288 @@
+"""
+Summarization workers that share the backlog through the database.
+A worker summarizes each property it claims with HierarchicalReviewSummarizer.summarize_property. The batch drivers,
+generate_hierarchical_summaries and generate_property_summary_from_basemodel, pick their properties by streaming the
+rows WHERE SUMMARY IS NULL instead, so two processes summarize, and pay for, the same properties, and a crash loses
+track of what was in flight. Here the backlog is a queue table, JoshuaSummaryWork, with a status and a number of
+attempts per property:
+    - enqueue adds the properties without a summary, any worker can run it at any time
+    - a worker claims a batch with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers on any machine never claim
+      the same property, and leases it for lease_seconds, renewed by a heartbeat while it is summarized
+    - a property is marked done once its summaries are written, and goes back to pending with a backoff on failure,
+      until max_attempts have failed
+    - the properties of a worker that died are claimed again once their lease has expired
+Any number of workers can therefore drain the backlog in parallel and resume after a failure.
+
+    python summary_worker.py enqueue
+    python summary_worker.py work --batch-size 20 --properties-in-flight 4
+    python summary_worker.py work --poll 60    # Waits for new work instead of exiting once the queue is empty
+    python summary_worker.py status
+"""
+import argparse
+import asyncio
+import os
+import socket
+import time
+import uuid
+import airbnb_review_summarizer as ars
+import metrics
+from hierarchical_summarizer import HierarchicalReviewSummarizer, property_concurrency
+from completion_cache import completion_cache_modes
+
+work_table = 'JoshuaSummaryWork'
+claim_batch_size = 20
+lease_seconds = 600  # A property whose worker stopped renewing its lease for that long is claimed again
+heartbeat_interval = 60  # Seconds between two renewals of the leases
+max_attempts = 3
+retry_backoff_seconds = 300  # Multiplied by the number of attempts
+done_flush_size = 100  # Properties summarized between two saves of their status
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class SummaryWorker(HierarchicalReviewSummarizer):
+    def __init__(self, name=None, **kwargs):
+        """
+        :param name: Names the worker in the queue table, unique per process by default
+        :param kwargs: The arguments of HierarchicalReviewSummarizer
+        """
+        super().__init__(**kwargs)
+        self.name = name or worker_name()
+        self.work_table_ready = False
+        self.leased = set()  # The claimed properties that are not marked yet, only changed on the event loop
+        self.pending_done = []
+
+    def ensure_work_table(self):
+        if self.work_table_ready:
+            return
+        self.postgres_helper.execute(f"""
+        CREATE TABLE IF NOT EXISTS {work_table} (
+            PROPERTY_ID bigint PRIMARY KEY,
+            STATUS text NOT NULL DEFAULT 'pending',
+            ATTEMPTS integer NOT NULL DEFAULT 0,
+            WORKER text,
+            LEASED_UNTIL timestamp,
+            NOT_BEFORE timestamp NOT NULL DEFAULT now(),
+            LAST_ERROR text,
+            UPDATED_AT timestamp NOT NULL DEFAULT now()
+        )
+        """)
+        self.postgres_helper.execute(f"CREATE INDEX IF NOT EXISTS {work_table}_claim ON {work_table} (STATUS, NOT_BEFORE)")
+        self.work_table_ready = True
+
+    def enqueue(self):
+        """
+        Queues the properties without a summary, including the ones done before whose summary was cleared since.
+        """
+        self.ensure_work_table()
+        self.postgres_helper.execute(f"""
+        INSERT INTO {work_table} (PROPERTY_ID)
+        SELECT PROPERTY_ID
+        FROM JoshuaConsolidatedRawReviews
+        WHERE length(CONSOLIDATED_REVIEW) > 0
+        AND SUMMARY IS NULL
+        ON CONFLICT (PROPERTY_ID) DO UPDATE
+        SET STATUS = 'pending', ATTEMPTS = 0, NOT_BEFORE = now(), LAST_ERROR = NULL, UPDATED_AT = now()
+        WHERE {work_table}.STATUS = 'done'
+        """)
+
+    def claim(self, limit):
+        """
+        Leases up to limit properties that are pending, or whose worker let its lease expire, to this worker.
+        The rows locked by the other workers' claims are skipped rather than waited for.
+        :return: The (property_id, consolidated review) of the claimed properties
+        """
+        self.ensure_work_table()
+        sql = f"""
+        WITH CLAIMED AS (
+            UPDATE {work_table} W
+            SET STATUS = 'running', ATTEMPTS = W.ATTEMPTS + 1, WORKER = %s,
+                LEASED_UNTIL = now() + make_interval(secs => %s), UPDATED_AT = now()
+            WHERE W.PROPERTY_ID IN (
+                SELECT PROPERTY_ID
+                FROM {work_table}
+                WHERE ((STATUS = 'pending' AND NOT_BEFORE <= now()) OR (STATUS = 'running' AND LEASED_UNTIL < now()))
+                AND ATTEMPTS < %s
+                ORDER BY NOT_BEFORE, PROPERTY_ID
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING W.PROPERTY_ID
+        )
+        SELECT JCR.PROPERTY_ID, JCR.CONSOLIDATED_REVIEW
+        FROM CLAIMED
+        JOIN JoshuaConsolidatedRawReviews JCR
+            ON JCR.PROPERTY_ID = CLAIMED.PROPERTY_ID
+        """
+        return self.postgres_helper.query(sql, (self.name, lease_seconds, max_attempts, limit))
+
+    def give_up_expired(self):
+        """
+        Fails the properties whose last allowed attempt died with its worker, they would stay running forever.
+        """
+        self.postgres_helper.execute(f"""
+        UPDATE {work_table}
+        SET STATUS = 'failed', LAST_ERROR = 'The lease of the last attempt expired', UPDATED_AT = now()
+        WHERE STATUS = 'running' AND LEASED_UNTIL < now() AND ATTEMPTS >= %s
+        """, (max_attempts,))
+
+    def renew_leases(self, property_ids):
+        if len(property_ids) == 0:
+            return
+        self.postgres_helper.execute(f"""
+        UPDATE {work_table}
+        SET LEASED_UNTIL = now() + make_interval(secs => %s), UPDATED_AT = now()
+        WHERE PROPERTY_ID = ANY(%s) AND WORKER = %s AND STATUS = 'running'
+        """, (lease_seconds, property_ids, self.name))
+
+    def mark_done(self, property_ids):
+        """
+        Marks the properties done once their summaries are in the database, so that a crash summarizes them again
+        rather than never. Properties whose lease was taken over by another worker are left to it.
+        """
+        self.review_writer.flush()
+        if len(property_ids) == 0:
+            return
+        self.postgres_helper.execute(f"""
+        UPDATE {work_table}
+        SET STATUS = 'done', LEASED_UNTIL = NULL, LAST_ERROR = NULL, UPDATED_AT = now()
+        WHERE PROPERTY_ID = ANY(%s) AND WORKER = %s
+        """, (list(property_ids), self.name))
+
+    def mark_failed(self, property_id, error):
+        """
+        Puts a property back in the queue after a backoff, or fails it for good after max_attempts.
+        """
+        self.postgres_helper.execute(f"""
+        UPDATE {work_table}
+        SET STATUS = CASE WHEN ATTEMPTS >= %s THEN 'failed' ELSE 'pending' END,
+            NOT_BEFORE = now() + make_interval(secs => %s * ATTEMPTS),
+            LEASED_UNTIL = NULL, LAST_ERROR = %s, UPDATED_AT = now()
+        WHERE PROPERTY_ID = %s AND WORKER = %s
+        """, (max_attempts, retry_backoff_seconds, error[:2000], int(property_id), self.name))
+
+    def status_counts(self):
+        """
+        :return: A dictionary of the number of properties by status
+        """
+        self.ensure_work_table()
+        return dict(self.postgres_helper.query(f"SELECT STATUS, COUNT(*) FROM {work_table} GROUP BY STATUS"))
+
+    async def flush_done(self):
+        # Taken on the event loop, so every property taken has its summaries queued before the flush
+        property_ids, self.pending_done = self.pending_done, []
+        await self.run_blocking(self.mark_done, property_ids)
+        self.leased.difference_update(property_ids)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(heartbeat_interval)
+            try:
+                await self.run_blocking(self.renew_leases, list(self.leased))
+            except (RuntimeError, Exception) as err:
+                print(f"Failed to renew the leases of worker {self.name}: {err}")
+
+    async def work(self, limit=None, batch_size=claim_batch_size, concurrency=property_concurrency, poll_interval=None):
+        """
+        Claims and summarizes properties, concurrency of them at the same time, until the queue is empty.
+        :param limit: The number of properties, None for all of them
+        :param poll_interval: Seconds to wait for new work once the queue is empty, None to return instead
+        """
+        slots = asyncio.Semaphore(concurrency)
+        tasks = set()
+        failures = 0
+        property_counter = 0
+
+        async def summarize(property_id, consolidated_review):
+            nonlocal failures
+            try:
+                await self.summarize_property(property_id, consolidated_review)
+                self.pending_done.append(int(property_id))
+            except Exception as err:
+                failures += 1
+                print(f"Failed to summarize property Id {property_id}: {err}")
+                try:
+                    await self.run_blocking(self.mark_failed, property_id, str(err))
+                    self.leased.discard(int(property_id))
+                except (RuntimeError, Exception) as mark_err:
+                    print(f"Failed to record the failure of property Id {property_id}: {mark_err}")
+            finally:
+                slots.release()
+
+        print(f"Worker {self.name} started")
+        start_time = time.monotonic()
+        heartbeat = asyncio.create_task(self.heartbeat())
+        try:
+            await self.run_blocking(self.give_up_expired)
+            while limit is None or property_counter < limit:
+                claim_size = batch_size if limit is None else min(batch_size, limit - property_counter)
+                rows = await self.run_blocking(self.claim, claim_size)
+                self.leased.update(int(row[0]) for row in rows)
+                if len(rows) == 0:
+                    if len(tasks) > 0:
+                        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                        continue
+                    if poll_interval is None:
+                        break
+                    await self.flush_done()
+                    await asyncio.sleep(poll_interval)
+                    await self.run_blocking(self.give_up_expired)
+                    continue
+                for property_id, consolidated_review in rows:
+                    await slots.acquire()
+                    task = asyncio.create_task(summarize(property_id, consolidated_review))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    property_counter += 1
+                    if len(self.pending_done) >= done_flush_size:
+                        await self.flush_done()
+                # The next batch is claimed once a slot frees up, so the claimed properties do not wait for long
+                await slots.acquire()
+                slots.release()
+            await asyncio.gather(*tasks)
+            await self.flush_done()
+        finally:
+            heartbeat.cancel()
+        elapsed = time.monotonic() - start_time
+
+        total_cost = self.grand_token_count * ars.cost_per_100k_tokens / 100000
+        print(f"Worker {self.name} summarized properties: {property_counter} ({failures} failed, "
+              f"{self.retry_count} retries)")
+        print(f"Chunks summarized: {self.chunk_calls}, reused: {self.reused_chunks}")
+        print(self.completion_cache.report())
+        print(f"Elapsed: {elapsed:.1f} seconds")
+        print(f"Total tokens: {self.grand_token_count}")
+        print(f"Cost of generating model: ${total_cost}")
+        print(metrics.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the queued properties, with any number of workers.')
+    parser.add_argument('command', choices=['enqueue', 'work', 'status'])
+    parser.add_argument('--limit', type=int, default=0, help='The number of properties, 0 for all of them')
+    parser.add_argument('--batch-size', type=int, default=claim_batch_size, help='Properties claimed at once')
+    parser.add_argument('--poll', type=float, default=None, help='Seconds between two claims once the queue is empty, '
+                                                                 'the worker exits on an empty queue without it')
+    parser.add_argument('--no-enqueue', action='store_true', help='Only drain the queue, without adding to it')
+    parser.add_argument('--properties-in-flight', type=int, default=property_concurrency)
+    parser.add_argument('--concurrency', type=int, default=ars.max_concurrent_requests)
+    parser.add_argument('--rpm', type=int, default=ars.requests_per_minute)
+    parser.add_argument('--tpm', type=int, default=ars.tokens_per_minute)
+    parser.add_argument('--base-url', default=None, help='OpenAI compatible endpoint, e.g. the fake server')
+    parser.add_argument('--cache-mode', choices=completion_cache_modes, default=ars.completion_cache_mode,
+                        help='replay runs offline from the completion cache')
+    args = parser.parse_args()
+
+    worker = SummaryWorker(concurrency=args.concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                           base_url=args.base_url, cache_mode=args.cache_mode)
+    if args.command == 'enqueue':
+        worker.enqueue()
+        print(worker.status_counts())
+    elif args.command == 'status':
+        print(worker.status_counts())
+    else:
+        if not args.no_enqueue:
+            worker.enqueue()
+        asyncio.run(worker.work(args.limit or None, args.batch_size, args.properties_in_flight, args.poll))
@@ -0,0 +1,27 @@
+"""
+The modules of the application are flat files at the root of the repository, and the benchmarks' synthetic database
+answers the queries of the server without PostgreSQL.
+"""
+import os
+import sys
+
+import pytest
+import tiktoken
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [root, os.path.join(root, 'benchmarks')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch):
+    """
+    A tiktoken encoding of one token per byte, so that token counts are exact in the tests and no encoding file has to
+    be downloaded.
+    """
+    import token_budget
+    encoding = tiktoken.Encoding(name='bytes', pat_str=r"""\S+|\s+""",
+                                 mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+    monkeypatch.setattr(token_budget, 'get_encoding', lambda encoding_name=None: encoding)
+    return encoding
@@ -0,0 +1,22 @@
+import pytest
+
+from async_review_summarizer import AsyncAirBnbReviewSummarizer
+
+
+class RecordingWriter(object):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, property_id, kind, text):
+        self.rows.append((property_id, kind, text))
+
+
+@pytest.mark.parametrize('kind', ['summary', 'critical_review'])
+def test_skipped_properties_clear_the_column_of_their_kind(kind):
+    summarizer = AsyncAirBnbReviewSummarizer(api_key='test', cache_mode='off')
+    summarizer.review_writer = RecordingWriter()
+    summarizer.token_worthy_review_stream = lambda property_reviews, prompt, page_size: iter(property_reviews)
+    property_reviews = [(1, 'Great stay', 3), (2, '', 0), (3, 'Noisy', 2)]
+    assert list(summarizer.prepare_reviews(property_reviews, kind, limit=None)) == [(1, 'Great stay', 3),
+                                                                                     (3, 'Noisy', 2)]
+    assert summarizer.review_writer.rows == [(2, kind, "")]
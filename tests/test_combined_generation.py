@@ -0,0 +1,104 @@
+import json
+
+import openai
+import pytest
+from openai.types.chat import ChatCompletion
+
+import airbnb_review_summarizer as ars
+from airbnb_review_summarizer import AirBnbReviewSummarizer
+from token_budget import get_token_budget
+
+
+def completion(content, finish_reason='stop'):
+    return ChatCompletion.model_validate({
+        'id': 'completion', 'object': 'chat.completion', 'created': 0, 'model': ars.openai_model,
+        'choices': [{'index': 0, 'finish_reason': finish_reason,
+                     'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 20, 'total_tokens': 120}
+    })
+
+
+class FakeCompletions(object):
+    """
+    Answers the combined request with the given content and every other request with the text of its kind.
+    """
+    def __init__(self, combined_content):
+        self.combined_content = combined_content
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        if 'response_format' in request:
+            if isinstance(self.combined_content, Exception):
+                raise self.combined_content
+            return completion(self.combined_content)
+        kind = 'summary' if request['messages'][0]['content'] == ars.summary_prompt else 'critical_review'
+        return completion(f"Two call {kind}")
+
+
+class FakeClient(object):
+    base_url = 'http://localhost:1/v1'
+
+    def __init__(self, combined_content):
+        self.chat = type('Chat', (object,), {})()
+        self.chat.completions = FakeCompletions(combined_content)
+
+
+@pytest.fixture
+def summarizer(byte_encoding, monkeypatch):
+    get_token_budget.cache_clear()
+    summarizer = AirBnbReviewSummarizer(cache_mode='off')
+    summarizer.saved = {}
+    summarizer.get_consolidated_reviews_for_single_property = lambda property_id: 'Great stay|||Noisy street'
+    summarizer.save_property_review_summary = lambda property_id, text: summarizer.saved.__setitem__(
+        (property_id, 'summary'), text)
+    summarizer.save_critical_review = lambda property_id, text: summarizer.saved.__setitem__(
+        (property_id, 'critical_review'), text)
+    yield summarizer
+    get_token_budget.cache_clear()
+
+
+def use_client(monkeypatch, combined_content):
+    fake_client = FakeClient(combined_content)
+    monkeypatch.setattr(ars, 'client', fake_client)
+    return fake_client.chat.completions
+
+
+def test_default_model_generates_both_texts_in_one_json_mode_call(summarizer, monkeypatch):
+    assert not ars.openai_model.startswith(tuple(ars.json_schema_models)) and summarizer.combined_generation
+    completions = use_client(monkeypatch, json.dumps({'summary': ' Quiet ', 'critical_review': 'Noisy'}))
+    summarizer.fetch_save_summary_of_reviews_for_single_property(7)
+    assert [request['response_format'] for request in completions.requests] == [{'type': 'json_object'}]
+    assert summarizer.saved == {(7, 'summary'): 'Quiet', (7, 'critical_review'): 'Noisy'}
+    assert summarizer.generation_totals['combined']['count'] == 1
+    assert summarizer.generation_totals['two_calls']['count'] == 0
+
+
+def test_json_schema_models_get_the_strict_schema(monkeypatch):
+    monkeypatch.setattr(ars, 'openai_model', 'gpt-4o-mini')
+    assert ars.completion_request('combined', 'reviews')['response_format'] == ars.combined_response_format
+    assert 'response_format' not in ars.completion_request('summary', 'reviews')
+
+
+@pytest.mark.parametrize('content', ['not json', json.dumps({'summary': 'Quiet'}),
+                                     json.dumps({'summary': 'Quiet', 'critical_review': 'Noisy', 'extra': 'x'})])
+def test_invalid_combined_response_falls_back_to_two_calls(summarizer, monkeypatch, content):
+    completions = use_client(monkeypatch, content)
+    summarizer.fetch_save_summary_of_reviews_for_single_property(7)
+    assert len(completions.requests) == 3
+    assert summarizer.saved == {(7, 'summary'): 'Two call summary', (7, 'critical_review'): 'Two call critical_review'}
+    assert summarizer.generation_totals['two_calls']['count'] == 1
+    # A property whose response was invalid does not turn combined generation off for the next ones
+    assert summarizer.combined_generation
+
+
+def test_rejected_response_format_turns_combined_generation_off(summarizer, monkeypatch):
+    # Raised as the client raises it for a 400 response, without the HTTP response it is built from
+    error = openai.BadRequestError.__new__(openai.BadRequestError)
+    Exception.__init__(error, "Invalid parameter: 'response_format'")
+    completions = use_client(monkeypatch, error)
+    summarizer.fetch_save_summary_of_reviews_for_single_property(7)
+    summarizer.fetch_save_summary_of_reviews_for_single_property(8)
+    assert [('response_format' in request) for request in completions.requests] == [True, False, False, False, False]
+    assert not summarizer.combined_generation
+    assert summarizer.saved[(8, 'summary')] == 'Two call summary'
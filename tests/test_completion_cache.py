@@ -0,0 +1,119 @@
+import sqlite3
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+import completion_cache
+from completion_cache import CompletionCache, CompletionCacheMiss, completion_key
+
+
+def make_response(content, total_tokens=10):
+    return ChatCompletion.model_validate({
+        'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-test',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': total_tokens - 2, 'completion_tokens': 2, 'total_tokens': total_tokens},
+    })
+
+
+def make_request(text):
+    return {'model': 'gpt-test', 'temperature': 0.5, 'max_tokens': 100,
+            'messages': [{'role': 'system', 'content': 'Summarize'}, {'role': 'user', 'content': text}]}
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / 'completions.sqlite3')
+
+
+def stored_rows(filename):
+    with sqlite3.connect(filename) as connection:
+        return dict(connection.execute('SELECT KEY, LAST_USED_AT FROM completions').fetchall())
+
+
+def test_key_names_the_whole_request():
+    request = make_request('Great stay')
+    assert completion_key(request) == completion_key(dict(reversed(list(request.items()))))
+    assert completion_key(request) != completion_key(make_request('Noisy'))
+    assert completion_key(request) != completion_key(dict(request, temperature=1))
+    assert completion_key(request) != completion_key(dict(request, model='gpt-other'))
+    assert completion_key(request) != completion_key(request, base_url='http://localhost:8089/v1')
+
+
+def test_record_then_replay(filename):
+    calls = []
+
+    def create():
+        calls.append(1)
+        return make_response('A nice place', total_tokens=42)
+
+    cache = CompletionCache(filename, mode='record')
+    first = cache.complete(make_request('Great stay'), create)
+    second = cache.complete(make_request('Great stay'), create)
+    assert len(calls) == 1
+    assert second == first
+    assert cache.report() == 'Completion cache: 1 hits, 1 misses, 42 tokens saved'
+
+    replay = CompletionCache(filename, mode='replay')
+    assert replay.complete(make_request('Great stay'), create).choices[0].message.content == 'A nice place'
+    assert len(calls) == 1
+    with pytest.raises(CompletionCacheMiss):
+        replay.complete(make_request('Noisy'), create)
+    assert len(calls) == 1
+    replay.put(completion_key(make_request('Noisy')), make_response('Loud'))
+    assert completion_key(make_request('Noisy')) not in stored_rows(filename)
+
+
+def test_off_neither_reads_nor_writes(filename):
+    CompletionCache(filename, mode='record').put(completion_key(make_request('Great stay')), make_response('Cached'))
+    cache = CompletionCache(filename, mode='off')
+    assert cache.complete(make_request('Great stay'), lambda: make_response('Fresh')).choices[0].message.content \
+        == 'Fresh'
+    cache.put(completion_key(make_request('Noisy')), make_response('Loud'))
+    assert list(stored_rows(filename)) == [completion_key(make_request('Great stay'))]
+    assert cache.hits == cache.misses == 0
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        CompletionCache(mode='write')
+
+
+def test_least_recently_used_responses_are_evicted(filename, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(completion_cache.time, 'time', lambda: now[0])
+    size = len(make_response('response 0').model_dump_json().encode('utf-8'))
+    cache = CompletionCache(filename, max_bytes=int(3.5 * size), mode='record')
+    keys = [completion_key(make_request(f"review {i}")) for i in range(4)]
+    for i, key in enumerate(keys[:3]):
+        now[0] += 1
+        cache.put(key, make_response(f"response {i}"))
+    now[0] += 1
+    assert cache.get(keys[0]) is not None  # The oldest response is used again
+
+    now[0] += 1
+    cache.put(keys[3], make_response('response 3'))
+    # Four responses are over 3.5 of them, the eviction frees down to 90% of it: the least recently used goes
+    assert sorted(stored_rows(filename)) == sorted([keys[0], keys[2], keys[3]])
+    assert cache.total_bytes == 3 * size
+    reopened = CompletionCache(filename, mode='record')
+    reopened.connect()
+    assert reopened.total_bytes == 3 * size
+
+
+def test_hits_are_touched_in_batches(filename, monkeypatch):
+    monkeypatch.setattr(completion_cache, 'touch_batch_size', 3)
+    now = [1000.0]
+    monkeypatch.setattr(completion_cache.time, 'time', lambda: now[0])
+    cache = CompletionCache(filename, mode='record')
+    keys = [completion_key(make_request(f"review {i}")) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, make_response(f"response {i}"))
+
+    now[0] = 2000.0
+    cache.get(keys[0])
+    cache.get(keys[1])
+    assert set(stored_rows(filename).values()) == {1000.0}
+    cache.get(keys[0])
+    cache.get(keys[2])
+    assert stored_rows(filename) == {key: 2000.0 for key in keys}
+    assert cache.touched == {}
@@ -0,0 +1,158 @@
+"""
+The map-reduce of hierarchical_summarizer with one token per byte, empty prompts and a fake completion, so that the
+chunks can be checked against the budget to the byte. The chunk summaries are kept in an in-memory table.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import airbnb_review_summarizer as ars
+from hierarchical_summarizer import HierarchicalReviewSummarizer
+from token_budget import get_token_budget, review_separator
+
+chunk_tokens = 40
+
+
+class FakeChunkTable(object):
+    def __init__(self):
+        self.rows = {}
+
+    def execute(self, query_string, params=None):
+        assert 'CREATE TABLE' in query_string
+
+    def query(self, query_string, params=None, name=''):
+        property_id, chunk_hashes = params
+        return [(chunk_hash, self.rows[(property_id, chunk_hash)]) for chunk_hash in chunk_hashes
+                if (property_id, chunk_hash) in self.rows]
+
+    def execute_values(self, query_string, rows):
+        for property_id, chunk_hash, level, token_count, summary in rows:
+            self.rows.setdefault((property_id, chunk_hash), summary)
+
+
+class RecordingWriter(object):
+    def __init__(self):
+        self.rows = []
+
+    def add(self, property_id, kind, text):
+        self.rows.append((property_id, kind, text))
+
+
+@pytest.fixture
+def summarizer(byte_encoding, monkeypatch):
+    for kind in ['summary', 'critical_review', 'chunk_summary', 'reduce_summary', 'reduce_critical_review']:
+        monkeypatch.setitem(ars.prompt_settings, kind, dict(ars.prompt_settings[kind], prompt=''))
+    get_token_budget.cache_clear()
+    summarizer = HierarchicalReviewSummarizer(chunk_tokens=chunk_tokens, api_key='test', cache_mode='off')
+    summarizer.postgres_helper = FakeChunkTable()
+    summarizer.review_writer = RecordingWriter()
+    summarizer.calls = []
+    summarizer.summary_width = 3
+
+    async def create_completion(kind, chunk, token_count):
+        summarizer.calls.append((kind, chunk, token_count))
+        text = f"{kind[0]}{len(summarizer.calls):02d}".ljust(summarizer.summary_width, '.')
+        return SimpleNamespace(usage=SimpleNamespace(total_tokens=token_count),
+                               choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+    summarizer.create_completion = create_completion
+    yield summarizer
+    get_token_budget.cache_clear()
+
+
+def consolidated(count):
+    """
+    :return: A consolidated review of count reviews of 9 bytes, the most recent first
+    """
+    return review_separator.join(f"review {i:02d}" for i in reversed(range(count)))
+
+
+def calls_of(summarizer, kind):
+    return [call for call in summarizer.calls if call[0] == kind]
+
+
+def test_reviews_within_the_budget_are_summarized_directly(summarizer):
+    result = asyncio.run(summarizer.summarize_property(1, consolidated(3)))
+    assert [call[0] for call in summarizer.calls] == ['summary', 'critical_review']
+    assert summarizer.calls[0][1:] == (consolidated(3), 33)
+    assert summarizer.review_writer.rows == [(1, 'summary', result['summary']),
+                                             (1, 'critical_review', result['critical_review'])]
+    assert summarizer.postgres_helper.rows == {}
+
+
+def test_chunks_are_packed_oldest_first_within_the_budget(summarizer):
+    asyncio.run(summarizer.summarize_property(1, consolidated(10)))
+    chunks = calls_of(summarizer, 'chunk_summary')
+    # Three reviews of 9 bytes and two separators fill 33 of the 40 tokens, a fourth review would not fit
+    assert [text for _, text, _ in chunks] == [
+        'review 00|||review 01|||review 02',
+        'review 03|||review 04|||review 05',
+        'review 06|||review 07|||review 08',
+        'review 09',
+    ]
+    assert all(token_count == len(text) <= chunk_tokens for _, text, token_count in chunks)
+    assert summarizer.chunk_calls == 4 and summarizer.reused_chunks == 0
+    assert len(summarizer.postgres_helper.rows) == 4
+
+
+def test_partial_summaries_are_reduced_most_recent_first(summarizer):
+    result = asyncio.run(summarizer.summarize_property(1, consolidated(10)))
+    partials = ['c01', 'c02', 'c03', 'c04']
+    reduce_calls = summarizer.calls[4:]
+    assert sorted(call[0] for call in reduce_calls) == ['reduce_critical_review', 'reduce_summary']
+    assert all(text == review_separator.join(reversed(partials)) for _, text, _ in reduce_calls)
+    assert summarizer.review_writer.rows == [(1, 'summary', result['summary']),
+                                             (1, 'critical_review', result['critical_review'])]
+    assert result['summary'].startswith('r') and result['critical_review'].startswith('r')
+
+
+def test_partial_summaries_over_the_budget_are_summarized_one_level_up(summarizer):
+    summarizer.summary_width = 15
+    asyncio.run(summarizer.summarize_property(1, consolidated(10)))
+    # Four partials of 15 bytes do not fit 40 tokens, they are packed two by two into a second level
+    chunks = calls_of(summarizer, 'chunk_summary')
+    assert len(chunks) == 6
+    assert [text for _, text, _ in chunks[4:]] == ['c01............|||c02............',
+                                                   'c03............|||c04............']
+    reduce_summary, = calls_of(summarizer, 'reduce_summary')
+    assert reduce_summary[1] == 'c06............|||c05............'
+    assert len(summarizer.postgres_helper.rows) == 6
+
+
+def test_stored_chunk_summaries_are_reused(summarizer):
+    asyncio.run(summarizer.summarize_property(1, consolidated(10)))
+    summarizer.calls.clear()
+    asyncio.run(summarizer.summarize_property(1, consolidated(10)))
+    assert calls_of(summarizer, 'chunk_summary') == []
+    assert summarizer.reused_chunks == 4
+
+    # A new review only changes the newest chunk
+    summarizer.calls.clear()
+    asyncio.run(summarizer.summarize_property(1, consolidated(11)))
+    assert [text for _, text, _ in calls_of(summarizer, 'chunk_summary')] == ['review 09|||review 10']
+    assert summarizer.reused_chunks == 7
+    reduce_summary, = calls_of(summarizer, 'reduce_summary')
+    assert reduce_summary[1].split(review_separator)[1:] == ['c03', 'c02', 'c01']
+
+    # The summaries of another property are not reused
+    summarizer.calls.clear()
+    asyncio.run(summarizer.summarize_property(2, consolidated(10)))
+    assert len(calls_of(summarizer, 'chunk_summary')) == 4
+
+
+def test_chunk_hash_names_the_model_prompt_and_level(summarizer, monkeypatch):
+    chunk_hash = summarizer.chunk_hash(0, 'review 00')
+    assert summarizer.chunk_hash(0, 'review 00') == chunk_hash
+    assert summarizer.chunk_hash(1, 'review 00') != chunk_hash
+    assert summarizer.chunk_hash(0, 'review 01') != chunk_hash
+    monkeypatch.setitem(ars.prompt_settings, 'chunk_summary', {'prompt': 'Condense', 'temperature': 0.3})
+    other_prompt_hash = summarizer.chunk_hash(0, 'review 00')
+    monkeypatch.setattr(ars, 'openai_model', 'another-model')
+    assert len({chunk_hash, other_prompt_hash, summarizer.chunk_hash(0, 'review 00')}) == 3
+
+
+def test_empty_reviews_clear_the_summary(summarizer):
+    assert asyncio.run(summarizer.summarize_property(1, ' ||| ')) == {'summary': "", 'critical_review': None}
+    assert summarizer.calls == []
+    assert summarizer.review_writer.rows == [(1, 'summary', "")]
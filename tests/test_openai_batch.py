@@ -0,0 +1,89 @@
+import json
+import types
+
+import pytest
+
+import airbnb_review_summarizer as ars
+import openai_batch
+from openai_batch import OpenAIBatchSummarizer
+
+
+def write_export(path, property_ids, kind='summary'):
+    with open(path, 'w') as export_file:
+        for property_id in property_ids:
+            export_file.write(json.dumps({'messages': [{'role': 'system', 'content': 'old prompt'},
+                                                       {'role': 'user', 'content': f"Reviews of {property_id}"}],
+                                          'property_id': property_id, 'kind': kind}) + '\n')
+    return str(path)
+
+
+def result_line(property_id, content=None, error=None):
+    if content is None:
+        return json.dumps({'custom_id': str(property_id), 'response': {'status_code': 400, 'body': {'error': error}},
+                           'error': None})
+    body = {'choices': [{'message': {'content': content}}], 'usage': {'total_tokens': 10}}
+    return json.dumps({'custom_id': str(property_id), 'response': {'status_code': 200, 'body': body}, 'error': None})
+
+
+@pytest.fixture
+def batches(tmp_path, monkeypatch):
+    batch_summarizer = OpenAIBatchSummarizer(str(tmp_path / 'manifest.json'))
+    batch_summarizer.saved = []
+    monkeypatch.setattr(openai_batch, 'bulk_update_reviews',
+                        lambda postgres_helper, kind, rows: batch_summarizer.saved.append((kind, rows)))
+    return batch_summarizer
+
+
+def test_shards_hold_at_most_size_requests(batches, tmp_path):
+    export = write_export(tmp_path / 'token_worthy_reviews_critical_review_240101_120000.jsonl', [1, 2, 3],
+                          kind='critical_review')
+    shards = batches.shard_jsonl(export, kind='critical_review', size=2)
+    assert shards == [str(tmp_path / f"token_worthy_reviews_critical_review_240101_120000_batch_{i:04d}.jsonl")
+                      for i in range(2)]
+    requests = [json.loads(line) for shard in shards for line in open(shard)]
+    assert [request['custom_id'] for request in requests] == ['1', '2', '3']
+    assert requests[0]['body']['messages'] == [
+        {'role': 'system', 'content': ars.prompt_settings['critical_review']['prompt']},
+        {'role': 'user', 'content': 'Reviews of 1'}]
+    assert requests[0]['body']['temperature'] == ars.prompt_settings['critical_review']['temperature']
+
+
+def test_shards_refuse_an_export_of_another_kind(batches, tmp_path):
+    export = write_export(tmp_path / 'export.jsonl', [1], kind='summary')
+    with pytest.raises(ValueError):
+        batches.shard_jsonl(export, kind='critical_review')
+
+
+def test_parse_output_skips_the_failed_requests(batches):
+    rows, total_tokens = batches.parse_output('\n'.join([result_line(1, 'Quiet'), result_line(2, error={}), '']))
+    assert rows == [(1, 'Quiet')] and total_tokens == 10
+
+
+def test_parse_errors(batches):
+    errors = batches.parse_errors('\n'.join([
+        json.dumps({'custom_id': '2', 'response': None, 'error': {'code': 'x', 'message': 'Too long'}}),
+        result_line(3, error={'message': 'Rate limited'})]))
+    assert errors == [(2, 'Too long'), (3, 'Rate limited')]
+
+
+def test_failed_requests_are_written_to_a_retry_shard(batches, tmp_path, monkeypatch):
+    shard, = batches.shard_jsonl(write_export(tmp_path / 'export.jsonl', [1, 2, 3]))
+    batches.manifest['batches'].append({'batch_id': 'batch_1', 'kind': 'summary', 'shard_file': shard,
+                                        'output_file_id': 'output', 'error_file_id': 'errors', 'status': 'completed',
+                                        'ingested': False})
+    files = {'output': result_line(1, 'Quiet'),
+             'errors': json.dumps({'custom_id': '2', 'response': None, 'error': {'message': 'Too long'}})}
+    client = types.SimpleNamespace(files=types.SimpleNamespace(
+        content=lambda file_id: types.SimpleNamespace(text=files[file_id])))
+    monkeypatch.setattr(ars, 'client', client)
+    batches.ingest()
+    assert batches.saved == [('summary', [(1, 'Quiet')])]
+    entry = batches.manifest['batches'][0]
+    assert entry['ingested']
+    # Property 3 has neither a result nor an error, as when the batch expired before running it
+    assert [json.loads(line)['custom_id'] for line in open(entry['retry_shard_file'])] == ['2', '3']
+
+    submitted = []
+    monkeypatch.setattr(batches, 'submit_shard', lambda shard_filename, kind: submitted.append((shard_filename, kind)))
+    batches.retry()
+    assert submitted == [(entry['retry_shard_file'], 'summary')]
@@ -0,0 +1,85 @@
+import gzip
+import json
+import zlib
+
+import pytest
+from flask import Flask
+
+import payload_encoding
+from payload_encoding import columnar, encode_payload, gzip_chunks, payload_response
+
+app = Flask(__name__)
+
+large_payload = {'data': [{'property_id': str(i), 'city': 'Austin'} for i in range(200)]}
+
+
+def test_columnar_encodes_the_dictionary_fields():
+    rows = [{'id': 1, 'city': 'Austin'}, {'id': 2, 'city': 'Boston'}, {'id': 3, 'city': 'Austin'}]
+    assert columnar(rows, ['id', 'city'], dictionary_fields=['city']) == {
+        'fields': ['id', 'city'],
+        'columns': {'id': [1, 2, 3], 'city': [0, 1, 0]},
+        'dictionaries': {'city': ['Austin', 'Boston']}
+    }
+
+
+def test_etag_names_the_content():
+    assert encode_payload({'a': 1, 'b': [1, 2]})['etag'] == encode_payload({'a': 1, 'b': [1, 2]})['etag']
+    assert encode_payload({'a': 1})['etag'] != encode_payload({'a': 2})['etag']
+    assert json.loads(encode_payload({'a': 1})['bodies']['identity']) == {'a': 1}
+
+
+def test_matching_etag_is_not_modified():
+    encoded_payload = encode_payload(large_payload)
+    with app.test_request_context(headers={'If-None-Match': f"\"{encoded_payload['etag']}\""}):
+        response = payload_response(encoded_payload)
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.get_etag() == (encoded_payload['etag'], False)
+
+
+def test_stale_etag_gets_the_payload():
+    encoded_payload = encode_payload(large_payload)
+    with app.test_request_context(headers={'If-None-Match': '"stale"'}):
+        response = payload_response(encoded_payload)
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == large_payload
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+
+
+def test_gzip_body_is_compressed_once(monkeypatch):
+    monkeypatch.setattr(payload_encoding, 'brotli', None)
+    encoded_payload = encode_payload(large_payload)
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip, br'}):
+        response = payload_response(encoded_payload)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.get_data())) == large_payload
+    compressed = encoded_payload['bodies']['gzip']
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        assert payload_response(encoded_payload).get_data() is compressed
+
+
+@pytest.mark.skipif(payload_encoding.brotli is None, reason='brotli is not installed')
+def test_brotli_is_preferred():
+    encoded_payload = encode_payload(large_payload)
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip, br'}):
+        response = payload_response(encoded_payload)
+    assert response.headers['Content-Encoding'] == 'br'
+    assert json.loads(payload_encoding.brotli.decompress(response.get_data())) == large_payload
+
+
+def test_small_bodies_are_not_compressed():
+    encoded_payload = encode_payload({'a': 1})
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = payload_response(encoded_payload, max_age=60)
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Cache-Control'] == 'max-age=60, must-revalidate'
+
+
+def test_gzip_chunks_are_flushed_one_by_one():
+    chunks = ['{"data":[', '1,2,', '3]}']
+    compressed = list(gzip_chunks(chunk for chunk in chunks))
+    assert gzip.decompress(b''.join(compressed)) == b'{"data":[1,2,3]}'
+    decompressor = zlib.decompressobj(31)
+    # Every chunk can be decompressed as soon as it is received
+    assert [decompressor.decompress(data) for data in compressed[:len(chunks)]] == [chunk.encode() for chunk in chunks]
@@ -0,0 +1,108 @@
+import gzip
+import json
+
+import pytest
+
+import server
+from synthetic_data import SyntheticDataset, SyntheticPostgres
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return SyntheticDataset(1200)
+
+
+@pytest.fixture
+def client(dataset, monkeypatch):
+    """
+    A client of the server whose database is the synthetic one.
+    """
+    database = SyntheticPostgres(dataset)
+    monkeypatch.setattr(server, 'postgres', database)
+    monkeypatch.setattr(server.property_read_model, 'postgres_helper', database)
+    monkeypatch.setattr(server.property_read_model, 'refresh_interval', None)
+    server.query_cache.invalidate('property_list')
+    yield server.app.test_client()
+    server.query_cache.invalidate('property_list')
+
+
+def property_ids(dataset):
+    return [str(property_id) for property_id in dataset.property_ids]
+
+
+def test_page_query_reads_one_row_more_than_the_limit():
+    query_string, params = server.property_list_page_query(100, None)
+    assert 'PROPERTY_ID >' not in query_string
+    assert params == (101,)
+    query_string, params = server.property_list_page_query(100, 12345)
+    assert 'AND PROPERTY_ID > %s' in query_string and 'ORDER BY PROPERTY_ID' in query_string
+    assert params == (12345, 101)
+
+
+def test_cursor_pages_cover_every_property_once(client, dataset):
+    seen = []
+    url = '/v1/api/property/list/all?limit=500'
+    while url is not None:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = response.get_json()
+        seen += [row['property_id'] for row in page['data']]
+        link = response.headers.get('Link')
+        assert (link is None) == (page['next_cursor'] is None)
+        url = link[1:link.index('>')] if link is not None else None
+    assert seen == property_ids(dataset)
+
+
+def test_last_page_and_empty_page(client, dataset):
+    last_ids = property_ids(dataset)[-3:]
+    page = client.get(f"/v1/api/property/list/all?limit=3&after={int(last_ids[0]) - 1}").get_json()
+    assert [row['property_id'] for row in page['data']] == last_ids
+    assert page['next_cursor'] is None
+    page = client.get(f"/v1/api/property/list/all?after={last_ids[-1]}").get_json()
+    assert page['data'] == [] and page['next_cursor'] is None
+
+
+def test_default_page_is_cached_with_an_etag(client, dataset):
+    response = client.get('/v1/api/property/list/all', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(response.get_data()))['data']) == min(len(dataset),
+                                                                                server.list_default_limit)
+    assert client.get('/v1/api/property/list/all', headers={'If-None-Match': response.headers['ETag']}).status_code \
+        == 304
+
+
+def test_columnar_pages_are_capped(client, dataset, monkeypatch):
+    monkeypatch.setattr(server, 'list_max_columnar_limit', 100)
+    page = client.get('/v1/api/property/list/all?format=columnar&limit=1000').get_json()
+    assert page['columns']['property_id'] == property_ids(dataset)[:100]
+    assert page['next_cursor'] == property_ids(dataset)[99]
+
+
+def test_large_pages_are_streamed_and_continue_like_the_cached_ones(client, dataset, monkeypatch):
+    monkeypatch.setattr(server, 'list_stream_min_rows', 100)
+    monkeypatch.setattr(server, 'list_stream_flush_rows', 50)
+    response = client.get('/v1/api/property/list/all?limit=700', headers={'Accept-Encoding': 'gzip'},
+                          buffered=False)
+    assert 'ETag' not in response.headers
+    chunks = list(response.response)
+    assert len(chunks) > 700 // 50
+    page = json.loads(gzip.decompress(b''.join(chunks)))
+    rest = client.get(f"/v1/api/property/list/all?limit=700&after={page['next_cursor']}")
+    rest_page = json.loads(rest.get_data())
+    assert [row['property_id'] for row in page['data'] + rest_page['data']] == property_ids(dataset)
+    assert rest_page['next_cursor'] is None
+
+
+@pytest.mark.parametrize('query', ['after=abc', 'after=-1', 'limit=0', 'format=csv'])
+def test_invalid_page_arguments(client, query):
+    assert client.get(f"/v1/api/property/list/all?{query}").status_code == 400
+
+
+def test_read_model_changes_drop_the_cached_pages(client):
+    def cached_pages():
+        return [key for namespace, key in server.query_cache.entries if namespace == 'property_list']
+
+    client.get('/v1/api/property/list/all')
+    assert len(cached_pages()) == 1
+    server.property_read_model.on_change()
+    assert cached_pages() == []
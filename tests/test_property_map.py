@@ -0,0 +1,114 @@
+import random
+
+import pytest
+
+import property_map
+import server
+from property_map import PropertyMapIndex, longitude_ranges
+
+
+class FakePostgres(object):
+    def __init__(self, locations):
+        self.locations = locations
+
+    def query(self, query_string, params=None, name=''):
+        return [(property_id, f"Property {property_id}", 1, 1, 'Apartment', '00000', 'City', 1, 'State', latitude,
+                 longitude) for property_id, (latitude, longitude) in self.locations.items()]
+
+
+@pytest.fixture(scope='module')
+def locations():
+    generator = random.Random(0)
+    locations = {str(i): (generator.uniform(30.0, 40.0), generator.uniform(-125.0, -115.0)) for i in range(2000)}
+    # Around the antimeridian and on the edges of cells
+    locations.update({'a1': (10.0, 179.95), 'a2': (10.05, -179.95), 'e1': (34.0, -118.0), 'e2': (34.1, -118.1)})
+    return locations
+
+
+@pytest.fixture
+def index(locations):
+    return PropertyMapIndex(FakePostgres(locations), refresh_interval=None)
+
+
+def visible(locations, south, west, north, east):
+    return sorted(property_id for property_id, (latitude, longitude) in locations.items()
+                  if south <= latitude <= north
+                  and any(range_west <= longitude <= range_east for range_west, range_east in longitude_ranges(west, east)))
+
+
+def test_longitude_ranges_wrap_around_the_antimeridian():
+    assert longitude_ranges(-10, 10) == [(-10, 10)]
+    assert longitude_ranges(170, 190) == [(170, 180.0), (-180.0, -170)]
+    assert longitude_ranges(-200, 200) == [(-180.0, 180.0)]
+
+
+@pytest.mark.parametrize('bounds', [(34.0, -118.1, 34.1, -118.0), (33.03, -119.97, 36.51, -116.02),
+                                    (31.0, -124.0, 39.0, -116.0), (9.9, 179.9, 10.1, 180.1), (-90.0, -180.0, 90.0, 180.0)])
+def test_viewport_has_exactly_the_visible_properties(index, locations, bounds):
+    result = index.viewport(*bounds, zoom=14, marker_limit=len(locations))
+    assert not result['clustered'] and result['clusters'] == []
+    assert sorted(marker['property_id'] for marker in result['data']) == visible(locations, *bounds)
+    assert result['count'] == len(result['data'])
+
+
+@pytest.mark.parametrize('zoom, level', [(12, 0), (5, 1), (1, 2)])
+def test_zoom_selects_the_coarsest_level_that_fits_a_cluster(index, monkeypatch, zoom, level):
+    levels = []
+    cells_in = index.cells_in
+    monkeypatch.setattr(index, 'cells_in', lambda level, *bounds: levels.append(level) or cells_in(level, *bounds))
+    index.viewport(30.0, -125.0, 40.0, -115.0, zoom)
+    assert levels[0] == level
+    # Level 0 is the finest there is, even when its cells are larger than a cluster
+    cluster_degrees = property_map.cluster_cell_pixels * 360.0 / (property_map.tile_size_pixels * 2 ** zoom)
+    assert level == 0 or index.level_degrees[level] <= cluster_degrees
+    assert level == len(index.level_degrees) - 1 or index.level_degrees[level + 1] > cluster_degrees
+
+
+@pytest.mark.parametrize('zoom', [3, 6, 9])
+def test_clusters_count_every_visible_property(index, locations, zoom):
+    bounds = (31.0, -124.0, 39.0, -116.0)
+    result = index.viewport(*bounds, zoom=zoom, marker_limit=100)
+    assert result['clustered']
+    assert result['count'] == len(visible(locations, *bounds))
+    assert sum(cluster['count'] for cluster in result['clusters']) + len(result['data']) == result['count']
+    for cluster in result['clusters']:
+        assert cluster['count'] > 1
+        assert cluster['bottom_left']['lat'] <= cluster['latitude'] <= cluster['top_right']['lat']
+        assert cluster['bottom_left']['lon'] <= cluster['longitude'] <= cluster['top_right']['lon']
+
+
+def test_refresh_moves_and_removes_markers(locations):
+    changed_locations = dict(locations)
+    index = PropertyMapIndex(FakePostgres(changed_locations), refresh_interval=None)
+    index.ensure_loaded()
+    changed_locations['e1'] = (50.0, 10.0)
+    del changed_locations['e2']
+    assert index.refresh() == (1, 1)
+    assert visible(changed_locations, 49.0, 9.0, 51.0, 11.0) == ['e1']
+    assert [marker['property_id'] for marker in index.viewport(49.0, 9.0, 51.0, 11.0, zoom=10)['data']] == ['e1']
+    assert index.viewport(34.05, -118.15, 34.15, -118.05, zoom=14)['count'] == \
+        len(visible(changed_locations, 34.05, -118.15, 34.15, -118.05))
+
+
+@pytest.fixture
+def client(index, monkeypatch):
+    monkeypatch.setattr(server, 'property_map', index)
+    return server.app.test_client()
+
+
+def test_viewport_endpoint(client, locations):
+    page = client.get('/v1/api/property/viewport?south=34.0&west=-118.1&north=34.1&east=-118.0&zoom=14').get_json()
+    assert sorted(marker['property_id'] for marker in page['data']) == visible(locations, 34.0, -118.1, 34.1, -118.0)
+    assert page['info']['count'] == len(page['data']) and page['info']['zoom'] == 14
+    assert page['info']['center'] == {'lat': 34.05, 'lon': -118.05}
+
+
+def test_viewport_endpoint_defaults_to_every_property(client, locations):
+    page = client.get('/v1/api/property/viewport').get_json()
+    assert page['info']['count'] == len(locations)
+    assert page['info']['clustered']
+
+
+@pytest.mark.parametrize('query', ['south=34.0&west=-118.1&north=34.1&east=-118.0', 'south=34.0&zoom=10'])
+def test_viewport_endpoint_needs_the_whole_viewport(client, query):
+    assert client.get(f"/v1/api/property/viewport?{query}").status_code == 400
@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+import speed_distance as sd
+from property_neighbors import PropertyNeighborIndex
+from property_read_model import read_model_table
+
+property_types = ['Apartment', 'House', 'Cabin']
+
+
+class FakeReadModel(object):
+    def __init__(self):
+        self.ready = False
+
+    def ensure_ready(self):
+        self.ready = True
+
+
+class FakePostgres(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def query(self, query_string, params=None, name=''):
+        self.queries.append(query_string)
+        return self.rows
+
+
+@pytest.fixture(scope='module')
+def rows():
+    generator = random.Random(0)
+    rows = [(str(i), f"Property {i}", generator.randint(1, 3), 1, generator.choice(property_types), 'City', 'State',
+             generator.uniform(34.0, 34.5), generator.uniform(-118.5, -118.0)) for i in range(1500)]
+    # Across the antimeridian, 2.2 km apart
+    rows += [('w', 'West', 1, 1, 'House', 'Suva', 'Fiji', -17.0, 179.99), ('e', 'East', 1, 1, 'House', 'Suva', 'Fiji',
+                                                                            -17.0, -179.99)]
+    return rows
+
+
+@pytest.fixture
+def index(rows):
+    return PropertyNeighborIndex(FakePostgres(rows), refresh_interval=None)
+
+
+def haversine_km(rows, latitude, longitude):
+    """
+    The exact distance in km of every property to a location, by brute force.
+    """
+    return {row[0]: sd.distance_great_circle(latitude, longitude, row[7], row[8]) / 1000.0 for row in rows}
+
+
+def test_the_index_reads_the_property_read_model(rows):
+    postgres = FakePostgres(rows)
+    read_model = FakeReadModel()
+    index = PropertyNeighborIndex(postgres, refresh_interval=None, read_model=read_model)
+    assert index.location_of('w') == (-17.0, 179.99)
+    assert read_model.ready
+    assert f"FROM {read_model_table}" in postgres.queries[0] and 'JOSHUAPROPERTIES' not in postgres.queries[0]
+
+
+@pytest.mark.parametrize('radius_km', [0.5, 3.0, 12.0])
+def test_radius_has_exactly_the_properties_within_the_haversine_distance(index, rows, radius_km):
+    latitude, longitude = 34.25, -118.25
+    distances = haversine_km(rows, latitude, longitude)
+    count, neighbors = index.within_radius(latitude, longitude, radius_km, limit=len(rows))
+    expected = sorted((distance, property_id) for property_id, distance in distances.items() if distance <= radius_km)
+    assert count == len(expected) > 0
+    assert [neighbor['property_id'] for neighbor in neighbors] == [property_id for _, property_id in expected]
+    assert all(abs(neighbor['distance_km'] - distances[neighbor['property_id']]) < 0.001 for neighbor in neighbors)
+
+
+def test_radius_counts_every_match_but_returns_limit(index):
+    count, neighbors = index.within_radius(34.25, -118.25, 12.0, limit=5)
+    assert count > 5 and len(neighbors) == 5
+    assert [neighbor['distance_km'] for neighbor in neighbors] == sorted(neighbor['distance_km']
+                                                                         for neighbor in neighbors)
+
+
+def test_radius_crosses_the_antimeridian(index):
+    count, neighbors = index.within_radius(-17.0, 179.99, 3.0, exclude_property_id='w')
+    assert count == 1 and neighbors[0]['property_id'] == 'e'
+
+
+@pytest.mark.parametrize('filters', [{}, {'bedrooms': 2}, {'property_type': 'cabin'}, {'bedrooms': 3,
+                                                                                         'property_type': 'House'}])
+def test_nearest_are_the_k_closest_by_haversine_that_pass_the_filters(index, rows, filters):
+    property_id = rows[0][0]
+    latitude, longitude = index.location_of(property_id)
+    distances = haversine_km(rows, latitude, longitude)
+    matching = [row[0] for row in rows if row[0] != property_id
+                and row[2] == filters.get('bedrooms', row[2])
+                and row[4].lower() == filters.get('property_type', row[4]).lower()]
+    expected = sorted(matching, key=lambda matching_id: distances[matching_id])[:10]
+    neighbors = index.nearest(latitude, longitude, 10, exclude_property_id=property_id, **filters)
+    assert [neighbor['property_id'] for neighbor in neighbors] == expected
+
+
+def test_nearest_with_an_unknown_type_is_empty(index):
+    assert index.nearest(34.25, -118.25, 10, property_type='castle') == []
+    assert index.location_of('unknown') is None
@@ -0,0 +1,72 @@
+import property_read_model
+from property_read_model import PropertyReadModel, read_model_sync_batch_size
+
+
+class RecordingPostgres(object):
+    """
+    Records the statements of the read model, with the number of triggers found installed and the numbers of changes
+    in the log that each sync consumes.
+    """
+    def __init__(self, installed_triggers, changes=()):
+        self.installed_triggers = installed_triggers
+        self.changes = list(changes)
+        self.statements = []
+        self.version = (None, 0)
+
+    def execute(self, query_string, params=None):
+        self.statements.append(query_string)
+
+    def query(self, query_string, params=None, name=''):
+        self.statements.append(query_string)
+        if name == 'read_model_triggers':
+            return [(self.installed_triggers,)]
+        if name == 'read_model_version':
+            return [self.version]
+        consumed = self.changes.pop(0) if self.changes else 0
+        return [(consumed, consumed, 0)]
+
+    def syncs(self):
+        return [statement for statement in self.statements if 'WITH CHANGED' in statement]
+
+
+def test_installing_the_change_capture_applies_the_whole_source():
+    postgres = RecordingPostgres(installed_triggers=0)
+    PropertyReadModel(postgres, refresh_interval=None).ensure_ready()
+    assert sum('CREATE TRIGGER' in statement for statement in postgres.statements) == 2
+    syncs = postgres.syncs()
+    assert len(syncs) == 1
+    assert 'LIMIT %s' not in syncs[0] and 'IN (SELECT PROPERTY_ID FROM CHANGED)' not in syncs[0]
+
+
+def test_syncs_consume_the_change_log_batch_by_batch():
+    postgres = RecordingPostgres(installed_triggers=2, changes=[0, read_model_sync_batch_size, 3])
+    read_model = PropertyReadModel(postgres, refresh_interval=None)
+    read_model.ensure_ready()
+    assert not any('CREATE TRIGGER' in statement for statement in postgres.statements)
+    assert read_model.sync() == (read_model_sync_batch_size + 3, 0)
+    syncs = postgres.syncs()
+    assert len(syncs) == 3
+    assert all('FOR UPDATE SKIP LOCKED' in sync and 'WHERE JCR.PROPERTY_ID IN (SELECT PROPERTY_ID FROM CHANGED)' in sync
+               for sync in syncs)
+
+
+def test_duplicate_properties_are_picked_deterministically():
+    source_sql = property_read_model.read_model_source_sql()
+    order_by = source_sql[source_sql.index('ORDER BY'):]
+    assert order_by.split(',')[0] == 'ORDER BY JCR.PROPERTY_ID'
+    for column in property_read_model.read_model_columns[1:]:
+        assert f"JP.{column}" in order_by
+
+
+def test_a_changed_table_is_reported_to_every_process():
+    postgres = RecordingPostgres(installed_triggers=2)
+    changes = []
+    read_model = PropertyReadModel(postgres, refresh_interval=None, on_change=lambda: changes.append(postgres.version))
+    read_model.ensure_ready()
+    read_model.sync()
+    assert changes == []
+    # Written by the sync of another process, which consumed the change log
+    postgres.version = ('2026-10-18 12:00:00', 1)
+    read_model.sync()
+    read_model.sync()
+    assert changes == [('2026-10-18 12:00:00', 1)]
@@ -0,0 +1,117 @@
+import pytest
+
+from property_search import PropertySearchIndex, decode_search_cursor, encode_search_cursor, trigrams
+
+
+class FakePostgres(object):
+    def __init__(self, titles):
+        self.titles = titles
+
+    def query(self, query_string, params=None, name=''):
+        return list(self.titles.items())
+
+
+@pytest.fixture
+def titles():
+    return {
+        '1234': 'Cozy Cabin',
+        '12345': 'Lake House',
+        '200': 'Cabin in the Woods',
+        '300': 'Mountain cabin retreat',
+        '400': 'Bigcabins Lodge',
+        '500': 'Cabin',
+        '600': 'Seaside Loft 1234',
+    }
+
+
+@pytest.fixture
+def index(titles):
+    return PropertySearchIndex(FakePostgres(titles), refresh_interval=None)
+
+
+def ids(names):
+    return [name.split(':')[0] for name in names]
+
+
+def test_trigrams():
+    assert trigrams('cabin') == {'cab', 'abi', 'bin'}
+    assert trigrams('ab') == set()
+
+
+def test_ranks_title_prefix_then_word_prefix_then_substring(index):
+    # Title prefixes shortest first, then word prefixes earliest first, then substrings
+    assert ids(index.search('cabin')) == ['500', '200', '1234', '300', '400']
+
+
+def test_ranks_exact_id_then_id_prefix_then_title(index):
+    assert ids(index.search('1234')) == ['1234', '12345', '600']
+
+
+def test_short_terms_match_the_beginning_of_words(index):
+    assert ids(index.search('lo')) == ['600', '400']  # Loft is the earlier word
+    assert index.search('x') == []
+
+
+def test_search_is_case_insensitive_and_ignores_blank_terms(index):
+    assert index.search(' CABIN ') == index.search('cabin')
+    assert index.search('   ') == []
+
+
+def test_limit_is_capped(index):
+    assert len(index.search('cabin', limit=2)) == 2
+    assert len(index.search('cabin', limit=0)) == 1
+
+
+def test_pages_follow_each_other_without_duplicates(index):
+    everything, last_cursor = index.search_page('cabin', limit=50)
+    assert last_cursor is None
+    pages = []
+    cursor = None
+    while True:
+        names, cursor = index.search_page('cabin', limit=2, after=cursor)
+        pages.append(names)
+        if cursor is None:
+            break
+    assert [len(names) for names in pages] == [2, 2, 1]
+    assert [name for names in pages for name in names] == everything
+
+
+def test_cursor_round_trip():
+    cursor = encode_search_cursor((3, 5, 22), '300')
+    assert cursor == '3.5.22.300'
+    assert decode_search_cursor(cursor) == ((3, 5, 22), '300')
+
+
+@pytest.mark.parametrize('cursor', ['', 'abc', '1.2.300', '1.x.3.300', '1.2.3.4.5'])
+def test_invalid_cursor(index, cursor):
+    with pytest.raises(ValueError):
+        decode_search_cursor(cursor)
+    with pytest.raises(ValueError):
+        index.search_page('cabin', after=cursor)
+
+
+def test_refresh_applies_the_differences(index, titles):
+    index.ensure_loaded()
+    titles['700'] = 'Cabin Deluxe'
+    titles['200'] = 'Treehouse in the Woods'
+    del titles['500']
+    assert index.refresh() == (2, 1)
+    assert ids(index.search('cabin')) == ['700', '1234', '300', '400']
+    assert ids(index.search('tree')) == ['200']
+    assert ids(index.search('wo')) == ['200']
+
+
+def test_short_terms_rank_every_match():
+    # More word matches than any page, the best ranked ones coming last in word order
+    titles = {str(1000 + i): f"Zz Ro {i}" for i in range(1500)}
+    titles.update({'1': 'Rove', '2': 'Rowhouse'})
+    index = PropertySearchIndex(FakePostgres(titles), refresh_interval=None)
+    assert ids(index.search('ro', limit=3)) == ['1', '2', '1000']
+    seen = []
+    cursor = None
+    while True:
+        names, cursor = index.search_page('ro', limit=50, after=cursor)
+        seen += ids(names)
+        if cursor is None:
+            break
+    assert len(seen) == len(set(seen)) == len(titles)
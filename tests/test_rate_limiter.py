@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket, backoff_delay
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_bucket_starts_full_and_refills_continuously(clock):
+    bucket = TokenBucket(600, clock=clock)  # 10 units per second
+    assert bucket.time_until_available(600) == 0
+    bucket.consume(600)
+    assert bucket.time_until_available(100) == pytest.approx(10.0)
+    clock.now = 4.0
+    assert bucket.time_until_available(100) == pytest.approx(6.0)
+    clock.now = 10.0
+    assert bucket.time_until_available(100) == 0
+
+
+def test_bucket_never_holds_more_than_a_minute(clock):
+    bucket = TokenBucket(60, clock=clock)
+    clock.now = 3600.0
+    bucket.consume(60)
+    assert bucket.time_until_available(1) == pytest.approx(1.0)
+
+
+def test_oversized_amount_waits_for_a_full_bucket(clock):
+    bucket = TokenBucket(60, clock=clock)
+    bucket.consume(30)
+    assert bucket.time_until_available(1000) == pytest.approx(30.0)
+    bucket.consume(1000)
+    assert bucket.available == pytest.approx(-30.0)
+
+
+def test_drain_does_not_add_up(clock):
+    bucket = TokenBucket(60, clock=clock)
+    bucket.drain(5)
+    bucket.drain(5)
+    assert bucket.time_until_available(1) == pytest.approx(6.0)
+
+
+@pytest.fixture
+def limiter(clock, monkeypatch):
+    """
+    A limiter of 60 requests and 600 tokens per minute whose waits advance the fake clock instead of sleeping.
+    """
+    limiter = RateLimiter(60, 600)
+    limiter.request_bucket = TokenBucket(60, clock=clock)
+    limiter.token_bucket = TokenBucket(600, clock=clock)
+    real_sleep = asyncio.sleep
+
+    async def sleep(seconds):
+        clock.now += seconds
+        await real_sleep(0)
+
+    monkeypatch.setattr(rate_limiter.asyncio, 'sleep', sleep)
+    return limiter
+
+
+def test_acquire_waits_for_the_token_bucket(limiter, clock):
+    async def acquire_all():
+        await limiter.acquire(600)
+        assert clock.now == 0
+        await limiter.acquire(300)
+
+    asyncio.run(acquire_all())
+    assert clock.now == pytest.approx(30.0)
+
+
+def test_acquire_serves_waiters_in_arrival_order(limiter, clock):
+    served = []
+
+    async def acquire(name, token_count):
+        await limiter.acquire(token_count)
+        served.append((name, clock.now))
+
+    async def acquire_all():
+        await limiter.acquire(600)
+        await asyncio.gather(acquire('large', 600), acquire('small', 10))
+
+    asyncio.run(acquire_all())
+    assert [name for name, _ in served] == ['large', 'small']
+    assert served[0][1] == pytest.approx(60.0)
+    assert served[1][1] == pytest.approx(61.0)
+
+
+def test_back_off_pauses_the_next_acquire(limiter, clock):
+    limiter.back_off(5)
+    asyncio.run(limiter.acquire(1))
+    assert clock.now == pytest.approx(6.0)  # The paused bucket has to refill a whole request after the pause
+
+
+def test_backoff_delay_prefers_retry_after_within_the_cap():
+    assert backoff_delay(3, retry_after=7) == 7.0
+    assert backoff_delay(0, cap=10.0, retry_after=30) == 10.0
+
+
+def test_backoff_delay_is_jittered_below_the_exponential_bound(monkeypatch):
+    bounds = []
+    monkeypatch.setattr(rate_limiter.random, 'uniform', lambda low, high: bounds.append((low, high)) or high)
+    assert [backoff_delay(attempt, base=1.0, cap=10.0) for attempt in range(6)] == [1, 2, 4, 8, 10, 10]
+    assert all(low == 0 for low, _ in bounds)
@@ -0,0 +1,46 @@
+import gc
+import weakref
+
+import pytest
+
+import review_writer
+from review_writer import BufferedReviewWriter
+
+
+class RecordingPostgres(object):
+    def __init__(self):
+        self.rows = []
+
+    def execute_values(self, query_string, rows, template=None, page_size=1000):
+        self.rows += rows
+
+
+@pytest.fixture(autouse=True)
+def open_writers(monkeypatch):
+    """
+    Keeps the writers of the other tests out of the exit hook.
+    """
+    monkeypatch.setattr(review_writer, '_open_writers', weakref.WeakSet())
+
+
+def test_writers_are_closed_by_one_exit_hook(monkeypatch):
+    registered = []
+    monkeypatch.setattr(review_writer, '_close_hook_registered', False)
+    monkeypatch.setattr(review_writer.atexit, 'register', registered.append)
+    postgres = RecordingPostgres()
+    writers = [BufferedReviewWriter(postgres, flush_interval=60) for _ in range(3)]
+    assert registered == [review_writer._close_open_writers]
+    writers[0].add(1, 'critical_review', 'Noisy')
+    writers[1].close()
+    review_writer._close_open_writers()
+    assert postgres.rows == [(1, 'Noisy')]
+    assert all(writer.stopped.is_set() for writer in writers)
+    assert len(review_writer._open_writers) == 0
+
+
+def test_unused_writers_are_not_kept_alive():
+    writer = BufferedReviewWriter(RecordingPostgres())
+    assert writer in review_writer._open_writers
+    del writer
+    gc.collect()
+    assert len(review_writer._open_writers) == 0
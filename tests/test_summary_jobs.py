@@ -0,0 +1,182 @@
+import threading
+import time
+
+import pytest
+
+import server
+import summary_jobs
+from summary_jobs import SummaryJobExecutor
+
+
+class StubSummarizer(object):
+    """
+    Summarizes a property when the test lets it, failing while fail is set. Every summarized property is available.
+    """
+    def __init__(self):
+        self.calls = []
+        self.proceed = threading.Event()
+        self.fail = False
+        self.summarized = set()
+        self.saved = {}
+
+    def fetch_save_summary_of_reviews_for_single_property(self, property_id):
+        self.calls.append(property_id)
+        assert self.proceed.wait(5)
+        if self.fail:
+            raise RuntimeError('The model is overloaded')
+        self.summarized.add(int(property_id))
+
+    def stream_summary_of_reviews_for_single_property(self, property_id):
+        for kind in ['summary', 'critical_review']:
+            parts = []
+            for delta in [f"{kind} ", 'of ', str(property_id)]:
+                parts.append(delta)
+                yield kind, delta
+            self.saved[(int(property_id), kind)] = ''.join(parts)
+        self.summarized.add(int(property_id))
+
+    def is_summary_available(self, property_id):
+        return int(property_id) in self.summarized
+
+    def get_consolidated_reviews_for_single_property(self, property_id):
+        return 'Great stay|||Noisy street' if int(property_id) < 1000 else ''
+
+
+def wait_until_finished(jobs, property_id):
+    for _ in range(500):
+        job = jobs.status(property_id)
+        if job['finished_at'] is not None:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"The job of property Id {property_id} did not finish")
+
+
+@pytest.fixture
+def summarizer():
+    return StubSummarizer()
+
+
+@pytest.fixture
+def jobs(summarizer):
+    completed = []
+    jobs = SummaryJobExecutor(summarizer, on_complete=completed.append)
+    jobs.completed = completed
+    yield jobs
+    summarizer.proceed.set()
+    jobs.executor.shutdown(wait=True)
+
+
+def test_concurrent_submissions_share_one_job(jobs, summarizer):
+    first = jobs.submit(7)
+    second = jobs.submit('7')
+    assert first['status'] in ['pending', 'running'] and second['status'] in ['pending', 'running']
+    summarizer.proceed.set()
+    assert wait_until_finished(jobs, 7)['status'] == 'completed'
+    assert summarizer.calls == [7]
+    assert jobs.completed == [7]
+
+
+def test_claimed_properties_are_not_submitted(jobs, summarizer):
+    assert jobs.claim(7)
+    assert not jobs.claim(7)
+    assert jobs.submit(7)['status'] == 'running'
+    jobs.release(7)
+    assert jobs.status(7)['status'] == 'completed' and summarizer.calls == []
+
+
+def test_failures_back_off_twice_as_long_each_time(jobs, summarizer):
+    summarizer.fail = True
+    summarizer.proceed.set()
+    jobs.submit(7)
+    job = wait_until_finished(jobs, 7)
+    assert job['status'] == 'failed' and job['failures'] == 1 and job['error'] == 'The model is overloaded'
+    assert summary_jobs.failed_job_retry_backoff - 1 < jobs.retry_delay(job) <= summary_jobs.failed_job_retry_backoff
+    jobs.submit(7)
+    job = wait_until_finished(jobs, 7)
+    assert job['failures'] == 2
+    assert jobs.retry_delay(job) > 2 * summary_jobs.failed_job_retry_backoff - 1
+    assert jobs.completed == []
+
+
+@pytest.fixture
+def client(monkeypatch, summarizer, jobs):
+    monkeypatch.setattr(server, 'review_summarizer', summarizer)
+    monkeypatch.setattr(server, 'summary_jobs', jobs)
+    server.query_cache.invalidate('review_summary')
+    yield server.app.test_client()
+    server.query_cache.invalidate('review_summary')
+
+
+def test_new_property_is_accepted_then_polled(client, jobs, summarizer):
+    responses = [client.get('/v1/api/reviews/summary/7') for _ in range(2)]
+    assert [response.status_code for response in responses] == [202, 202]
+    body = responses[0].get_json()
+    assert body['status_url'] == '/v1/api/reviews/summary/7/status'
+    assert body['data']['reviews'] == ['Great stay', 'Noisy street'] and body['data']['ai_generated_summary'] is None
+    assert client.get(body['status_url']).get_json()['status'] in ['pending', 'running']
+    summarizer.proceed.set()
+    wait_until_finished(jobs, 7)
+    assert client.get(body['status_url']).get_json()['status'] == 'completed'
+    assert summarizer.calls == [7]
+
+
+def test_property_without_reviews_is_not_found(client, summarizer):
+    assert client.get('/v1/api/reviews/summary/1234').status_code == 404
+    assert summarizer.calls == []
+
+
+def test_failed_property_is_retried_after_the_backoff(client, jobs, summarizer, monkeypatch):
+    summarizer.fail = True
+    summarizer.proceed.set()
+    client.get('/v1/api/reviews/summary/7')
+    wait_until_finished(jobs, 7)
+    response = client.get('/v1/api/reviews/summary/7')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(summary_jobs.failed_job_retry_backoff)
+    body = response.get_json()
+    assert body['status'] == 'failed' and body['error'] == 'The model is overloaded'
+    assert body['retry_after'] == summary_jobs.failed_job_retry_backoff
+    status = client.get('/v1/api/reviews/summary/7/status').get_json()
+    assert status['status'] == 'failed' and status['retry_after'] == summary_jobs.failed_job_retry_backoff
+    assert summarizer.calls == [7]
+
+    # Once the backoff is over, the next request summarizes the property again
+    now = time.time()
+    monkeypatch.setattr(summary_jobs.time, 'time', lambda: now + summary_jobs.failed_job_retry_backoff + 1)
+    summarizer.fail = False
+    assert client.get('/v1/api/reviews/summary/7').status_code == 202
+    wait_until_finished(jobs, 7)
+    assert summarizer.calls == [7, 7]
+
+
+class SavedSummaries(object):
+    """
+    Reads the texts saved by the stub summarizer as the review summary endpoint reads them from the database.
+    """
+    def __init__(self, summarizer):
+        self.summarizer = summarizer
+
+    def query_prepared(self, name, statement, params):
+        property_id = params[0]
+        return [(property_id, 'Great stay|||Noisy street', self.summarizer.saved.get((property_id, 'summary')),
+                 self.summarizer.saved.get((property_id, 'critical_review')))]
+
+
+def test_a_client_leaving_mid_stream_hands_the_generation_over(client, jobs, summarizer, monkeypatch):
+    monkeypatch.setattr(server, 'postgres', SavedSummaries(summarizer))
+    response = client.get('/v1/api/reviews/summary/7/stream', buffered=False)
+    events = iter(response.response)
+    received = b''
+    while b'event: summary' not in received:
+        received += next(events)
+    assert jobs.status(7)['status'] == 'running'
+    response.close()  # The client disconnects before the critical review
+
+    job = wait_until_finished(jobs, 7)
+    assert job['status'] == 'completed'
+    assert summarizer.saved == {(7, 'summary'): 'summary of 7', (7, 'critical_review'): 'critical_review of 7'}
+    assert jobs.completed == [7]
+
+    summary = client.get('/v1/api/reviews/summary/7').get_json()
+    assert summary['data']['ai_generated_summary'] == 'summary of 7'
+    assert server.query_cache.get('review_summary', 7) == (True, summary)
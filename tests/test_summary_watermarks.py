@@ -0,0 +1,49 @@
+import pytest
+
+import summary_watermarks
+from incremental_refresh import IncrementalSummaryRefresher
+from review_writer import bulk_update_reviews
+
+
+class RecordingPostgres(object):
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query_string, params=None):
+        self.statements.append(query_string)
+
+    def execute_values(self, query_string, rows, template=None, page_size=1000):
+        self.statements.append(query_string)
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    monkeypatch.setattr(summary_watermarks, '_watermark_table_ready', False)
+    return RecordingPostgres()
+
+
+def test_saved_summaries_are_marked_in_the_same_statement(postgres):
+    bulk_update_reviews(postgres, 'summary', [(1, 'Quiet'), (2, '')])
+    create, save = postgres.statements
+    assert f"CREATE TABLE IF NOT EXISTS {summary_watermarks.watermark_table}" in create
+    assert save.index('UPDATE JoshuaConsolidatedRawReviews') < save.index('RETURNING JCR.PROPERTY_ID, RESULTS.TEXT') \
+        < save.index(f"INSERT INTO {summary_watermarks.watermark_table}")
+    assert 'FROM SAVED WHERE length(TEXT) > 0' in save
+    # The table is created once per process
+    bulk_update_reviews(postgres, 'summary', [(3, 'Noisy')])
+    assert len(postgres.statements) == 3
+
+
+def test_critical_reviews_and_merges_are_not_marked(postgres):
+    bulk_update_reviews(postgres, 'critical_review', [(1, 'Noisy')])
+    bulk_update_reviews(postgres, 'summary', [(1, 'Quiet')], mark_summaries=False)
+    assert not any(summary_watermarks.watermark_table in statement for statement in postgres.statements)
+
+
+def test_baseline_only_marks_the_properties_without_a_mark(postgres):
+    refresher = IncrementalSummaryRefresher(base_url='http://localhost:1/v1', api_key='test', cache_mode='off')
+    assert refresher.review_writer.mark_summaries is False
+    refresher.postgres_helper = postgres
+    refresher.mark_baseline()
+    baseline = postgres.statements[-1]
+    assert 'NOT EXISTS (SELECT 1 FROM' in baseline and 'NOT IN' not in baseline
@@ -0,0 +1,178 @@
+"""
+The queue of summary_worker against an in-memory model of JoshuaSummaryWork. The model applies the conditions of the
+statements of the worker to the rows, with a clock that the tests move, so that expiring leases and backoffs do not
+take minutes. Statements are serialized as the row locks of PostgreSQL would, SKIP LOCKED included.
+"""
+import asyncio
+
+import pytest
+
+import summary_worker
+from summary_worker import SummaryWorker
+
+
+class FakeWorkTable(object):
+    def __init__(self, property_ids):
+        self.now = 1000.0
+        self.reviews = {property_id: f"Review of {property_id}" for property_id in property_ids}
+        self.rows = {}
+
+    def row(self, property_id):
+        return self.rows[property_id]
+
+    def execute(self, query_string, params=None):
+        if 'CREATE' in query_string:
+            return
+        if f"INSERT INTO {summary_worker.work_table}" in query_string:
+            for property_id in self.reviews:
+                row = self.rows.get(property_id)
+                if row is None or row['status'] == 'done':
+                    self.rows[property_id] = {'status': 'pending', 'attempts': 0, 'worker': None, 'leased_until': None,
+                                              'not_before': self.now, 'last_error': None}
+        elif "SET STATUS = 'failed', LAST_ERROR" in query_string:
+            attempts, = params
+            for row in self.rows.values():
+                if row['status'] == 'running' and row['leased_until'] < self.now and row['attempts'] >= attempts:
+                    row.update(status='failed', last_error='The lease of the last attempt expired')
+        elif 'SET LEASED_UNTIL' in query_string:
+            seconds, property_ids, worker = params
+            for property_id in property_ids:
+                row = self.rows[property_id]
+                if row['worker'] == worker and row['status'] == 'running':
+                    row['leased_until'] = self.now + seconds
+        elif "SET STATUS = 'done'" in query_string:
+            property_ids, worker = params
+            for property_id in property_ids:
+                if self.rows[property_id]['worker'] == worker:
+                    self.rows[property_id].update(status='done', leased_until=None, last_error=None)
+        elif 'CASE WHEN ATTEMPTS' in query_string:
+            attempts, backoff, error, property_id, worker = params
+            row = self.rows[property_id]
+            if row['worker'] == worker:
+                row.update(status='failed' if row['attempts'] >= attempts else 'pending',
+                           not_before=self.now + backoff * row['attempts'], leased_until=None, last_error=error)
+        else:
+            raise AssertionError(f"Unexpected statement {query_string}")
+
+    def query(self, query_string, params=None):
+        if 'FOR UPDATE SKIP LOCKED' in query_string:
+            worker, seconds, attempts, limit = params
+            claimable = sorted((row['not_before'], property_id) for property_id, row in self.rows.items()
+                               if ((row['status'] == 'pending' and row['not_before'] <= self.now)
+                                   or (row['status'] == 'running' and row['leased_until'] < self.now))
+                               and row['attempts'] < attempts)
+            claimed = [property_id for _, property_id in claimable[:limit]]
+            for property_id in claimed:
+                row = self.rows[property_id]
+                row.update(status='running', attempts=row['attempts'] + 1, worker=worker,
+                           leased_until=self.now + seconds)
+            return [(property_id, self.reviews[property_id]) for property_id in claimed]
+        if 'GROUP BY STATUS' in query_string:
+            counts = {}
+            for row in self.rows.values():
+                counts[row['status']] = counts.get(row['status'], 0) + 1
+            return list(counts.items())
+        raise AssertionError(f"Unexpected query {query_string}")
+
+
+@pytest.fixture
+def table():
+    return FakeWorkTable(range(1, 11))
+
+
+def make_worker(table, name):
+    worker = SummaryWorker(name=name, base_url='http://localhost:1/v1', api_key='test', cache_mode='off')
+    worker.postgres_helper = table
+    worker.review_writer.flush = lambda: None
+    return worker
+
+
+@pytest.fixture
+def workers(table):
+    return [make_worker(table, 'a'), make_worker(table, 'b')]
+
+
+def test_claims_of_two_workers_do_not_overlap(table, workers):
+    workers[0].enqueue()
+    first = [row[0] for row in workers[0].claim(4)]
+    second = [row[0] for row in workers[1].claim(4)]
+    assert first == [1, 2, 3, 4]
+    assert second == [5, 6, 7, 8]
+    assert all(table.row(property_id)['attempts'] == 1 for property_id in first + second)
+    assert workers[0].status_counts() == {'running': 8, 'pending': 2}
+
+
+def test_renewing_keeps_the_lease(table, workers):
+    workers[0].enqueue()
+    workers[0].claim(2)
+    table.now += summary_worker.lease_seconds - 1
+    workers[0].renew_leases([1, 2])
+    table.now += 2
+    assert [row[0] for row in workers[1].claim(10)] == list(range(3, 11))
+
+
+def test_an_expired_lease_is_taken_over(table, workers):
+    workers[0].enqueue()
+    workers[0].claim(2)
+    table.now += summary_worker.lease_seconds + 1
+    assert [row[0] for row in workers[1].claim(2)] == [1, 2]
+    assert table.row(1)['attempts'] == 2
+    # The worker that lost its lease can neither renew it nor mark the property done
+    workers[0].renew_leases([1])
+    workers[0].mark_done([1, 2])
+    assert table.row(1)['worker'] == 'b' and table.row(1)['status'] == 'running'
+    workers[1].mark_done([1])
+    assert table.row(1)['status'] == 'done'
+
+
+def test_failures_back_off_then_give_up(table, workers):
+    workers[0].enqueue()
+    for attempt in range(1, summary_worker.max_attempts + 1):
+        table.now = table.row(1)['not_before']
+        claimed = [row[0] for row in workers[0].claim(10)]
+        assert 1 in claimed
+        workers[0].mark_failed(1, 'boom')
+        workers[0].mark_done([property_id for property_id in claimed if property_id != 1])
+        row = table.row(1)
+        assert row['attempts'] == attempt and row['last_error'] == 'boom'
+        if attempt < summary_worker.max_attempts:
+            assert row['status'] == 'pending'
+            assert row['not_before'] == table.now + summary_worker.retry_backoff_seconds * attempt
+            assert workers[1].claim(10) == []
+    assert table.row(1)['status'] == 'failed'
+    table.now += 24 * 3600
+    assert workers[1].claim(10) == []
+
+
+def test_a_last_attempt_whose_worker_died_is_given_up(table, workers):
+    workers[0].enqueue()
+    table.row(1)['attempts'] = summary_worker.max_attempts - 1
+    workers[0].claim(1)
+    table.now += summary_worker.lease_seconds + 1
+    workers[1].give_up_expired()
+    assert table.row(1)['status'] == 'failed'
+    assert table.row(1)['last_error'] == 'The lease of the last attempt expired'
+
+
+def test_workers_drain_the_queue(table, workers, monkeypatch):
+    monkeypatch.setattr(summary_worker, 'done_flush_size', 3)
+    summarized = []
+
+    async def summarize_property(property_id, consolidated_review):
+        await asyncio.sleep(0)
+        if property_id == 4:
+            raise RuntimeError('boom')
+        summarized.append(property_id)
+
+    for worker in workers:
+        worker.summarize_property = summarize_property
+
+    async def work():
+        await asyncio.gather(*[worker.work(batch_size=2, concurrency=2) for worker in workers])
+
+    workers[0].enqueue()
+    asyncio.run(work())
+    assert sorted(summarized) == [1, 2, 3, 5, 6, 7, 8, 9, 10]
+    assert workers[0].status_counts() == {'done': 9, 'pending': 1}
+    assert table.row(4)['not_before'] == table.now + summary_worker.retry_backoff_seconds
+    assert all(len(worker.leased) == 0 and len(worker.pending_done) == 0 for worker in workers)
@@ -0,0 +1,54 @@
+import pytest
+
+from token_budget import TokenBudget, num_tokens
+
+
+@pytest.fixture(autouse=True)
+def one_token_per_byte(byte_encoding):
+    return byte_encoding
+
+
+def test_num_tokens():
+    assert num_tokens('abc def') == 7
+
+
+def test_prompt_is_taken_from_the_budget():
+    budget = TokenBudget(max_tokens=13, prompt='xy')
+    assert budget.prompt_tokens == 2
+    assert budget.budget == 11
+
+
+def test_fit_keeps_the_newest_reviews_that_fit():
+    budget = TokenBudget(max_tokens=11)
+    assert budget.fit('aaaa|||bbbb|||cccc') == ('aaaa|||bbbb', 11)
+    assert budget.fit('aaaa|||bbbbb|||cc') == ('aaaa', 4)  # An older review that fits is not kept past a gap
+
+
+def test_fit_keeps_everything_within_the_budget():
+    budget = TokenBudget(max_tokens=100)
+    assert budget.fit('aaaa|||bbbb') == ('aaaa|||bbbb', 11)
+    assert budget.fit('') == ('', 0)
+
+
+def test_fit_crops_a_newest_review_over_the_budget():
+    budget = TokenBudget(max_tokens=3)
+    assert budget.fit('abcdef|||gh') == ('abc', 3)
+
+
+def test_crop_never_splits_a_character_over_the_budget():
+    budget = TokenBudget(max_tokens=3)
+    cropped, token_count = budget.crop_tokens('ééé')  # Two bytes each
+    assert (cropped, token_count) == ('é', 2)
+
+
+def test_fit_many_matches_fit():
+    budget = TokenBudget(max_tokens=11)
+    texts = ['aaaa|||bbbb|||cccc', '', 'abcdefghijklmnop', 'a|||b|||c|||d|||e']
+    assert budget.fit_many(texts, num_threads=2) == [budget.fit(text) for text in texts]
+    assert budget.fit_many(texts)[3] == ('a|||b|||c', 9)
+
+
+def test_chunks_pack_consecutive_pieces():
+    budget = TokenBudget(max_tokens=11)
+    assert budget.chunks(['aaaa', 'bbbb', 'cccc']) == [('aaaa|||bbbb', 11), ('cccc', 4)]
+    assert budget.chunks(['abcdefghijklmnop', 'x']) == [('abcdefghijk', 11), ('x', 1)]
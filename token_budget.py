@@ -0,0 +1,170 @@
+"""
+Token budgeting of the consolidated reviews.
+A consolidated review is the list of reviews of a property separated by '|||', the most recent first. To fit the
+context budget of a prompt we keep the newest reviews that fit. Each candidate review is encoded once, the text that
+is kept is encoded once more for its exact count, and the older reviews that can not fit are never encoded at all.
+Only when the newest review alone exceeds the budget is it cropped on a token boundary, like
+crop_string_to_max_tokens used to do.
+Encoders are loaded once per process since tiktoken.get_encoding rebuilds its tables on every call.
+Special tokens such as <|endoftext|> are encoded as plain text, since reviews are user content.
+"""
+from functools import lru_cache
+import tiktoken
+
+review_separator = '|||'
+default_encoding = 'cl100k_base'
+encode_threads = 8
+chars_per_token_estimate = 6  # Generous for English, used to decide how many reviews to encode per round
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=default_encoding):
+    """
+    Returns the cached tiktoken encoding.
+    """
+    return tiktoken.get_encoding(encoding_name)
+
+
+def num_tokens(text, encoding_name=default_encoding):
+    """
+    Returns the number of tokens in a text string.
+    """
+    return len(get_encoding(encoding_name).encode_ordinary(text))
+
+
+class TokenBudget(object):
+    def __init__(self, max_tokens=4096, prompt='', encoding_name=default_encoding):
+        """
+        :param max_tokens: The number of tokens available for the prompt and the reviews together
+        :param prompt: The system prompt that is sent along with the reviews
+        :param encoding_name: The tiktoken encoding of the model
+        """
+        self.encoding = get_encoding(encoding_name)
+        self.prompt_tokens = len(self.encoding.encode_ordinary(prompt))
+        self.budget = max(0, max_tokens - self.prompt_tokens)
+        self.separator_tokens = len(self.encoding.encode_ordinary(review_separator))
+
+    def count(self, text):
+        return len(self.encoding.encode_ordinary(text))
+
+    def crop_tokens(self, text):
+        """
+        Crops a text on a token boundary.
+        :return: The cropped text and its number of tokens
+        """
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= self.budget:
+            return text, len(tokens)
+        cropped = self.encoding.decode(tokens[:self.budget])
+        # Decoding may split a multi-byte character, which then encodes into more tokens than it was cropped to
+        while len(cropped) > 0 and self.count(cropped) > self.budget:
+            cropped = cropped[:-1]
+        return cropped, self.count(cropped)
+
+    def fit(self, text):
+        """
+        Keeps the newest reviews of a consolidated review that fit the budget.
+        :return: The cropped text and its exact number of tokens
+        """
+        return self.fit_many([text])[0]
+
+    def fit_many(self, texts, num_threads=encode_threads):
+        """
+        Fits a whole page of consolidated reviews, encoding their reviews in parallel with encode_batch.
+        :param texts: The consolidated reviews
+        :param num_threads: The number of threads tiktoken encodes with
+        :return: A list of (cropped text, exact number of tokens), in the order of texts
+        """
+        reviews = [text.split(review_separator) for text in texts]
+        token_counts = [[] for _ in texts]
+        totals = [0] * len(texts)
+        pending = [i for i, text in enumerate(texts) if len(text) > 0]
+
+        # Encode the reviews newest first in rounds, until each text has run out of budget or of reviews
+        while len(pending) > 0:
+            batch_owners = []
+            batch_reviews = []
+            for i in pending:
+                start = len(token_counts[i])
+                char_allowance = (self.budget - totals[i]) * chars_per_token_estimate
+                end = start
+                while end < len(reviews[i]) and char_allowance > 0:
+                    char_allowance -= len(reviews[i][end]) + len(review_separator)
+                    end += 1
+                for review in reviews[i][start:end]:
+                    batch_owners.append(i)
+                    batch_reviews.append(review)
+
+            for i, tokens in zip(batch_owners, self.encoding.encode_ordinary_batch(batch_reviews, num_threads=num_threads)):
+                token_counts[i].append(len(tokens))
+                totals[i] += len(tokens) + (self.separator_tokens if len(token_counts[i]) > 1 else 0)
+
+            pending = [i for i in pending if totals[i] < self.budget and len(token_counts[i]) < len(reviews[i])]
+
+        results = []
+        for i, text in enumerate(texts):
+            # Take the newest reviews whose running total stays within the budget
+            kept = 0
+            running_total = 0
+            for token_count in token_counts[i]:
+                addition = token_count + (self.separator_tokens if kept > 0 else 0)
+                if running_total + addition > self.budget:
+                    break
+                running_total += addition
+                kept += 1
+            results.append(kept)
+
+        # Tokens can merge across the separator, so the exact count comes from one encode of each final text
+        cropped_texts = [review_separator.join(reviews[i][:kept]) for i, kept in enumerate(results)]
+        exact_counts = [len(tokens) for tokens in self.encoding.encode_ordinary_batch(cropped_texts, num_threads=num_threads)]
+
+        fitted = []
+        for i, text in enumerate(texts):
+            kept = results[i]
+            cropped, exact_count = cropped_texts[i], exact_counts[i]
+            while exact_count > self.budget and kept > 1:
+                kept -= 1
+                cropped = review_separator.join(reviews[i][:kept])
+                exact_count = self.count(cropped)
+            if (kept == 0 or exact_count > self.budget) and len(text) > 0:
+                # The newest review alone is over the budget
+                cropped, exact_count = self.crop_tokens(reviews[i][0])
+            fitted.append((cropped, exact_count))
+        return fitted
+
+    def chunks(self, pieces, num_threads=encode_threads):
+        """
+        Packs consecutive pieces of text, e.g. reviews, into as few chunks that fit the budget as possible, joined by
+        the review separator. A piece over the budget on its own is cropped.
+        :param pieces: The texts, in the order they are packed
+        :return: A list of (chunk text, exact number of tokens)
+        """
+        packed = []
+        current = []
+        current_tokens = 0
+        for piece, tokens in zip(pieces, self.encoding.encode_ordinary_batch(pieces, num_threads=num_threads)):
+            token_count = len(tokens)
+            if token_count > self.budget:
+                piece, token_count = self.crop_tokens(piece)
+            addition = token_count + (self.separator_tokens if len(current) > 0 else 0)
+            if len(current) > 0 and current_tokens + addition > self.budget:
+                packed.append(current)
+                current = []
+                addition = token_count
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += addition
+        if len(current) > 0:
+            packed.append(current)
+
+        chunk_texts = [review_separator.join(chunk) for chunk in packed]
+        exact_counts = [len(tokens) for tokens in self.encoding.encode_ordinary_batch(chunk_texts, num_threads=num_threads)]
+        return list(zip(chunk_texts, exact_counts))
+
+
+@lru_cache(maxsize=32)
+def get_token_budget(max_tokens=4096, prompt='', encoding_name=default_encoding):
+    """
+    Returns a shared TokenBudget, so that the prompt is only encoded once per process.
+    """
+    return TokenBudget(max_tokens, prompt, encoding_name)